@@ -0,0 +1,185 @@
+'''Ограниченный LRU-кеш с TTL на уровне модуля: переживает тёплые вызовы функции.
+
+publish_invalidation() ставит NOTIFY speaky_cache в транзакцию записи, а
+локальные ключи сбрасывает commit() уже после COMMIT: иначе параллельный
+запрос успел бы положить в кеш старую строку. Остальные инстансы по
+умолчанию узнают об изменении только по TTL: постоянное LISTEN-соединение
+на каждый тёплый инстанс — лишнее соединение к Postgres, а замороженный
+слушатель задерживает общую очередь NOTIFY. CACHE_LISTEN=1 включает
+LISTEN; функция, у которой уже есть своё LISTEN-соединение, передаёт
+события в receive() сама (chats, см. realtime.py).
+'''
+import json
+import os
+import select
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import psycopg2
+import psycopg2.extensions
+
+MISSING = object()
+CHANNEL = 'speaky_cache'
+
+caches = {}
+
+
+class TTLCache:
+    def __init__(self, name: str = None, max_size: int = 1024, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        if name:
+            caches[name] = self
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def delete_where(self, predicate):
+        '''Удаляет записи, для которых predicate(key, value) истинно (полный проход, кеш ограничен)'''
+        with self._lock:
+            stale = [key for key, (value, _) in self._data.items() if predicate(key, value)]
+            for key in stale:
+                del self._data[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'invalidations': self.invalidations,
+                'size': len(self._data),
+                'max_size': self.max_size
+            }
+
+
+def snapshot() -> dict:
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+# kind -> функции, которые знают, какие ключи этого процесса зависят от id
+_invalidators = {}
+
+
+def on_invalidate(kind: str, fn):
+    _invalidators.setdefault(kind, []).append(fn)
+
+
+def invalidate(kind: str, entity_id):
+    for fn in _invalidators.get(kind, ()):
+        fn(entity_id)
+
+
+# Соединение -> события его открытой транзакции, которые commit() применит локально
+_pending = weakref.WeakKeyDictionary()
+
+
+def publish_invalidation(cur, kind: str, entity_id):
+    '''Ставит NOTIFY в текущую транзакцию; локально ключи сбросит commit(), другие инстансы узнают после COMMIT'''
+    _pending.setdefault(cur.connection, []).append((kind, entity_id))
+    cur.execute('SELECT pg_notify(%s, %s)', (CHANNEL, json.dumps({'kind': kind, 'id': entity_id})))
+
+
+def publish_invalidations(cur, kind: str, entity_ids: list):
+    '''publish_invalidation для многих id одним оператором'''
+    if not entity_ids:
+        return
+    _pending.setdefault(cur.connection, []).extend((kind, entity_id) for entity_id in entity_ids)
+    cur.execute('''
+        SELECT pg_notify(%s, json_build_object('kind', %s::text, 'id', entity_id)::text)
+        FROM unnest(%s) entity_id
+    ''', (CHANNEL, kind, list(entity_ids)))
+
+
+def commit(conn):
+    '''COMMIT и затем локальная инвалидация всего, что опубликовала эта транзакция'''
+    try:
+        conn.commit()
+    finally:
+        # После отката тоже сбрасываем: лишний промах дешевле устаревшей записи
+        for kind, entity_id in _pending.pop(conn, ()):
+            invalidate(kind, entity_id)
+
+
+def receive(payload: str):
+    '''Событие speaky_cache от другого инстанса'''
+    event = json.loads(payload)
+    invalidate(event['kind'], event['id'])
+
+
+def reset():
+    '''Пропущенные события не восстановить — сбрасываем всё, дальше работает TTL'''
+    for cache in caches.values():
+        cache.clear()
+
+
+def listening() -> bool:
+    return os.environ.get('CACHE_LISTEN', '0') == '1'
+
+
+def _listen(dsn: str):
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(dsn, keepalives=1, keepalives_idle=30)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f'LISTEN {CHANNEL}')
+            while True:
+                if select.select([conn], [], [], 30.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    receive(conn.notifies.pop(0).payload)
+        except psycopg2.Error:
+            reset()
+            time.sleep(1.0)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+_listener = None
+
+
+def ensure_listener():
+    global _listener
+    if not listening() or (_listener is not None and _listener.is_alive()):
+        return
+    _listener = threading.Thread(target=_listen, args=(os.environ['DATABASE_URL'],), name='speaky-cache', daemon=True)
+    _listener.start()
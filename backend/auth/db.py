@@ -0,0 +1,148 @@
+'''Пул соединений PostgreSQL на уровне модуля: переживает тёплые вызовы функции'''
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    '''Ограниченный пул с проверкой живости и прозрачным переподключением.
+
+    Свободные соединения перед выдачей проверяются дешёвым conn.poll()
+    (ловит разорванные сервером сессии после failover), а простаивавшие
+    дольше check_interval — ещё и SELECT 1.
+    '''
+
+    def __init__(self, dsn: str, max_size: int = 5, timeout: float = 10.0, check_interval: float = 30.0,
+                 connection_factory=None):
+        self.dsn = dsn
+        self.connection_factory = connection_factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        return psycopg2.connect(
+            self.dsn,
+            connect_timeout=5,
+            keepalives=1,
+            keepalives_idle=30,
+            keepalives_interval=10,
+            keepalives_count=3,
+            connection_factory=self.connection_factory
+        )
+
+    def _healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        try:
+            conn.poll()
+            if time.monotonic() - idle_since >= self.check_interval:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            if not self._idle and self._size >= self.max_size:
+                self.waits += 1
+            while not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f'No free connection in {self.timeout}s (max_size={self.max_size})')
+                self._cond.wait(remaining)
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+            else:
+                conn, idle_since = None, 0.0
+                self._size += 1
+
+        if conn is not None:
+            if self._healthy(conn, idle_since):
+                with self._cond:
+                    self.hits += 1
+                return conn
+            self._discard(conn)
+            with self._cond:
+                self.reconnects += 1
+        else:
+            with self._cond:
+                self.misses += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn):
+        keep = not conn.closed
+        if keep and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+        if not keep:
+            self._discard(conn)
+        with self._cond:
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._size -= 1
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'reconnects': self.reconnects,
+                'size': self._size,
+                'idle': len(self._idle),
+                'max_size': self.max_size
+            }
+
+
+# Подкласс psycopg2 connection для всех соединений пула (локальный стенд считает через него запросы)
+connection_factory = None
+
+_pool = None
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(
+            os.environ['DATABASE_URL'],
+            max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '5')),
+            timeout=float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+            check_interval=float(os.environ.get('DB_POOL_CHECK_INTERVAL', '30')),
+            connection_factory=connection_factory
+        )
+    return _pool
@@ -1,26 +1,39 @@
 import json
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
 
+from cache import MISSING, TTLCache, commit, ensure_listener, on_invalidate, publish_invalidation, snapshot
+from db import get_pool
+from instrument import phase, profiled, record_error
+from runtime import TupleCursor, preflight, response
+
+# Телефон пользователя не меняется, поэтому phone -> id кешируется без инвалидации,
+# а сам профиль — по id и сбрасывается при update_profile/verify_user в users
+phone_cache = TTLCache(
+    'phones',
+    max_size=int(os.environ.get('USER_CACHE_SIZE', '4096')),
+    ttl=float(os.environ.get('PHONE_CACHE_TTL', '3600'))
+)
+user_cache = TTLCache(
+    'users',
+    max_size=int(os.environ.get('USER_CACHE_SIZE', '4096')),
+    ttl=float(os.environ.get('USER_CACHE_TTL', '30'))
+)
+
+on_invalidate('user', lambda user_id: user_cache.delete(int(user_id)))
+
+@profiled('auth')
 def handler(event: dict, context) -> dict:
     '''API для регистрации и авторизации пользователей Speaky'''
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return preflight('GET, POST, OPTIONS')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    ensure_listener()
+    pool = get_pool()
+    with phase('connect'):
+        conn = pool.getconn()
+    cur = conn.cursor(cursor_factory=TupleCursor)
     schema = os.environ['MAIN_DB_SCHEMA']
     
     try:
@@ -42,58 +55,45 @@ def handler(event: dict, context) -> dict:
                               verified, enots, is_admin, language, theme, created_at
                 ''', (phone, nickname, username))
                 
-                user = dict(cur.fetchone())
-                conn.commit()
+                user = cur.record()
+                publish_invalidation(cur, 'user', user['id'])
+                commit(conn)
+                phone_cache.set(phone, user['id'])
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'user': user}, default=str),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True, 'user': user})
+            
+            elif action == 'cache_stats':
+                return response(200, snapshot())
             
             elif action == 'login':
                 phone = body.get('phone')
+                user_id = phone_cache.get(phone)
+                user = user_cache.get(user_id) if user_id is not MISSING else MISSING
                 
-                cur.execute(f'''
-                    SELECT id, phone, nickname, username, avatar_url, banner_url,
-                           verified, enots, is_admin, language, theme, created_at
-                    FROM {schema}.users
-                    WHERE phone = %s
-                ''', (phone,))
-                
-                user = cur.fetchone()
+                if user is MISSING:
+                    cur.execute(f'''
+                        SELECT id, phone, nickname, username, avatar_url, banner_url,
+                               verified, enots, is_admin, language, theme, created_at
+                        FROM {schema}.users
+                        WHERE phone = %s
+                    ''', (phone,))
+                    
+                    user = cur.record()
+                    if user:
+                        phone_cache.set(phone, user['id'])
+                        user_cache.set(user['id'], user)
                 
                 if user:
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'success': True, 'user': dict(user)}, default=str),
-                        'isBase64Encoded': False
-                    }
+                    return response(200, {'success': True, 'user': user})
                 else:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'success': False, 'error': 'User not found'}),
-                        'isBase64Encoded': False
-                    }
+                    return response(404, {'success': False, 'error': 'User not found'})
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return response(405, {'error': 'Method not allowed'})
         
     except Exception as e:
+        record_error(e)
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return response(500, {'error': str(e)})
     finally:
         cur.close()
-        conn.close()
+        pool.putconn(conn)
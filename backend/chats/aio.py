@@ -0,0 +1,152 @@
+'''Асинхронный handler функции chats (HANDLER_MODE=async, см. конец index.py).
+
+Частые чтения (список чатов во всех режимах, участники, присутствие,
+прочтения) идут через пул asyncpg (aiodb.py) без потока на запрос. Запросы
+одного ответа, зависящие друг от друга, остаются последовательными на одном
+соединении: sync_token берётся до выборки, иначе дельта по since потеряет
+изменения между ними. SQL, кеши и сборка ответов общие с index.py, поэтому
+ответы совпадают с синхронным режимом.
+
+Записи и остальные действия выполняет синхронный handler в пуле потоков,
+long-poll updates — в отдельном: каждый ждущий клиент держит поток до
+UPDATES_MAX_WAIT, и общий пул он бы занял целиком.
+'''
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from aiodb import fetch, fetchtuples, fetchval, get_async_pool, numbered, run_sync
+from cache import MISSING, snapshot
+from chatlist import LIST_ORDERS, SYNC_TOKEN_SQL, list_page, list_page_query, list_sql, with_thumb
+from index import (
+    LIST_FETCH_SIZE, error_response, list_changes_sql, list_etag_sql, list_headers, make_etag, members_cache,
+    members_sql, not_modified, sync_handler, wait_for_updates
+)
+from instrument import profiled
+from presence import lookup_sql, parse_ids, presence_of, store
+from reads import RECEIPTS_MAX_USERS, receipts_of, receipts_sql
+from realtime import ensure_listener, get_hub
+from runtime import dumps, raw_response, response
+
+_waiters = ThreadPoolExecutor(int(os.environ.get('ASYNC_UPDATES_WORKERS', '256')), thread_name_prefix='updates')
+
+
+def as_id(raw):
+    '''id из query string: asyncpg, в отличие от литералов psycopg2, строку в integer не приводит'''
+    return int(raw) if raw not in (None, '') else None
+
+
+async def list_changes(conn, schema: str, user_id: int, since: int) -> dict:
+    token = str(await fetchval(conn, SYNC_TOKEN_SQL))
+    changed, removed = list_changes_sql(schema)
+    chats = [with_thumb(chat) for chat in await fetch(conn, changed, {'user_id': user_id, 'since': since})]
+    removed = [chat_id for chat_id, in await fetchtuples(conn, removed, {'user_id': user_id, 'since': since})]
+    return {'chats': chats, 'removed': removed, 'sync_token': token}
+
+
+async def stream_list(conn, query: str, params: dict) -> str:
+    '''JSON-массив чатов из курсора: как index.stream_list, в памяти одна пачка строк'''
+    query, values = numbered(query, params)
+    parts = []
+    async with conn.transaction():
+        async for chat in conn.cursor(query, *values, prefetch=LIST_FETCH_SIZE):
+            parts.append(dumps(with_thumb(dict(chat))))
+    return '[' + ','.join(parts) + ']'
+
+
+async def list_chats(pool, schema: str, event: dict, params: dict) -> dict:
+    user_id = as_id(params.get('user_id'))
+    async with pool.acquire() as conn:
+        if params.get('since'):
+            return response(200, await list_changes(conn, schema, user_id, int(params['since'])))
+
+        # Неизменившийся список отдаётся 304 до выборки строк и сериализации
+        count, total = (await fetchtuples(conn, list_etag_sql(schema), (user_id,)))[0]
+        etag = make_etag(params.get('user_id', ''), params, count, total)
+        headers = list_headers(etag)
+        if not_modified(event, etag):
+            return raw_response(304, '', headers)
+
+        if not params.get('limit') and not params.get('cursor'):
+            sort_key = LIST_ORDERS.get(params.get('order', ''), LIST_ORDERS['created'])
+            body = await stream_list(conn, list_sql(schema, sort_key), {'user_id': user_id})
+            return raw_response(200, body, headers)
+
+        query, values, limit = list_page_query(schema, user_id, params)
+        token = {}
+        if not params.get('cursor'):
+            # Токен первой страницы — до выборки страницы, на том же соединении
+            token['sync_token'] = str(await fetchval(conn, SYNC_TOKEN_SQL))
+        rows = await fetch(conn, query, values)
+    return response(200, list_page(rows, limit, params.get('order', ''), token), headers)
+
+
+async def members(pool, schema: str, event: dict, params: dict) -> dict:
+    chat_id = int(params.get('chat_id', ''))
+    chat_members = members_cache.get(chat_id)
+    if chat_members is MISSING:
+        chat_members = [with_thumb(m) for m in await fetch(pool, members_sql(schema), (chat_id,))]
+        members_cache.set(chat_id, chat_members)
+    return response(200, chat_members)
+
+
+async def cache_stats(pool, schema: str, event: dict, params: dict) -> dict:
+    return response(200, {**snapshot(), 'presence': store.stats()})
+
+
+async def receipts(pool, schema: str, event: dict, params: dict) -> dict:
+    chat_id, message_id = int(params['chat_id']), int(params['message_id'])
+    rows = await fetchtuples(pool, receipts_sql(schema), (chat_id, message_id, RECEIPTS_MAX_USERS))
+    return response(200, receipts_of(chat_id, message_id, rows))
+
+
+async def presence(pool, schema: str, event: dict, params: dict) -> dict:
+    try:
+        user_ids = parse_ids(params.get('user_ids'))
+    except ValueError as e:
+        return response(400, {'error': str(e)})
+
+    rows = await fetchtuples(pool, lookup_sql(schema), (user_ids,)) if user_ids else []
+    result = {'presence': presence_of(rows, store.seen(user_ids))}
+    if params.get('chat_id'):
+        get_hub().ensure_started()
+        result['typing'] = store.typing(int(params['chat_id']))
+    return response(200, result)
+
+
+READS = {
+    'list': list_chats,
+    'members': members,
+    'cache_stats': cache_stats,
+    'receipts': receipts,
+    'presence': presence
+}
+
+
+async def handler(event: dict, context) -> dict:
+    '''API для управления чатами, группами и каналами (асинхронный режим)'''
+    params = event.get('queryStringParameters', {}) or {}
+    action = params.get('action') if event.get('httpMethod', 'GET') == 'GET' else None
+    if action != 'updates' and action not in READS:
+        # Синхронный handler профилирует себя сам
+        return await run_sync(sync_handler, event, context)
+    return await serve(event, context)
+
+
+@profiled('chats')
+async def serve(event: dict, context) -> dict:
+    '''updates и чтения из READS; ошибки — тем же error_response, что в синхронном handler'''
+    params = event['queryStringParameters']
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    try:
+        if params['action'] == 'updates':
+            # Копия контекста — чтобы замеры профиля видели и поток ожидания
+            return await asyncio.get_running_loop().run_in_executor(
+                _waiters, contextvars.copy_context().run, wait_for_updates, params, schema
+            )
+
+        ensure_listener()
+        return await READS[params['action']](await get_async_pool(), schema, event, params)
+    except Exception as e:
+        return error_response(e)
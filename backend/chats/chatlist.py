@@ -0,0 +1,95 @@
+'''Страницы списка чатов пользователя: общий код chats (action=list) и users (action=bootstrap).
+
+Функции деплоятся по отдельности, поэтому копия модуля лежит в каждой из
+двух. Курсор, колонки и порядок одни и те же, так что первую страницу из
+bootstrap клиент листает дальше через chats?action=list&cursor=..., а
+досинхронизируется по её sync_token через since.
+'''
+import base64
+from datetime import datetime
+
+# Аватарки из контентно-адресуемого хранилища upload имеют WebP-ступени <url>_<size>.webp
+MEDIA_PATH = '/speaky/media/'
+THUMB_SIZE = 64
+
+# Ключ сортировки списка; вторым ключом и в курсоре всегда идёт c.id
+LIST_ORDERS = {
+    'created': 'c.created_at',
+    'activity': 'COALESCE(s.last_message_at, c.created_at)'
+}
+
+LIST_DEFAULT_LIMIT = 100
+LIST_MAX_LIMIT = 500
+
+# Бейдж непрочитанных — разность счётчиков (V0016), без подсчёта по messages
+UNREAD_SQL = 'GREATEST(COALESCE(s.message_count, 0) - cm.read_count, 0)'
+
+LIST_COLUMNS = f'''c.id, c.type, c.name, c.avatar_url, c.created_by, c.created_at, cm.role,
+                  COALESCE(s.message_count, 0) as message_count,
+                  s.last_message_id, s.last_message_at, s.last_message_preview,
+                  cm.last_read_message_id, {UNREAD_SQL} AS unread_count'''
+
+SYNC_TOKEN_SQL = 'SELECT txid_snapshot_xmin(txid_current_snapshot())'
+
+
+def with_thumb(row: dict) -> dict:
+    url = row.get('avatar_url')
+    row['avatar_thumb_url'] = f'{url}_{THUMB_SIZE}.webp' if url and MEDIA_PATH in url else url
+    return row
+
+
+def encode_cursor(created_at: datetime, message_id: int) -> str:
+    raw = f'{created_at.isoformat()}|{message_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    created_at, message_id = raw.split('|')
+    return datetime.fromisoformat(created_at), int(message_id)
+
+
+def list_cursor(order: str, chat: dict) -> str:
+    sort_at = (chat['last_message_at'] or chat['created_at']) if order == 'activity' else chat['created_at']
+    return encode_cursor(sort_at, chat['id'])
+
+
+def sync_token(cur) -> str:
+    '''xmin текущего снимка: транзакции старше уже видны, изменения остальных придут в следующей дельте'''
+    cur.execute(SYNC_TOKEN_SQL)
+    return str(cur.fetchone()[0])
+
+
+def list_sql(schema: str, sort_key: str, filters: str = '', paged: bool = False) -> str:
+    '''Чаты пользователя в порядке sort_key: весь список или страница (LIMIT %(limit)s)'''
+    return f'''
+        SELECT {LIST_COLUMNS}
+        FROM {schema}.chats c
+        JOIN {schema}.chat_members cm ON c.id = cm.chat_id
+        LEFT JOIN {schema}.chat_stats s ON s.chat_id = c.id
+        WHERE cm.user_id = %(user_id)s{filters}
+        ORDER BY {sort_key} DESC, c.id DESC
+        {'LIMIT %(limit)s' if paged else ''}
+    '''
+
+
+def list_page_query(schema: str, user_id, params: dict) -> tuple:
+    '''(SQL, параметры, limit) keyset-страницы списка по limit/cursor'''
+    sort_key = LIST_ORDERS.get(params.get('order', ''), LIST_ORDERS['created'])
+    limit = max(1, min(int(params.get('limit') or LIST_DEFAULT_LIMIT), LIST_MAX_LIMIT))
+    query = {'user_id': user_id, 'limit': limit + 1}
+    filters = ''
+    if params.get('cursor'):
+        query['cursor_at'], query['cursor_id'] = decode_cursor(params['cursor'])
+        filters = f' AND ({sort_key}, c.id) < (%(cursor_at)s, %(cursor_id)s)'
+    return list_sql(schema, sort_key, filters, paged=True), query, limit
+
+
+def list_page(rows: list, limit: int, order: str, token: dict) -> dict:
+    '''Страница из limit + 1 строк: лишняя строка означает, что есть следующая'''
+    chats = [with_thumb(chat) for chat in rows[:limit]]
+    return {
+        'chats': chats,
+        'next_cursor': list_cursor(order, chats[-1]) if len(rows) > limit else None,
+        **token
+    }
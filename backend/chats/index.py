@@ -1,35 +1,325 @@
+import hashlib
 import json
 import os
-import psycopg2
 import psycopg2.extras
-from datetime import datetime
 
-def json_serial(obj):
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    raise TypeError(f"Type {type(obj)} not serializable")
+from cache import MISSING, TTLCache, commit, on_invalidate, publish_invalidation, snapshot
+from chatlist import (
+    LIST_COLUMNS, LIST_ORDERS, decode_cursor, encode_cursor, list_page, list_page_query, list_sql, sync_token,
+    with_thumb
+)
+from db import get_pool
+from instrument import phase, profiled, record_error
+from membership import (
+    MEMBERS_REQUEST_MAX, add_members, apply_in_batches, copy_batches, list_batches, remove_members
+)
+from partitions import (
+    ARCHIVE_KEEP_MONTHS, archive_cold, archive_horizon, archived_history, ensure_partitions, legacy_exists, maintain
+)
+from presence import lookup, parse_ids, store
+from reads import MARKS_REQUEST_MAX, apply_marks, latest_marks, mark_sent, receipts
+from realtime import ensure_listener, get_hub
+from runtime import JSON_HEADERS, TupleCursor, dumps, preflight, raw_response, response
 
+# Состав чатов меняется редко, а members открывают постоянно
+members_cache = TTLCache(
+    'members',
+    max_size=int(os.environ.get('MEMBERS_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('MEMBERS_CACHE_TTL', '60'))
+)
+
+on_invalidate('members', lambda chat_id: members_cache.delete(int(chat_id)))
+# В списке участников есть ник и аватар, поэтому изменение профиля тоже сбрасывает списки с этим пользователем
+on_invalidate('user', lambda user_id: members_cache.delete_where(
+    lambda chat_id, members: any(m['id'] == int(user_id) for m in members)
+))
+
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+
+LIST_FETCH_SIZE = 500
+
+def list_etag_sql(schema: str) -> str:
+    '''Число чатов пользователя и сумма changed_xid (V0013) их записей списка'''
+    return f'''
+        SELECT COUNT(*),
+               COALESCE(SUM(COALESCE(cm.changed_xid, 0) + COALESCE(c.changed_xid, 0) + COALESCE(s.changed_xid, 0)), 0)
+        FROM {schema}.chat_members cm
+        JOIN {schema}.chats c ON c.id = cm.chat_id
+        LEFT JOIN {schema}.chat_stats s ON s.chat_id = cm.chat_id
+        WHERE cm.user_id = %s
+    '''
+
+def make_etag(user_id, params: dict, count: int, total) -> str:
+    key = '|'.join(str(params.get(name) or '') for name in ('order', 'cursor', 'limit'))
+    return 'W/"' + hashlib.md5(f'{user_id}|{key}|{count}|{total}'.encode()).hexdigest() + '"'
+
+def list_etag(cur, schema: str, user_id, params: dict) -> str:
+    '''Слабый ETag списка без чтения самих строк: число чатов и сумма changed_xid (V0013).
+
+    Любое изменение записи списка даёт строке новый, больший id транзакции, а
+    выход из чата меняет число строк, поэтому версия меняется вместе со списком.
+    '''
+    cur.execute(list_etag_sql(schema), (user_id,))
+    return make_etag(user_id, params, *cur.fetchone())
+
+def list_headers(etag: str) -> dict:
+    return {**JSON_HEADERS, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'}
+
+def not_modified(event: dict, etag: str) -> bool:
+    request_headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    return etag in (request_headers.get('if-none-match') or '').split(', ')
+
+def list_changes_sql(schema: str) -> tuple:
+    '''Запросы дельты: изменённые записи списка и чаты, из которых пользователь вышел'''
+    changed = f'''
+        SELECT {LIST_COLUMNS}
+        FROM {schema}.chat_members cm
+        JOIN {schema}.chats c ON c.id = cm.chat_id
+        LEFT JOIN {schema}.chat_stats s ON s.chat_id = c.id
+        WHERE cm.user_id = %(user_id)s
+          AND (cm.changed_xid >= %(since)s OR c.changed_xid >= %(since)s OR s.changed_xid >= %(since)s)
+    '''
+    removed = f'''
+        SELECT r.chat_id
+        FROM {schema}.chat_member_removals r
+        WHERE r.user_id = %(user_id)s AND r.removed_xid >= %(since)s
+          AND NOT EXISTS (
+              SELECT 1 FROM {schema}.chat_members cm WHERE cm.chat_id = r.chat_id AND cm.user_id = r.user_id
+          )
+    '''
+    return changed, removed
+
+def list_changes(cur, schema: str, user_id, since: int) -> dict:
+    '''Дельта списка: записи, изменённые транзакциями не старше since, и чаты, из которых пользователь вышел'''
+    token = sync_token(cur)
+    changed, removed = list_changes_sql(schema)
+    cur.execute(changed, {'user_id': user_id, 'since': since})
+    chats = [with_thumb(chat) for chat in cur.records()]
+    cur.execute(removed, {'user_id': user_id, 'since': since})
+    removed = [chat_id for chat_id, in cur.fetchall()]
+    return {'chats': chats, 'removed': removed, 'sync_token': token}
+
+def stream_list(conn, query: str, params: dict) -> str:
+    '''JSON-массив чатов из серверного курсора: в памяти одна пачка строк, а не весь результат'''
+    parts = []
+    with conn.cursor('chat_list', cursor_factory=TupleCursor) as rows:
+        rows.itersize = LIST_FETCH_SIZE
+        rows.execute(query, params)
+        while chunk := rows.fetchmany(LIST_FETCH_SIZE):
+            with phase('serialize'):
+                parts += [dumps(with_thumb(chat)) for chat in rows.records(chunk)]
+    return '[' + ','.join(parts) + ']'
+
+def members_sql(schema: str) -> str:
+    return f'''
+        SELECT u.id, u.nickname, u.username, u.avatar_url, u.verified, cm.role
+        FROM {schema}.users u
+        JOIN {schema}.chat_members cm ON u.id = cm.user_id
+        WHERE cm.chat_id = %s
+    '''
+
+SEND_BATCH_MAX = 1000
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+
+UPDATES_MAX_WAIT = 25.0
+
+def insert_messages(cur, schema: str, items: list) -> list:
+    '''Вставляет пачку сообщений одним INSERT ... VALUES и возвращает результат в порядке items.
+
+    Повтор с тем же (sender_id, idempotency_key) не создаёт дубль: возвращается
+    id уже сохранённого сообщения с duplicate=True. Уникальность ключа держит
+    message_idempotency_keys (на секционированной messages глобального
+    уникального индекса нет): id сообщений выдаются заранее, а вставляются
+    только строки без ключа и те, чей ключ удалось занять. Им же в том же
+    операторе выдаются номера в чате (chat_seq) — из них reads.apply_marks
+    считает прочитанное.
+    '''
+    rows = [(
+        item.get('chat_id'),
+        item.get('user_id'),
+        item.get('message_text'),
+        item.get('media_type', 'text'),
+        item.get('media_url'),
+        item.get('reply_to'),
+        item.get('idempotency_key')
+    ) for item in items]
+    
+    inserted = psycopg2.extras.execute_values(cur, f'''
+        WITH items (n, chat_id, sender_id, message_text, media_type, media_url, reply_to, idempotency_key) AS (
+            VALUES %s
+        ),
+        numbered AS (
+            SELECT nextval('{schema}.messages_id_seq')::int AS id, items.* FROM items
+        ),
+        claimed AS (
+            INSERT INTO {schema}.message_idempotency_keys (sender_id, idempotency_key, message_id, created_at)
+            SELECT DISTINCT ON (sender_id, idempotency_key) sender_id, idempotency_key, id, CURRENT_TIMESTAMP
+            FROM numbered
+            WHERE idempotency_key IS NOT NULL AND sender_id IS NOT NULL
+            ORDER BY sender_id, idempotency_key, n
+            ON CONFLICT DO NOTHING
+            RETURNING message_id
+        ),
+        fresh AS (
+            SELECT * FROM numbered
+            WHERE idempotency_key IS NULL OR sender_id IS NULL OR id IN (SELECT message_id FROM claimed)
+        ),
+        reserved AS (
+            -- Номера chat_seq (V0020): один upsert chat_stats на чат пачки, в порядке chat_id
+            INSERT INTO {schema}.chat_stats AS s (chat_id, message_seq)
+            SELECT chat_id, COUNT(*) FROM fresh WHERE chat_id IS NOT NULL GROUP BY chat_id ORDER BY chat_id
+            ON CONFLICT (chat_id) DO UPDATE SET message_seq = s.message_seq + EXCLUDED.message_seq
+            RETURNING chat_id, message_seq
+        )
+        INSERT INTO {schema}.messages
+            (id, chat_id, sender_id, message_text, media_type, media_url, reply_to, idempotency_key, chat_seq)
+        SELECT f.id, f.chat_id, f.sender_id, f.message_text, f.media_type, f.media_url, f.reply_to, f.idempotency_key,
+               r.message_seq - COUNT(*) OVER (PARTITION BY f.chat_id) + ROW_NUMBER() OVER (PARTITION BY f.chat_id ORDER BY f.n)
+        FROM fresh f
+        LEFT JOIN reserved r ON r.chat_id = f.chat_id
+        ORDER BY f.n
+        RETURNING id, sender_id, idempotency_key, created_at
+    ''', [(n, *row) for n, row in enumerate(rows)],
+        template='(%s, %s::int, %s::int, %s::text, %s::varchar, %s::text, %s::int, %s::varchar)',
+        page_size=len(rows), fetch=True)
+    inserted = cur.records(inserted)
+    
+    by_key = {(r['sender_id'], r['idempotency_key']): r for r in inserted if r['idempotency_key'] is not None}
+    without_key = iter([r for r in inserted if r['idempotency_key'] is None])
+    
+    missing = {(r[1], r[6]) for r in rows if r[6] is not None and (r[1], r[6]) not in by_key}
+    existing = {}
+    if missing:
+        cur.execute(f'''
+            SELECT message_id AS id, sender_id, idempotency_key, created_at
+            FROM {schema}.message_idempotency_keys
+            WHERE (sender_id, idempotency_key) IN %s
+        ''', (tuple(missing),))
+        existing = {(r['sender_id'], r['idempotency_key']): r for r in cur.records()}
+    
+    results = []
+    seen = set()
+    for row in rows:
+        key = (row[1], row[6])
+        if row[6] is None:
+            saved, duplicate = next(without_key), False
+        elif key in by_key:
+            saved, duplicate = by_key[key], key in seen
+        else:
+            saved, duplicate = existing[key], True
+        seen.add(key)
+        results.append({
+            'id': saved['id'],
+            'created_at': saved['created_at'],
+            'idempotency_key': row[6],
+            'duplicate': duplicate
+        })
+    return results
+
+UPDATES_TOKEN_SQL = 'SELECT txid_current_snapshot()::text'
+
+def updates_snapshot(schema: str, user_id: int, cursor: str) -> tuple:
+    '''(токен, чаты пользователя, события сообщений новее cursor) одним соединением из пула.
+
+    Токен — снимок транзакций (txid_current_snapshot), а не id сообщения:
+    транзакция с меньшим id, закоммиченная позже, была невидима в снимке
+    клиента, поэтому её chat_stats.changed_xid (V0013) попадёт в следующий
+    ответ. Снимок берётся до выборки: изменение между ними придёт ещё раз, но
+    не потеряется.
+    '''
+    pool = get_pool()
+    with phase('connect'):
+        conn = pool.getconn()
+    cur = conn.cursor(cursor_factory=TupleCursor)
+    try:
+        cur.execute(UPDATES_TOKEN_SQL)
+        token = cur.fetchone()[0]
+        cur.execute(f'''
+            SELECT cm.chat_id, s.last_message_id, COALESCE(s.message_count, 0) as message_count,
+                   s.changed_xid IS NOT NULL AND (
+                       %(cursor)s::txid_snapshot IS NULL
+                       OR NOT txid_visible_in_snapshot(s.changed_xid, %(cursor)s::txid_snapshot)
+                   )
+            FROM {schema}.chat_members cm
+            LEFT JOIN {schema}.chat_stats s ON s.chat_id = cm.chat_id
+            WHERE cm.user_id = %(user_id)s
+        ''', {'user_id': user_id, 'cursor': cursor})
+        chats = cur.fetchall()
+        store.flush(conn, schema)
+    finally:
+        cur.close()
+        pool.putconn(conn)
+    # Кортежи (chat_id, last_message_id, message_count, changed): события только по изменившимся чатам
+    events = [
+        {'type': 'message', 'chat_id': chat_id, 'last_message_id': last_id, 'message_count': count}
+        for chat_id, last_id, count, changed in chats if changed and last_id
+    ]
+    return token, [chat_id for chat_id, _, _, _ in chats], events
+
+def wait_for_updates(params: dict, schema: str) -> dict:
+    '''Long-poll: события по чатам пользователя, изменившимся после cursor (токена из прошлого ответа).
+
+    Соединение из пула берётся только на снимок и отдаётся до ожидания; будит
+    клиента общий для процесса LISTEN speaky_events. После пробуждения
+    сообщения перечитываются из chat_stats вместе с новым токеном, а не
+    берутся из уведомлений: токен покрывает ровно то, что отдано клиенту.
+    '''
+    user_id = int(params.get('user_id'))
+    cursor = params.get('cursor') or None
+    timeout = min(float(params.get('timeout') or UPDATES_MAX_WAIT), UPDATES_MAX_WAIT)
+    
+    # Ожидание обновлений и есть пульс присутствия: отдельный heartbeat клиенту не нужен
+    store.touch(user_id)
+    hub = get_hub()
+    hub.ensure_started()
+    sub = hub.subscribe(user_id)
+    try:
+        token, chat_ids, events = updates_snapshot(schema, user_id, cursor)
+        hub.watch(sub, chat_ids)
+        resync = False
+        # Без cursor клиент только узнаёт текущий токен; ждём, если новых сообщений нет
+        if cursor and not events:
+            woken, resync = hub.wait(sub, timeout)
+            events = [e for e in woken if e['type'] != 'message']
+            if len(events) < len(woken):
+                token, _, messages = updates_snapshot(schema, user_id, cursor)
+                events += messages
+    finally:
+        hub.unsubscribe(sub)
+    
+    return response(200, {'events': events, 'cursor': token, 'resync': resync})
+
+def error_response(error: Exception) -> dict:
+    '''Исключение обработчика -> ответ: неверный ввод клиента — 400, остальное — 500 с записью в профиль'''
+    if isinstance(error, (ValueError, TypeError, psycopg2.DataError)):
+        return response(400, {'error': str(error)})
+    record_error(error)
+    return response(500, {'error': str(error)})
+
+@profiled('chats')
 def handler(event: dict, context) -> dict:
     '''API для управления чатами, группами и каналами'''
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return preflight('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, If-None-Match')
     
-    dsn = os.environ.get('DATABASE_URL')
     schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
     
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    if method == 'GET' and (event.get('queryStringParameters') or {}).get('action') == 'updates':
+        try:
+            return wait_for_updates(event['queryStringParameters'], schema)
+        except Exception as e:
+            return error_response(e)
+    
+    ensure_listener()
+    pool = get_pool()
+    with phase('connect'):
+        conn = pool.getconn()
+    cur = conn.cursor(cursor_factory=TupleCursor)
     
     try:
         if method == 'GET':
@@ -37,40 +327,174 @@ def handler(event: dict, context) -> dict:
             user_id = event.get('queryStringParameters', {}).get('user_id', '')
             
             if action == 'list':
-                # Получить все чаты пользователя
-                cur.execute(f'''
-                    SELECT c.*, cm.role,
-                           (SELECT COUNT(*) FROM {schema}.messages WHERE chat_id = c.id) as message_count
-                    FROM {schema}.chats c
-                    JOIN {schema}.chat_members cm ON c.id = cm.chat_id
-                    WHERE cm.user_id = %s
-                    ORDER BY c.created_at DESC
-                ''', (user_id,))
-                chats = cur.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps([dict(chat) for chat in chats], default=json_serial),
-                    'isBase64Encoded': False
-                }
+                # Чаты пользователя; счётчики берутся из chat_stats, а не из messages.
+                # since=<sync_token> — только изменения; limit/cursor — keyset-страницы; без них — весь список массивом.
+                params = event.get('queryStringParameters', {})
+                
+                if params.get('since'):
+                    return response(200, list_changes(cur, schema, user_id, int(params['since'])))
+                
+                # Неизменившийся список отдаётся 304 до выборки строк и сериализации
+                etag = list_etag(cur, schema, user_id, params)
+                headers = list_headers(etag)
+                if not_modified(event, etag):
+                    return raw_response(304, '', headers)
+                
+                if not params.get('limit') and not params.get('cursor'):
+                    sort_key = LIST_ORDERS.get(params.get('order', ''), LIST_ORDERS['created'])
+                    return raw_response(200, stream_list(conn, list_sql(schema, sort_key), {'user_id': user_id}), headers)
+                
+                query, values, limit = list_page_query(schema, user_id, params)
+                token = {}
+                if not params.get('cursor'):
+                    # Токен первой страницы: после обхода всех страниц клиент досинхронизируется с since
+                    token['sync_token'] = sync_token(cur)
+                cur.execute(query, values)
+                
+                return response(200, list_page(cur.records(), limit, params.get('order', ''), token), headers)
             
             elif action == 'members':
                 chat_id = event.get('queryStringParameters', {}).get('chat_id', '')
+                members = members_cache.get(int(chat_id))
+                if members is MISSING:
+                    cur.execute(members_sql(schema), (chat_id,))
+                    members = [with_thumb(m) for m in cur.records()]
+                    members_cache.set(int(chat_id), members)
+                
+                return response(200, members)
+            
+            elif action == 'cache_stats':
+                return response(200, {**snapshot(), 'presence': store.stats()})
+            
+            elif action == 'receipts':
+                # Кто прочитал сообщение: участники с водяным знаком не ниже message_id
+                params = event.get('queryStringParameters', {})
+                return response(200, receipts(cur, schema, int(params['chat_id']), int(params['message_id'])))
+            
+            elif action == 'presence':
+                # Присутствие пачки id (участники, друзья) и кто сейчас печатает в chat_id
+                params = event.get('queryStringParameters', {})
+                try:
+                    user_ids = parse_ids(params.get('user_ids'))
+                except ValueError as e:
+                    return response(400, {'error': str(e)})
+                
+                result = {'presence': lookup(cur, schema, user_ids)}
+                if params.get('chat_id'):
+                    # События typing с других инстансов приходят через общий LISTEN
+                    get_hub().ensure_started()
+                    result['typing'] = store.typing(int(params['chat_id']))
+                return response(200, result)
+            
+            elif action == 'search':
+                # Полнотекстовый поиск только по чатам, где пользователь состоит; keyset по (created_at, id)
+                params = event.get('queryStringParameters', {})
+                limit = min(int(params.get('limit') or SEARCH_DEFAULT_LIMIT), SEARCH_MAX_LIMIT)
+                query = {'user_id': user_id, 'q': params.get('q', ''), 'limit': limit + 1}
+                filters = ''
+                if params.get('chat_id'):
+                    query['chat_id'] = params['chat_id']
+                    filters += ' AND m.chat_id = %(chat_id)s'
+                if params.get('before'):
+                    query['before_at'], query['before_id'] = decode_cursor(params['before'])
+                    # Отдельное условие на created_at отсекает более новые секции ещё при планировании
+                    filters += ' AND m.created_at <= %(before_at)s AND (m.created_at, m.id) < (%(before_at)s, %(before_id)s)'
+                
+                # ts_headline дорогой, поэтому считается только для строк страницы
                 cur.execute(f'''
-                    SELECT u.id, u.nickname, u.username, u.avatar_url, u.verified, cm.role
-                    FROM {schema}.users u
-                    JOIN {schema}.chat_members cm ON u.id = cm.user_id
-                    WHERE cm.chat_id = %s
-                ''', (chat_id,))
-                members = cur.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps([dict(m) for m in members], default=json_serial),
-                    'isBase64Encoded': False
-                }
+                    WITH q AS (
+                        SELECT websearch_to_tsquery('russian', %(q)s) || websearch_to_tsquery('english', %(q)s) AS query
+                    ),
+                    page AS (
+                        SELECT m.id, m.chat_id, m.sender_id, m.message_text, m.media_type, m.created_at
+                        FROM {schema}.messages m, q
+                        WHERE m.search_vector @@ q.query
+                          AND m.chat_id IN (SELECT chat_id FROM {schema}.chat_members WHERE user_id = %(user_id)s)
+                          {filters}
+                        ORDER BY m.created_at DESC, m.id DESC
+                        LIMIT %(limit)s
+                    )
+                    SELECT page.id, page.chat_id, page.sender_id, page.media_type, page.created_at,
+                           ts_headline(
+                               COALESCE((SELECT CASE WHEN language = 'en' THEN 'english' ELSE 'russian' END::regconfig
+                                         FROM {schema}.users WHERE id = %(user_id)s), 'russian'::regconfig),
+                               page.message_text, q.query,
+                               'StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=20, MinWords=5'
+                           ) as highlight
+                    FROM page, q
+                    ORDER BY page.created_at DESC, page.id DESC
+                ''', query)
+                rows = cur.records()
+                results = rows[:limit]
+                has_more = len(rows) > limit
+                
+                return response(200, {
+                    'results': results,
+                    'next_cursor': encode_cursor(results[-1]['created_at'], results[-1]['id']) if has_more else None
+                })
+            
+            elif action == 'history':
+                # Keyset-пагинация по (created_at, id): без OFFSET, стоимость страницы не зависит от глубины.
+                # Условие на created_at рядом с парой отсекает лишние месячные секции при планировании;
+                # когда онлайн-сообщения чата кончаются, страница дочитывается из архива (partitions.py).
+                params = event.get('queryStringParameters', {})
+                chat_id = params.get('chat_id', '')
+                before = params.get('before')
+                after = params.get('after')
+                limit = min(int(params.get('limit') or HISTORY_DEFAULT_LIMIT), HISTORY_MAX_LIMIT)
+                
+                columns = 'id, chat_id, sender_id, message_text, media_type, media_url, reply_to, created_at'
+                if after:
+                    after_at, after_id = decode_cursor(after)
+                    rows = []
+                    horizon = archive_horizon(cur, schema)
+                    if horizon and after_at < horizon:
+                        rows = archived_history(cur, schema, int(chat_id), limit + 1, after=(after_at, after_id))
+                    if len(rows) <= limit:
+                        cur.execute(f'''
+                            SELECT {columns}
+                            FROM {schema}.messages
+                            WHERE chat_id = %s AND created_at >= %s AND (created_at, id) > (%s, %s)
+                            ORDER BY created_at, id
+                            LIMIT %s
+                        ''', (chat_id, after_at, after_at, after_id, limit + 1 - len(rows)))
+                        rows += cur.records()
+                    has_more = len(rows) > limit
+                    messages = rows[:limit]
+                else:
+                    if before:
+                        before_at, before_id = decode_cursor(before)
+                        cur.execute(f'''
+                            SELECT {columns}
+                            FROM {schema}.messages
+                            WHERE chat_id = %s AND created_at <= %s AND (created_at, id) < (%s, %s)
+                            ORDER BY created_at DESC, id DESC
+                            LIMIT %s
+                        ''', (chat_id, before_at, before_at, before_id, limit + 1))
+                    else:
+                        cur.execute(f'''
+                            SELECT {columns}
+                            FROM {schema}.messages
+                            WHERE chat_id = %s
+                            ORDER BY created_at DESC, id DESC
+                            LIMIT %s
+                        ''', (chat_id, limit + 1))
+                    rows = cur.records()
+                    if len(rows) <= limit and archive_horizon(cur, schema):
+                        oldest = (rows[-1]['created_at'], rows[-1]['id']) if rows else (decode_cursor(before) if before else None)
+                        rows += archived_history(cur, schema, int(chat_id), limit + 1 - len(rows), before=oldest)
+                    has_more = len(rows) > limit
+                    messages = rows[:limit][::-1]
+                
+                first = messages[0] if messages else None
+                last = messages[-1] if messages else None
+                
+                return response(200, {
+                    'messages': messages,
+                    'has_more': has_more,
+                    'before_cursor': encode_cursor(first['created_at'], first['id']) if first else before,
+                    'after_cursor': encode_cursor(last['created_at'], last['id']) if last else after
+                })
         
         elif method == 'POST':
             data = json.loads(event.get('body', '{}'))
@@ -88,7 +512,7 @@ def handler(event: dict, context) -> dict:
                     VALUES (%s, %s, %s, %s)
                     RETURNING id, type, name, avatar_url, created_by, created_at
                 ''', (chat_type, name, avatar_url, user_id))
-                chat = cur.fetchone()
+                chat = cur.record()
                 
                 # Добавить создателя как админа
                 cur.execute(f'''
@@ -98,12 +522,71 @@ def handler(event: dict, context) -> dict:
                 
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'chat': dict(chat)}, default=json_serial),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True, 'chat': chat})
+            
+            elif action == 'send':
+                ensure_partitions(conn, schema)
+                message = insert_messages(cur, schema, [data])[0]
+                mark_sent(cur, schema, [(data.get('chat_id'), data.get('user_id'), message['id'])])
+                conn.commit()
+                # Отправленное сообщение заканчивает набор текста
+                store.touch(int(data['user_id']))
+                store.set_typing(int(data['chat_id']), int(data['user_id']), False)
+                store.flush(conn, schema)
+                
+                return response(200, {'success': True, 'message': message})
+            
+            elif action == 'mark_read':
+                # Прочитано до message_id: одна отметка или marks=[{chat_id, message_id}] по нескольким чатам.
+                # Все отметки запроса пишутся одним UPDATE до ответа.
+                user_id = int(data['user_id'])
+                marks = data.get('marks') or [{'chat_id': data.get('chat_id'), 'message_id': data.get('message_id')}]
+                if len(marks) > MARKS_REQUEST_MAX:
+                    return response(400, {'error': f'marks must contain at most {MARKS_REQUEST_MAX} items'})
+                
+                marks = latest_marks(user_id, [(int(m['chat_id']), int(m['message_id'])) for m in marks])
+                rows = apply_marks(cur, schema, marks)
+                conn.commit()
+                
+                chats = [{key: row[key] for key in ('chat_id', 'last_read_message_id', 'unread_count')} for row in rows]
+                return response(200, {'success': True, 'chats': chats})
+            
+            elif action == 'heartbeat':
+                store.touch(int(data['user_id']))
+                store.flush(conn, schema)
+                
+                return response(200, {'success': True})
+            
+            elif action == 'typing':
+                # Публикуется только начало, продление раз в полTTL и остановка, а не каждое нажатие
+                user_id, chat_id = int(data['user_id']), int(data['chat_id'])
+                typing = data.get('typing', True) is not False
+                store.touch(user_id)
+                if store.set_typing(chat_id, user_id, typing):
+                    cur.execute('SELECT pg_notify(%s, %s)', (get_hub().channel, dumps({
+                        'type': 'typing', 'chat_id': chat_id, 'user_id': user_id, 'typing': typing
+                    })))
+                    conn.commit()
+                store.flush(conn, schema)
+                
+                return response(200, {'success': True})
+            
+            elif action == 'send_batch':
+                # Пачка от бота или рассылки канала: одна транзакция, один INSERT
+                items = data.get('messages') or []
+                if not items or len(items) > SEND_BATCH_MAX:
+                    return response(400, {'error': f'messages must contain 1..{SEND_BATCH_MAX} items'})
+                
+                defaults = {'chat_id': data.get('chat_id'), 'user_id': data.get('user_id')}
+                ensure_partitions(conn, schema)
+                items = [{**defaults, **item} for item in items]
+                messages = insert_messages(cur, schema, items)
+                mark_sent(cur, schema, [
+                    (item.get('chat_id'), item.get('user_id'), message['id']) for item, message in zip(items, messages)
+                ])
+                conn.commit()
+                
+                return response(200, {'success': True, 'messages': messages})
             
             elif action == 'add_member':
                 chat_id = data.get('chat_id')
@@ -114,14 +597,56 @@ def handler(event: dict, context) -> dict:
                     INSERT INTO {schema}.chat_members (chat_id, user_id, role)
                     VALUES (%s, %s, %s)
                 ''', (chat_id, user_id, role))
-                conn.commit()
+                publish_invalidation(cur, 'members', chat_id)
+                commit(conn)
+                
+                return response(200, {'success': True})
+            
+            elif action == 'add_members':
+                # Импорт подписчиков: список user_ids или копия состава source_chat_id, пачками по транзакции
+                chat_id = data.get('chat_id')
+                role = data.get('role', 'member')
+                source_chat_id = data.get('source_chat_id')
+                cursor = int(data.get('cursor') or 0)
+                
+                if source_chat_id:
+                    batches = copy_batches(cur, schema, source_chat_id, cursor)
+                    total = None
+                else:
+                    user_ids = [int(user_id) for user_id in data.get('user_ids') or []]
+                    if not user_ids or len(user_ids) > MEMBERS_REQUEST_MAX:
+                        return response(400, {'error': f'user_ids must contain 1..{MEMBERS_REQUEST_MAX} items'})
+                    batches = list_batches(user_ids, cursor)
+                    total = len(user_ids)
+                
+                progress = apply_in_batches(
+                    conn, cur, schema, chat_id,
+                    lambda cur, ids: add_members(cur, schema, chat_id, ids, role), batches
+                )
+                
+                return response(200, {'success': True, 'added': progress.pop('changed'), 'total': total, **progress})
+        
+        elif method == 'PUT':
+            # Обслуживание секций messages: только для администраторов
+            data = json.loads(event.get('body', '{}'))
+            action = data.get('action', '')
+            cur.execute(f'SELECT is_admin FROM {schema}.users WHERE id = %s', (data.get('admin_id'),))
+            admin = cur.fetchone()
+            
+            if not admin or not admin[0]:
+                return response(403, {'error': 'Admin access required'})
+            
+            if action == 'maintain_partitions':
+                # Секции на будущие месяцы и перенос legacy по месяцу за транзакцию; повторять, пока legacy=true
+                return response(200, {'success': True, **maintain(conn, cur, schema)})
+            
+            elif action == 'archive_messages':
+                # Архивирование требует разобранной legacy: иначе архив не был бы старше всего онлайн
+                if legacy_exists(cur, schema):
+                    return response(409, {'error': 'messages_legacy is not split yet, run maintain_partitions'})
+                keep_months = int(data.get('keep_months') or ARCHIVE_KEEP_MONTHS)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True, **archive_cold(conn, cur, schema, keep_months)})
         
         elif method == 'DELETE':
             data = json.loads(event.get('body', '{}'))
@@ -135,22 +660,38 @@ def handler(event: dict, context) -> dict:
                     DELETE FROM {schema}.chat_members
                     WHERE chat_id = %s AND user_id = %s
                 ''', (chat_id, user_id))
-                conn.commit()
+                publish_invalidation(cur, 'members', chat_id)
+                commit(conn)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True})
+            
+            elif action == 'remove_members':
+                chat_id = data.get('chat_id')
+                user_ids = [int(user_id) for user_id in data.get('user_ids') or []]
+                if not user_ids or len(user_ids) > MEMBERS_REQUEST_MAX:
+                    return response(400, {'error': f'user_ids must contain 1..{MEMBERS_REQUEST_MAX} items'})
+                
+                progress = apply_in_batches(
+                    conn, cur, schema, chat_id,
+                    lambda cur, ids: remove_members(cur, schema, chat_id, ids),
+                    list_batches(user_ids, int(data.get('cursor') or 0))
+                )
+                
+                return response(200, {'success': True, 'removed': progress.pop('changed'), 'total': len(user_ids), **progress})
         
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'}),
-            'isBase64Encoded': False
-        }
+        return response(400, {'error': 'Invalid action'})
     
+    except Exception as e:
+        conn.rollback()
+        return error_response(e)
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        pool.putconn(conn)
+
+# Синхронный handler под своим именем: aio.py отдаёт ему действия без асинхронной версии
+sync_handler = handler
+
+# HANDLER_MODE=async: точкой входа становится асинхронный handler из aio.py
+if os.environ.get('HANDLER_MODE') == 'async':
+    import aio
+    handler = aio.handler
@@ -0,0 +1,87 @@
+'''Массовое изменение состава чата: списки user_id и копирование из другого чата.
+
+Каждая пачка — один оператор над массивом id и одна транзакция, поэтому импорт
+канала на 50k подписчиков — это десятки коммитов, а не 50k. Прогресс
+фиксируется после каждой пачки: при обрыве повтор с next_cursor продолжает
+с места остановки, а ON CONFLICT пропускает уже добавленных.
+'''
+import os
+import time
+
+from cache import commit, publish_invalidation
+
+MEMBERS_BATCH_SIZE = int(os.environ.get('MEMBERS_BATCH_SIZE', '1000'))
+MEMBERS_REQUEST_MAX = 100_000
+# Запас до таймаута функции: дальше отдаём next_cursor и клиент продолжает новым вызовом
+MEMBERS_TIME_BUDGET = float(os.environ.get('MEMBERS_TIME_BUDGET', '20'))
+
+
+def add_members(cur, schema: str, chat_id: int, user_ids: list, role: str = 'member') -> int:
+    '''Добавляет пачку участников одним INSERT ... SELECT; несуществующие id и уже состоящие пропускаются'''
+    cur.execute(f'''
+        INSERT INTO {schema}.chat_members (chat_id, user_id, role)
+        SELECT %s, u.id, %s
+        FROM {schema}.users u
+        WHERE u.id = ANY(%s::int[])
+        ON CONFLICT (chat_id, user_id) DO NOTHING
+    ''', (chat_id, role, user_ids))
+    return cur.rowcount
+
+
+def remove_members(cur, schema: str, chat_id: int, user_ids: list) -> int:
+    cur.execute(f'''
+        DELETE FROM {schema}.chat_members
+        WHERE chat_id = %s AND user_id = ANY(%s::int[])
+    ''', (chat_id, user_ids))
+    return cur.rowcount
+
+
+def source_batch(cur, schema: str, source_chat_id: int, after_user_id: int, limit: int) -> list:
+    '''Следующие участники исходного чата по возрастанию user_id (идёт по UNIQUE(chat_id, user_id))'''
+    cur.execute(f'''
+        SELECT user_id FROM {schema}.chat_members
+        WHERE chat_id = %s AND user_id > %s
+        ORDER BY user_id
+        LIMIT %s
+    ''', (source_chat_id, after_user_id, limit))
+    return [user_id for user_id, in cur.fetchall()]
+
+
+def apply_in_batches(conn, cur, schema: str, chat_id: int, apply, batches) -> dict:
+    '''Применяет apply(cur, ids) к каждой пачке из batches в отдельной транзакции.
+
+    batches выдаёт пары (ids, cursor после пачки). Останавливается по
+    исчерпании пачек или MEMBERS_TIME_BUDGET и возвращает прогресс.
+    '''
+    started = time.monotonic()
+    progress = {'processed': 0, 'changed': 0, 'batches': 0, 'next_cursor': None, 'done': True}
+    for ids, cursor in batches:
+        progress['changed'] += apply(cur, ids)
+        publish_invalidation(cur, 'members', chat_id)
+        commit(conn)
+        progress['processed'] += len(ids)
+        progress['batches'] += 1
+        progress['next_cursor'] = cursor
+        if time.monotonic() - started > MEMBERS_TIME_BUDGET:
+            progress['done'] = False
+            break
+    if progress['done']:
+        progress['next_cursor'] = None
+    return progress
+
+
+def list_batches(user_ids: list, offset: int):
+    '''Пачки из переданного списка; курсор — смещение в списке'''
+    for start in range(offset, len(user_ids), MEMBERS_BATCH_SIZE):
+        end = min(start + MEMBERS_BATCH_SIZE, len(user_ids))
+        yield user_ids[start:end], end
+
+
+def copy_batches(cur, schema: str, source_chat_id: int, after_user_id: int):
+    '''Пачки участников исходного чата; курсор — последний обработанный user_id'''
+    while True:
+        ids = source_batch(cur, schema, source_chat_id, after_user_id, MEMBERS_BATCH_SIZE)
+        if not ids:
+            return
+        after_user_id = ids[-1]
+        yield ids, after_user_id
@@ -0,0 +1,281 @@
+'''Помесячные секции messages (V0012): обслуживание, архив холодных месяцев в S3 и чтение истории из архива.
+
+Секции на следующие месяцы создаёт messages_ensure_partitions(): отправка
+сообщений вызывает её раз в сутки на процесс, так что секция нового месяца
+готова заранее. Старая куча messages_legacy разбирается на помесячные секции
+по месяцу за транзакцию (messages_split_legacy) — PUT maintain_partitions.
+
+Архив (PUT archive_messages): месяц старше ARCHIVE_KEEP_MONTHS выгружается в
+бакет upload как gzip NDJSON по объекту на чат
+(archive/messages/<YYYY-MM>/<chat_id>.ndjson.gz) из снимка без блокировки
+записи. Затем секция коротко блокируется: если с момента снимка она не
+менялась, месяц записывается в каталог message_archive_chats, а секция
+отключается и удаляется; иначе выгрузка повторится следующим вызовом. Архивируются
+только самые старые месяцы и только после разбора legacy, поэтому всё в архиве
+старше всего, что лежит в БД: history дочитывает архив, когда онлайн-сообщения
+чата кончились, и клиент границы не видит. Поиск по архиву не работает.
+'''
+import gzip
+import itertools
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import boto3
+import psycopg2.extras
+from botocore.config import Config
+
+from cache import MISSING, TTLCache
+from runtime import dumps
+
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'files')
+ARCHIVE_PREFIX = 'archive/messages'
+ARCHIVE_KEEP_MONTHS = int(os.environ.get('ARCHIVE_KEEP_MONTHS', '12'))
+ARCHIVE_FETCH_SIZE = 5000
+ARCHIVE_UPLOAD_WORKERS = int(os.environ.get('ARCHIVE_UPLOAD_WORKERS', '8'))
+PARTITIONS_AHEAD = int(os.environ.get('PARTITIONS_AHEAD', '2'))
+# Как у массового добавления участников: дальше клиент повторяет вызов
+PARTITIONS_TIME_BUDGET = float(os.environ.get('PARTITIONS_TIME_BUDGET', '20'))
+
+ARCHIVE_FIELDS = ('id', 'chat_id', 'sender_id', 'message_text', 'media_type', 'media_url', 'reply_to',
+                  'created_at', 'idempotency_key')
+HISTORY_FIELDS = ARCHIVE_FIELDS[:-1]
+
+# Объекты архива неизменяемы. Границу архива не кешируем: после archive_month
+# на другом инстансе устаревшая граница отдала бы пустые страницы вместо архива
+archive_cache = TTLCache(
+    'archive',
+    max_size=int(os.environ.get('ARCHIVE_CACHE_SIZE', '256')),
+    ttl=float(os.environ.get('ARCHIVE_CACHE_TTL', '3600'))
+)
+
+_s3 = None
+_ensured_on = None
+
+
+def s3_client():
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.client('s3',
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(max_pool_connections=ARCHIVE_UPLOAD_WORKERS, retries={'max_attempts': 3, 'mode': 'standard'})
+        )
+    return _s3
+
+
+def partition_name(month: date) -> str:
+    return f'messages_p{month:%Y%m}'
+
+
+def object_key(month: date, chat_id) -> str:
+    return f'{ARCHIVE_PREFIX}/{month:%Y-%m}/{"orphans" if chat_id is None else chat_id}.ndjson.gz'
+
+
+def ensure_partitions(conn, schema: str):
+    '''Секции на текущий и PARTITIONS_AHEAD следующих месяцев; в БД ходит раз в сутки на процесс'''
+    global _ensured_on
+    if _ensured_on == date.today():
+        return
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT {schema}.messages_ensure_partitions(%s)', (PARTITIONS_AHEAD,))
+    conn.commit()
+    _ensured_on = date.today()
+
+
+def legacy_exists(cur, schema: str) -> bool:
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL', (f'{schema}.messages_legacy',))
+    return cur.fetchone()[0]
+
+
+def maintain(conn, cur, schema: str) -> dict:
+    '''Создаёт недостающие секции и переносит месяцы из legacy, пока хватает PARTITIONS_TIME_BUDGET'''
+    started = time.monotonic()
+    cur.execute(f'SELECT {schema}.messages_ensure_partitions(%s)', (PARTITIONS_AHEAD,))
+    created = cur.fetchone()[0]
+    conn.commit()
+
+    split = []
+    while time.monotonic() - started < PARTITIONS_TIME_BUDGET:
+        cur.execute(f'SELECT {schema}.messages_split_legacy()')
+        name = cur.fetchone()[0]
+        conn.commit()
+        if name is None:
+            break
+        split.append(name)
+
+    legacy = legacy_exists(cur, schema)
+    conn.commit()
+    return {'created': created, 'split': split, 'legacy': legacy}
+
+
+def archive_candidates(cur, schema: str, keep_months: int) -> list:
+    '''Месяцы секций старше keep_months полных месяцев, от старых к новым'''
+    today = date.today()
+    index = today.year * 12 + today.month - 1 - keep_months
+    cutoff = date(index // 12, index % 12 + 1, 1)
+    cur.execute('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass AND c.relname ~ '^messages_p[0-9]{6}$'
+        ORDER BY c.relname
+    ''', (f'{schema}.messages',))
+    months = [datetime.strptime(name[len('messages_p'):], '%Y%m').date() for name, in cur.fetchall()]
+    return [month for month in months if month < cutoff]
+
+
+def _encode(rows: list) -> bytes:
+    lines = [dumps(dict(zip(ARCHIVE_FIELDS, row))) for row in rows]
+    return gzip.compress(('\n'.join(lines) + '\n').encode())
+
+
+def _upload(key: str, rows: list):
+    s3_client().put_object(Bucket=S3_BUCKET, Key=key, Body=_encode(rows), ContentType='application/x-ndjson')
+
+
+def partition_digest(cur, schema: str, name: str) -> tuple:
+    '''(число строк, сумма хешей строк) секции: меняется при любой вставке, правке или удалении'''
+    cur.execute(f'''
+        SELECT COUNT(*), COALESCE(SUM(hashtext(m::text)::bigint), 0) FROM {schema}.{name} m
+    ''')
+    return cur.fetchone()
+
+
+def upload_month(conn, schema: str, name: str, month: date) -> tuple:
+    '''Выгружает секцию в S3 из текущего снимка; возвращает (строки каталога, всего сообщений)'''
+    chats = []
+    total = 0
+    with ThreadPoolExecutor(ARCHIVE_UPLOAD_WORKERS) as uploads, conn.cursor(f'archive_{name}') as rows:
+        # Серверный курсор и ограниченная очередь загрузок: в памяти только несколько чатов, а не весь месяц
+        rows.itersize = ARCHIVE_FETCH_SIZE
+        rows.execute(f'''
+            SELECT {", ".join(ARCHIVE_FIELDS)}
+            FROM {schema}.{name}
+            ORDER BY chat_id, created_at, id
+        ''')
+        pending = deque()
+        for chat_id, group in itertools.groupby(rows, key=lambda row: row[1]):
+            group = list(group)
+            key = object_key(month, chat_id)
+            pending.append(uploads.submit(_upload, key, group))
+            if len(pending) >= 2 * ARCHIVE_UPLOAD_WORKERS:
+                pending.popleft().result()
+            total += len(group)
+            if chat_id is not None:
+                chats.append((chat_id, month, key, len(group), group[0][7], group[-1][7]))
+        for upload in pending:
+            upload.result()
+    return chats, total
+
+
+def archive_month(conn, cur, schema: str, month: date) -> dict:
+    '''Выгружает секцию месяца в S3, затем под короткой блокировкой пишет каталог и удаляет секцию.
+
+    Выгрузка идёт в снимке REPEATABLE READ и запись в секцию не блокирует.
+    Блокировка SHARE берётся только на сверку с дайджестом снимка, каталог и
+    DETACH. Если секция успела измениться, транзакция откатывается и месяц
+    остаётся в БД; загруженные объекты перезапишет следующая попытка.
+    '''
+    name = partition_name(month)
+    cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+    digest = partition_digest(cur, schema, name)
+    chats, total = upload_month(conn, schema, name, month)
+    conn.commit()
+
+    cur.execute(f'LOCK TABLE {schema}.{name} IN SHARE MODE')
+    if partition_digest(cur, schema, name) != digest:
+        conn.rollback()
+        return {'month': f'{month:%Y-%m}', 'changed': True}
+
+    cur.execute(f'''
+        INSERT INTO {schema}.message_archives (month, message_count, chat_count) VALUES (%s, %s, %s)
+    ''', (month, total, len(chats)))
+    psycopg2.extras.execute_values(cur, f'''
+        INSERT INTO {schema}.message_archive_chats (chat_id, month, object_key, message_count, first_at, last_at)
+        VALUES %s
+    ''', chats, page_size=1000)
+    # Повтор отправки годичной давности не ожидается: ключи идемпотентности уходят вместе с месяцем
+    cur.execute(f'''
+        DELETE FROM {schema}.message_idempotency_keys
+        WHERE created_at < %s::date + INTERVAL '1 month'
+    ''', (month,))
+    cur.execute(f'ALTER TABLE {schema}.messages DETACH PARTITION {schema}.{name}')
+    cur.execute(f'DROP TABLE {schema}.{name}')
+    conn.commit()
+    return {'month': f'{month:%Y-%m}', 'messages': total, 'chats': len(chats)}
+
+
+def archive_cold(conn, cur, schema: str, keep_months: int) -> dict:
+    '''Архивирует месяцы старше keep_months, пока хватает PARTITIONS_TIME_BUDGET'''
+    started = time.monotonic()
+    candidates = archive_candidates(cur, schema, keep_months)
+    conn.commit()
+    archived = []
+    for month in candidates:
+        if time.monotonic() - started > PARTITIONS_TIME_BUDGET:
+            break
+        result = archive_month(conn, cur, schema, month)
+        archived.append(result)
+        if result.get('changed'):
+            # Более новые месяцы не архивируются раньше этого: архив всегда старше всего в БД
+            break
+    done = len(archived) == len(candidates) and not any(result.get('changed') for result in archived)
+    return {'archived': archived, 'done': done}
+
+
+def archive_horizon(cur, schema: str):
+    '''Конец последнего архивного месяца (None — архива нет): раньше него сообщения только в архиве.
+
+    Читается на каждый запрос истории (одна строка каталога), чтобы граница
+    совпадала с удалёнными секциями на всех инстансах сразу.
+    '''
+    cur.execute(f"SELECT MAX(month) + INTERVAL '1 month' FROM {schema}.message_archives")
+    return cur.fetchone()[0]
+
+
+def load_archive(key: str) -> list:
+    '''Сообщения объекта архива по возрастанию (created_at, id)'''
+    messages = archive_cache.get(key)
+    if messages is MISSING:
+        body = s3_client().get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()
+        messages = []
+        for line in gzip.decompress(body).splitlines():
+            record = json.loads(line)
+            record['created_at'] = datetime.fromisoformat(record['created_at'])
+            messages.append({field: record.get(field) for field in HISTORY_FIELDS})
+        archive_cache.set(key, messages)
+    return messages
+
+
+def archived_history(cur, schema: str, chat_id: int, limit: int, before: tuple = None, after: tuple = None) -> list:
+    '''До limit архивных сообщений чата: старше before (новые первыми) или новее after (старые первыми)'''
+    if after:
+        cur.execute(f'''
+            SELECT object_key FROM {schema}.message_archive_chats
+            WHERE chat_id = %s AND last_at >= %s
+            ORDER BY month
+        ''', (chat_id, after[0]))
+    else:
+        cur.execute(f'''
+            SELECT object_key FROM {schema}.message_archive_chats
+            WHERE chat_id = %s AND (%s::timestamp IS NULL OR first_at <= %s)
+            ORDER BY month DESC
+        ''', (chat_id, before and before[0], before and before[0]))
+    keys = [key for key, in cur.fetchall()]
+
+    result = []
+    for key in keys:
+        messages = load_archive(key)
+        if after:
+            result += [m for m in messages if (m['created_at'], m['id']) > after]
+        else:
+            result += [m for m in reversed(messages) if not before or (m['created_at'], m['id']) < before]
+        if len(result) >= limit:
+            break
+    return result[:limit]
@@ -0,0 +1,165 @@
+'''Присутствие в памяти процесса: last_seen пользователей и «печатает» в чатах с TTL.
+
+Пульс (long-poll updates, heartbeat, typing, send) пишет в словарь процесса, а
+в users.last_seen (V0015) уходит не чаще раза в PRESENCE_WRITE_GRANULARITY на
+пользователя. Пишет тот же запрос, что принёс пульс: flush() перед ответом, а
+не по таймеру — после ответа инстанс могут заморозить или выгрузить. Один
+UPDATE захватывает и то, что накопили параллельные запросы. Окно «онлайн»
+(PRESENCE_ONLINE_WINDOW) заметно больше интервала записи, поэтому другой
+инстанс, видящий только БД, ошибается лишь на границе окна. lookup()
+складывает память процесса и БД и скрывает время у тех, кто выключил
+show_online. Функции users достаточно чтения из БД: её presence.py — только
+эти помощники без PresenceStore.
+
+Набор текста живёт TYPING_TTL секунд; между инстансами его разносят события
+'typing' в speaky_events (см. realtime.py), а повторные нажатия клавиш в пределах
+половины TTL второй раз не публикуются.
+'''
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+ONLINE_WINDOW = timedelta(seconds=float(os.environ.get('PRESENCE_ONLINE_WINDOW', '60')))
+WRITE_GRANULARITY = timedelta(seconds=float(os.environ.get('PRESENCE_WRITE_GRANULARITY', '30')))
+TYPING_TTL = float(os.environ.get('TYPING_TTL', '6'))
+PRESENCE_MAX_IDS = 500
+
+NEVER = datetime.min.replace(tzinfo=timezone.utc)
+
+
+class PresenceStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = {}
+        self._written = {}
+        self._dirty = {}
+        self._typing = {}
+        self.heartbeats = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def touch(self, user_id: int, now: datetime = None):
+        '''Пульс пользователя; если прошло WRITE_GRANULARITY, его запишет flush этого же запроса'''
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            self.heartbeats += 1
+            self._seen[user_id] = now
+            if now - self._written.get(user_id, NEVER) >= WRITE_GRANULARITY:
+                self._written[user_id] = now
+                self._dirty[user_id] = now
+
+    def seen(self, user_ids: list) -> dict:
+        with self._lock:
+            return {user_id: self._seen[user_id] for user_id in user_ids if user_id in self._seen}
+
+    def set_typing(self, chat_id: int, user_id: int, typing: bool = True) -> bool:
+        '''Меняет состояние набора; True — изменение стоит опубликовать другим инстансам'''
+        now = time.monotonic()
+        with self._lock:
+            chat = self._typing.setdefault(chat_id, {})
+            expires = chat.get(user_id)
+            if not typing:
+                chat.pop(user_id, None)
+                if not chat:
+                    del self._typing[chat_id]
+                return expires is not None and expires > now
+            chat[user_id] = now + TYPING_TTL
+            return expires is None or expires - now < TYPING_TTL / 2
+
+    def typing(self, chat_id: int) -> list:
+        now = time.monotonic()
+        with self._lock:
+            chat = self._typing.get(chat_id, {})
+            for user_id in [user_id for user_id, expires in chat.items() if expires <= now]:
+                del chat[user_id]
+            if not chat:
+                self._typing.pop(chat_id, None)
+            return sorted(chat)
+
+    def flush(self, conn, schema: str) -> int:
+        '''Пишет накопленные last_seen одним UPDATE; без записей к WRITE_GRANULARITY в БД не ходит'''
+        with self._lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            self._prune()
+
+        ids = sorted(batch)
+        try:
+            with conn.cursor() as cur:
+                # Порядок id одинаков во всех инстансах: встречные пачки не взаимоблокируются
+                cur.execute(f'''
+                    UPDATE {schema}.users u SET last_seen = d.seen
+                    FROM unnest(%s::int[], %s::timestamptz[]) AS d(id, seen)
+                    WHERE u.id = d.id AND (u.last_seen IS NULL OR u.last_seen < d.seen)
+                ''', (ids, [batch[user_id] for user_id in ids]))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            with self._lock:
+                for user_id, seen in batch.items():
+                    self._dirty[user_id] = max(seen, self._dirty.get(user_id, NEVER))
+            raise
+
+        with self._lock:
+            self.flushes += 1
+            self.rows_written += len(ids)
+        return len(ids)
+
+    def _prune(self):
+        '''Забывает давно молчащих: их last_seen уже в БД (под self._lock)'''
+        horizon = datetime.now(timezone.utc) - ONLINE_WINDOW - WRITE_GRANULARITY
+        for user_id in [user_id for user_id, seen in self._seen.items() if seen < horizon]:
+            del self._seen[user_id]
+            if user_id not in self._dirty:
+                self._written.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'heartbeats': self.heartbeats,
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+                'tracked': len(self._seen),
+                'dirty': len(self._dirty),
+                'typing_chats': len(self._typing)
+            }
+
+
+store = PresenceStore()
+
+
+def parse_ids(raw: str) -> list:
+    '''user_ids=1,2,3 без повторов, не больше PRESENCE_MAX_IDS'''
+    ids = list(dict.fromkeys(int(part) for part in (raw or '').split(',') if part.strip()))
+    if len(ids) > PRESENCE_MAX_IDS:
+        raise ValueError(f'user_ids must contain at most {PRESENCE_MAX_IDS} items')
+    return ids
+
+
+def lookup_sql(schema: str) -> str:
+    return f'SELECT id, show_online, last_seen FROM {schema}.users WHERE id = ANY(%s)'
+
+
+def presence_of(rows: list, local: dict = None) -> list:
+    '''Строки (id, show_online, last_seen) из БД и пульсы процесса {id: время} -> [{id, online, last_seen}]'''
+    local = local or {}
+    now = datetime.now(timezone.utc)
+    result = []
+    for user_id, show_online, last_seen in rows:
+        if show_online is False:
+            result.append({'id': user_id, 'online': False, 'last_seen': None})
+            continue
+        last_seen = max(filter(None, (last_seen, local.get(user_id))), default=None)
+        result.append({'id': user_id, 'online': bool(last_seen and now - last_seen < ONLINE_WINDOW),
+                       'last_seen': last_seen})
+    return result
+
+
+def lookup(cur, schema: str, user_ids: list) -> list:
+    '''Присутствие пачки пользователей одним запросом: [{id, online, last_seen}]'''
+    if not user_ids:
+        return []
+    cur.execute(lookup_sql(schema), (user_ids,))
+    return presence_of(cur.fetchall(), store.seen(user_ids))
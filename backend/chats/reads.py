@@ -0,0 +1,115 @@
+'''Прочитанное (V0016): водяной знак участника.
+
+Отметка хранит last_read_message_id и read_count — message_count чата на
+момент отметки, так что непрочитанные считаются в списке чатов вычитанием.
+Отметка только растёт: повтор, устаревшая или обгоняющая последнее сообщение
+отметка ничего не пишет сверх нужного.
+
+Клиент шлёт mark_read при прокрутке, то есть часто, поэтому отметка дешёвая:
+один UPDATE по всем чатам запроса в самом запросе, без очередей в памяти
+процесса — после ответа инстанс могут заморозить. read_count берётся из
+счётчиков chat_stats и номера сообщения в чате (V0020), а не подсчётом
+сообщений после отметки.
+'''
+MARKS_REQUEST_MAX = 500
+RECEIPTS_MAX_USERS = 100
+
+
+def latest_marks(user_id: int, marks: list) -> dict:
+    '''[(chat_id, message_id)] одного пользователя -> {(chat_id, user_id): message_id}, по чату — максимальная'''
+    latest = {}
+    for chat_id, message_id in marks:
+        key = (chat_id, user_id)
+        latest[key] = max(message_id, latest.get(key, 0))
+    return latest
+
+
+def apply_marks(cur, schema: str, marks: dict) -> list:
+    '''Пишет отметки {(chat_id, user_id): message_id} одним UPDATE; возвращает сдвинутые.
+
+    После отмеченного сообщения в чате message_seq - chat_seq сообщений
+    (V0020), значит прочитано message_count минус столько. Отметка на
+    последнем сообщении — весь message_count. Только у сообщений без номера
+    (до V0020 или вставленных мимо insert_messages) хвост считается по
+    индексу (chat_id, created_at, id).
+    '''
+    keys = sorted(marks)
+    cur.execute(f'''
+        WITH marks (chat_id, user_id, message_id) AS (
+            SELECT * FROM unnest(%s::int[], %s::int[], %s::bigint[])
+        ),
+        target AS (
+            SELECT m.chat_id, m.user_id, s.message_count,
+                   LEAST(m.message_id, s.last_message_id) AS message_id,
+                   GREATEST(CASE
+                       WHEN m.message_id >= s.last_message_id THEN s.message_count
+                       WHEN r.chat_seq IS NOT NULL THEN s.message_count - (s.message_seq - r.chat_seq)
+                       ELSE s.message_count - (
+                           SELECT COUNT(*)
+                           FROM {schema}.messages x
+                           WHERE x.chat_id = m.chat_id AND x.id > m.message_id
+                             AND x.created_at >= COALESCE(r.created_at, '-infinity')
+                       )
+                   END, 0) AS read_count
+            FROM marks m
+            JOIN {schema}.chat_stats s ON s.chat_id = m.chat_id
+            LEFT JOIN LATERAL (
+                SELECT x.chat_seq, x.created_at FROM {schema}.messages x
+                WHERE x.id = m.message_id AND x.chat_id = m.chat_id
+                LIMIT 1
+            ) r ON m.message_id < s.last_message_id
+        )
+        UPDATE {schema}.chat_members cm
+        SET last_read_message_id = t.message_id, read_count = t.read_count
+        FROM target t
+        WHERE cm.chat_id = t.chat_id AND cm.user_id = t.user_id
+          AND (cm.last_read_message_id IS NULL OR cm.last_read_message_id < t.message_id)
+        RETURNING cm.chat_id, cm.user_id, cm.last_read_message_id,
+                  GREATEST(t.message_count - t.read_count, 0) AS unread_count
+    ''', ([chat_id for chat_id, _ in keys], [user_id for _, user_id in keys], [marks[key] for key in keys]))
+    return cur.records()
+
+
+def mark_sent(cur, schema: str, sent: list):
+    '''Отправитель прочитал чат до своего сообщения: [(chat_id, user_id, message_id)].
+
+    Вызывается в транзакции отправки после вставки: строка chat_stats уже
+    заблокирована её триггером, поэтому message_count включает эту отправку.
+    '''
+    latest = {}
+    for chat_id, user_id, message_id in sent:
+        if chat_id is not None and user_id is not None:
+            key = (int(chat_id), int(user_id))
+            latest[key] = max(message_id, latest.get(key, 0))
+    if not latest:
+        return
+    keys = sorted(latest)
+    cur.execute(f'''
+        UPDATE {schema}.chat_members cm
+        SET last_read_message_id = v.message_id, read_count = s.message_count
+        FROM unnest(%s::int[], %s::int[], %s::bigint[]) AS v(chat_id, user_id, message_id)
+        JOIN {schema}.chat_stats s ON s.chat_id = v.chat_id
+        WHERE cm.chat_id = v.chat_id AND cm.user_id = v.user_id
+          AND (cm.last_read_message_id IS NULL OR cm.last_read_message_id < v.message_id)
+    ''', ([chat_id for chat_id, _ in keys], [user_id for _, user_id in keys], [latest[key] for key in keys]))
+
+
+def receipts_sql(schema: str) -> str:
+    return f'''
+        SELECT COUNT(*) OVER (), user_id
+        FROM {schema}.chat_members
+        WHERE chat_id = %s AND last_read_message_id >= %s
+        ORDER BY user_id
+        LIMIT %s
+    '''
+
+
+def receipts_of(chat_id: int, message_id: int, rows: list) -> dict:
+    return {'chat_id': chat_id, 'message_id': message_id,
+            'read_by': rows[0][0] if rows else 0, 'user_ids': [user_id for _, user_id in rows]}
+
+
+def receipts(cur, schema: str, chat_id: int, message_id: int) -> dict:
+    '''Сколько участников прочитали сообщение и первые RECEIPTS_MAX_USERS из них'''
+    cur.execute(receipts_sql(schema), (chat_id, message_id, RECEIPTS_MAX_USERS))
+    return receipts_of(chat_id, message_id, cur.fetchall())
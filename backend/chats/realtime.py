@@ -0,0 +1,216 @@
+'''Один LISTEN на процесс и раздача событий ожидающим long-poll клиентам.
+
+То же соединение слушает и speaky_cache (cache.py): второго постоянного
+соединения ради инвалидации кешей у chats нет.
+'''
+import json
+import os
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import cache
+from presence import store
+
+CHANNEL = 'speaky_events'
+
+
+class Subscriber:
+    '''Ожидающий клиент: копит события, схлопывая их по (type, chat_id, user_id)'''
+
+    def __init__(self, user_id: int, backlog: int):
+        self.user_id = user_id
+        self.chat_ids = None
+        self.backlog = backlog
+        self.pending = {}
+        self.resync = False
+        self.ready = threading.Event()
+
+    def push(self, event: dict):
+        key = (event['type'], event['chat_id'], event.get('user_id'))
+        current = self.pending.get(key)
+        if current and event['type'] == 'message':
+            current['count'] += event.get('count', 1)
+            current['last_message_id'] = max(current['last_message_id'], event['last_message_id'])
+        elif current or len(self.pending) < self.backlog:
+            self.pending[key] = dict(event)
+        else:
+            # Очередь переполнена: подробности теряем, клиент перечитает список чатов
+            self.resync = True
+        self.ready.set()
+
+
+class UpdateHub:
+    def __init__(self, dsn: str, channel: str = CHANNEL, backlog: int = 100):
+        self.dsn = dsn
+        self.channel = channel
+        self.backlog = backlog
+        self.connected = False
+        self.notifications = 0
+        self.wakeups = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._by_chat = {}
+        self._by_user = {}
+        self._unscoped = set()
+        self._thread = None
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='speaky-listener', daemon=True)
+                self._thread.start()
+
+    def subscribe(self, user_id: int) -> Subscriber:
+        '''Подписка до чтения снимка из БД: события, пришедшие между снимком
+        и watch(), не теряются — пока chat_ids неизвестны, подписчик получает все.'''
+        sub = Subscriber(user_id, self.backlog)
+        with self._lock:
+            self._by_user.setdefault(user_id, set()).add(sub)
+            self._unscoped.add(sub)
+        return sub
+
+    def watch(self, sub: Subscriber, chat_ids):
+        with self._lock:
+            sub.chat_ids = set(chat_ids)
+            self._unscoped.discard(sub)
+            for chat_id in sub.chat_ids:
+                self._by_chat.setdefault(chat_id, set()).add(sub)
+            for key in [k for k in sub.pending if k[1] not in sub.chat_ids and k[0] in ('message', 'typing')]:
+                del sub.pending[key]
+            if not sub.pending and not sub.resync:
+                sub.ready.clear()
+
+    def wait(self, sub: Subscriber, timeout: float) -> tuple:
+        sub.ready.wait(timeout)
+        with self._lock:
+            return list(sub.pending.values()), sub.resync
+
+    def unsubscribe(self, sub: Subscriber):
+        with self._lock:
+            self._unscoped.discard(sub)
+            self._discard(self._by_user, sub.user_id, sub)
+            for chat_id in sub.chat_ids or ():
+                self._discard(self._by_chat, chat_id, sub)
+
+    @staticmethod
+    def _discard(index: dict, key, sub: Subscriber):
+        subs = index.get(key)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del index[key]
+
+    def dispatch(self, event: dict):
+        if event['type'] == 'typing':
+            # Состояние набора нужно и action=presence этого инстанса, а не только ждущим клиентам
+            store.set_typing(event['chat_id'], event['user_id'], event['typing'])
+        with self._lock:
+            self.notifications += 1
+            chat_id = event['chat_id']
+            if event['type'] == 'membership':
+                # Одно уведомление на чат (V0017): каждому затронутому пользователю — событие со своим user_id
+                single = {key: value for key, value in event.items() if key != 'user_ids'}
+                for user_id in event['user_ids']:
+                    self._membership({**single, 'user_id': user_id})
+                return
+            targets = self._by_chat.get(chat_id, set()) | self._unscoped
+            for sub in targets:
+                if event['type'] == 'typing' and sub.user_id == event['user_id']:
+                    continue
+                sub.push(event)
+                self.wakeups += 1
+
+    def _membership(self, event: dict):
+        chat_id = event['chat_id']
+        for sub in set(self._by_user.get(event['user_id'], ())):
+            if sub.chat_ids is not None:
+                if event['action'] == 'added':
+                    sub.chat_ids.add(chat_id)
+                    self._by_chat.setdefault(chat_id, set()).add(sub)
+                else:
+                    sub.chat_ids.discard(chat_id)
+                    self._discard(self._by_chat, chat_id, sub)
+            sub.push(event)
+            self.wakeups += 1
+
+    def _resync_all(self):
+        with self._lock:
+            for subs in self._by_user.values():
+                for sub in subs:
+                    sub.resync = True
+                    sub.ready.set()
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn, keepalives=1, keepalives_idle=30)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {self.channel}')
+                    cur.execute(f'LISTEN {cache.CHANNEL}')
+                self.connected = True
+                backoff = 0.5
+                while True:
+                    if select.select([conn], [], [], 30.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            if notify.channel == cache.CHANNEL:
+                                cache.receive(notify.payload)
+                            else:
+                                self.dispatch(json.loads(notify.payload))
+                        except Exception as e:
+                            # Битое уведомление пропускаем: из-за него не должен встать весь поток
+                            self._drop(notify, e)
+            except Exception:
+                # Пока слушатель не работал, события могли потеряться — клиенты перечитают снимок
+                self.connected = False
+                self._resync_all()
+                cache.reset()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _drop(self, notify, error: Exception):
+        with self._lock:
+            self.dropped += 1
+        print(json.dumps({
+            'event': 'notification_dropped', 'channel': notify.channel, 'payload': notify.payload[:500],
+            'error': f'{type(error).__name__}: {error}'
+        }, ensure_ascii=False), flush=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'connected': self.connected,
+                'notifications': self.notifications,
+                'wakeups': self.wakeups,
+                'dropped': self.dropped,
+                'subscribers': sum(len(subs) for subs in self._by_user.values())
+            }
+
+
+_hub = None
+
+
+def get_hub() -> UpdateHub:
+    global _hub
+    if _hub is None:
+        _hub = UpdateHub(os.environ['DATABASE_URL'], backlog=int(os.environ.get('UPDATES_BACKLOG', '100')))
+    return _hub
+
+
+def ensure_listener():
+    '''cache.ensure_listener для chats: при CACHE_LISTEN=1 speaky_cache слушает соединение хаба'''
+    if cache.listening():
+        get_hub().ensure_started()
@@ -0,0 +1,52 @@
+'''Лестница разрешений для изображений: 64/256/1024 px в WebP'''
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+VARIANT_SIZES = (1024, 256, 64)
+WEBP_QUALITY = 80
+
+FORMAT_CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif'
+}
+
+# Готовые ступени одного изображения грузятся в S3 параллельно, пока запрос ждёт
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('IMAGE_WORKERS', str(os.cpu_count() or 1))),
+    thread_name_prefix='speaky-images'
+)
+
+
+def sniff_content_type(data: bytes):
+    '''Настоящий MIME по заголовку файла или None, если это не картинка'''
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return FORMAT_CONTENT_TYPES.get(image.format)
+    except (OSError, Image.DecompressionBombError):
+        return None
+
+
+def render_variants(data: bytes) -> dict:
+    '''Возвращает {size: webp_bytes}; каждая ступень ужимается из предыдущей, а не из оригинала.
+
+    Больше оригинала не растягиваем: маленькая картинка просто перекодируется,
+    чтобы ключи всех ступеней существовали и клиент мог строить URL сам.
+    '''
+    with Image.open(io.BytesIO(data)) as source:
+        # Для JPEG декодер сразу отдаёт уменьшенную в 2^n раз картинку
+        source.draft('RGB', (VARIANT_SIZES[0], VARIANT_SIZES[0]))
+        image = ImageOps.exif_transpose(source)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    variants = {}
+    for size in VARIANT_SIZES:
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+        variants[size] = out.getvalue()
+    return variants
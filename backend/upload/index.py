@@ -1,89 +1,468 @@
+import hashlib
+import io
 import json
 import os
 import base64
+import threading
+import time
+import uuid
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from datetime import datetime
 
+from db import get_pool
+from instrument import phase, profiled, record_error
+from images import VARIANT_SIZES, executor, render_variants, sniff_content_type
+from runtime import JSON_HEADERS, TupleCursor, preflight, response as json_response
+
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'files')
+
+PRESIGN_EXPIRES = 900
+MAX_PRESIGNED_SIZE = 2 * 1024 ** 3
+MULTIPART_MAX_PART_SIZE = 16 * 1024 * 1024
+
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '20'))
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', '8'))
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Файлы крупнее порога функция сама режет на части и грузит их параллельно
+transfer_config = TransferConfig(
+    multipart_threshold=UPLOAD_PART_SIZE,
+    multipart_chunksize=UPLOAD_PART_SIZE,
+    max_concurrency=UPLOAD_CONCURRENCY,
+    use_threads=UPLOAD_CONCURRENCY > 1
+)
+
+# Накопительные счётчики процесса: видно, сколько стоил холодный старт клиента и сами загрузки
+metrics = {'client_inits': 0, 'client_init_ms': 0.0, 'invocations': 0, 'uploads': 0, 'upload_ms': 0.0,
+           'images': 0, 'image_errors': 0}
+# Ступени грузятся из потоков images.executor, поэтому счётчики меняются под замком
+metrics_lock = threading.Lock()
+
+_s3 = None
+
+IMAGE_TYPES = ('photo', 'avatar', 'banner')
+
+ext_map = {'photo': 'jpg', 'video': 'mp4', 'voice': 'ogg', 'avatar': 'jpg', 'banner': 'jpg'}
+
+content_type_map = {
+    'photo': 'image/jpeg',
+    'video': 'video/mp4',
+    'voice': 'audio/ogg',
+    'avatar': 'image/jpeg',
+    'banner': 'image/jpeg'
+}
+
+def count(name: str, value=1):
+    with metrics_lock:
+        metrics[name] += value
+
+def s3_client():
+    '''Клиент создаётся один раз на процесс: модели botocore и пул соединений переживают тёплые вызовы'''
+    global _s3
+    if _s3 is None:
+        started = time.perf_counter()
+        _s3 = boto3.client('s3',
+            endpoint_url=S3_ENDPOINT_URL,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+            config=Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+                retries={'max_attempts': 3, 'mode': 'standard'}
+            )
+        )
+        count('client_inits')
+        count('client_init_ms', (time.perf_counter() - started) * 1000)
+    return _s3
+
+def put_file(s3, file_key: str, data: bytes, content_type: str) -> float:
+    started = time.perf_counter()
+    s3.upload_fileobj(
+        io.BytesIO(data), S3_BUCKET, file_key,
+        ExtraArgs={'ContentType': content_type},
+        Config=transfer_config
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+    count('uploads')
+    count('upload_ms', elapsed)
+    return elapsed
+
+def make_key(file_type: str, user_id) -> str:
+    '''Ключ для загрузок без известного заранее хеша (multipart, presign без sha256)'''
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    ext = ext_map.get(file_type, 'jpg')
+    return f'speaky/{file_type}s/{user_id}_{timestamp}_{uuid.uuid4().hex[:8]}.{ext}'
+
+def media_key(digest: str) -> str:
+    return f'speaky/media/{digest[:2]}/{digest}'
+
+def sha256_of(stream) -> str:
+    digest = hashlib.sha256()
+    while chunk := stream.read(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def lock_digest(cur, digest: str):
+    '''confirm и release одного хеша идут по очереди до COMMIT'''
+    cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (digest,))
+
+def add_reference(cur, schema: str, digest: str, user_id):
+    if user_id is None:
+        return
+    cur.execute(f'''
+        INSERT INTO {schema}.media_refs (sha256, user_id) VALUES (%s, %s)
+        ON CONFLICT (sha256, user_id) DO UPDATE SET refs = media_refs.refs + 1
+    ''', (digest, user_id))
+
+def reference_media(cur, schema: str, digest: str, user_id):
+    '''Если объект с таким хешем уже есть — ещё одна ссылка на него, тело не передаётся'''
+    cur.execute(f'''
+        UPDATE {schema}.media_objects
+        SET ref_count = ref_count + 1, last_referenced_at = CURRENT_TIMESTAMP
+        WHERE sha256 = %s
+        RETURNING object_key, content_type, variants
+    ''', (digest,))
+    row = cur.record()
+    if row:
+        add_reference(cur, schema, digest, user_id)
+    return row
+
+def variant_key(file_key: str, size: int) -> str:
+    return f'{file_key}_{size}.webp'
+
+def store_variants(s3, cur, schema: str, file_key: str, digest: str, data: bytes = None):
+    '''Рендер ступеней до ответа: URL отдаются, только когда файлы уже в S3 и отмечены в media_objects.
+
+    Ступени грузятся параллельно в пуле images.executor. Ошибка рендера не
+    ломает загрузку: оригинал уже сохранён, ответ просто придёт без variants,
+    а следующая ссылка на этот хеш попробует ещё раз.
+    '''
+    try:
+        if data is None:
+            data = s3.get_object(Bucket=S3_BUCKET, Key=file_key)['Body'].read()
+        rendered = render_variants(data)
+        list(executor.map(
+            lambda size: put_file(s3, variant_key(file_key, size), rendered[size], 'image/webp'), rendered
+        ))
+        keys = {str(size): variant_key(file_key, size) for size in rendered}
+        cur.execute(f'''
+            UPDATE {schema}.media_objects SET variants = %s WHERE sha256 = %s
+        ''', (json.dumps(keys), digest))
+        cur.connection.commit()
+    except Exception as e:
+        cur.connection.rollback()
+        record_error(e)
+        count('image_errors')
+        return None
+    count('images')
+    return {size: cdn_url(key) for size, key in keys.items()}
+
+def image_variants(s3, cur, schema: str, existing: dict, digest: str):
+    '''variants уже существующего объекта: готовые из media_objects или отрендеренные сейчас'''
+    if not (existing['content_type'] or '').startswith('image/'):
+        return None
+    if existing['variants']:
+        return {size: cdn_url(key) for size, key in existing['variants'].items()}
+    return store_variants(s3, cur, schema, existing['object_key'], digest)
+
+def register_media(cur, schema: str, digest: str, file_key: str, content_type: str, size: int, user_id) -> str:
+    cur.execute(f'''
+        INSERT INTO {schema}.media_objects (sha256, object_key, content_type, size_bytes, created_by)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (sha256) DO UPDATE
+        SET ref_count = media_objects.ref_count + 1, last_referenced_at = CURRENT_TIMESTAMP
+        RETURNING object_key
+    ''', (digest, file_key, content_type, size, user_id))
+    file_key = cur.fetchone()[0]
+    add_reference(cur, schema, digest, user_id)
+    return file_key
+
+def release_media(s3, cur, schema: str, digest: str, user_id):
+    '''Снимает одну ссылку пользователя; последняя ссылка удаляет строку, оригинал и WebP-ступени.
+
+    S3 чистится до COMMIT под блокировкой хеша: при ошибке удаления строка
+    остаётся, а параллельный confirm ждёт и делает HEAD уже после удаления.
+    '''
+    lock_digest(cur, digest)
+    cur.execute(f'''
+        UPDATE {schema}.media_refs SET refs = refs - 1
+        WHERE sha256 = %s AND user_id = %s AND refs > 0
+        RETURNING refs
+    ''', (digest, user_id))
+    mine = cur.fetchone()
+    if mine is None:
+        return None
+    if mine[0] == 0:
+        cur.execute(f'DELETE FROM {schema}.media_refs WHERE sha256 = %s AND user_id = %s', (digest, user_id))
+    cur.execute(f'''
+        UPDATE {schema}.media_objects SET ref_count = ref_count - 1
+        WHERE sha256 = %s
+        RETURNING ref_count
+    ''', (digest,))
+    ref_count = cur.fetchone()[0]
+    cur.execute(f'''
+        DELETE FROM {schema}.media_objects WHERE sha256 = %s AND ref_count <= 0
+        RETURNING object_key
+    ''', (digest,))
+    deleted = cur.fetchone()
+    if deleted:
+        keys = [deleted[0]] + [variant_key(deleted[0], size) for size in VARIANT_SIZES]
+        s3.delete_objects(Bucket=S3_BUCKET, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    return max(ref_count, 0)
+
+def cdn_url(file_key: str) -> str:
+    return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{file_key}"
+
+def response(status: int, payload: dict, timings: dict = None) -> dict:
+    if not timings:
+        return json_response(status, payload)
+    server_timing = ', '.join(f'{name};dur={ms:.1f}' for name, ms in timings.items())
+    return json_response(status, payload, {**JSON_HEADERS, 'Server-Timing': server_timing})
+
+def presign(s3, cur, schema: str, body: dict) -> dict:
+    '''Клиент грузит файл напрямую в S3: функция выдаёт только подписанный PUT или POST.
+
+    Если клиент прислал sha256 и такой объект уже есть, загрузка не нужна вовсе.
+    Иначе PUT подписывается на ключ по хешу с x-amz-checksum-sha256, чтобы S3
+    отверг тело, не совпадающее с заявленным хешем; после загрузки — action=confirm.
+    '''
+    file_type = body.get('type', 'photo')
+    content_type = content_type_map.get(file_type, 'application/octet-stream')
+    digest = body.get('sha256')
+
+    if digest:
+        existing = reference_media(cur, schema, digest, body.get('user_id'))
+        cur.connection.commit()
+        if existing:
+            return response(200, {'success': True, 'exists': True, 'url': cdn_url(existing['object_key'])})
+        file_key = media_key(digest)
+        checksum = base64.b64encode(bytes.fromhex(digest)).decode()
+        upload_url = s3.generate_presigned_url(
+            'put_object',
+            Params={'Bucket': S3_BUCKET, 'Key': file_key, 'ContentType': content_type, 'ChecksumSHA256': checksum},
+            ExpiresIn=PRESIGN_EXPIRES
+        )
+        return response(200, {'success': True, 'exists': False, 'method': 'PUT', 'upload_url': upload_url,
+                              'headers': {'Content-Type': content_type, 'x-amz-checksum-sha256': checksum},
+                              'key': file_key, 'url': cdn_url(file_key)})
+
+    file_key = make_key(file_type, body.get('user_id'))
+
+    if body.get('method') == 'post':
+        post = s3.generate_presigned_post(
+            S3_BUCKET, file_key,
+            Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, MAX_PRESIGNED_SIZE]],
+            ExpiresIn=PRESIGN_EXPIRES
+        )
+        return response(200, {'success': True, 'method': 'POST', 'upload_url': post['url'],
+                              'fields': post['fields'], 'key': file_key, 'url': cdn_url(file_key)})
+
+    upload_url = s3.generate_presigned_url(
+        'put_object',
+        Params={'Bucket': S3_BUCKET, 'Key': file_key, 'ContentType': content_type},
+        ExpiresIn=PRESIGN_EXPIRES
+    )
+    return response(200, {'success': True, 'method': 'PUT', 'upload_url': upload_url,
+                          'headers': {'Content-Type': content_type}, 'key': file_key, 'url': cdn_url(file_key)})
+
+def media(s3, cur, schema: str, body: dict) -> dict:
+    '''lookup / confirm / release для объектов, адресуемых по sha256'''
+    action = body.get('action')
+    digest = body.get('sha256') or ''
+    if len(digest) != 64:
+        return response(400, {'error': 'sha256 must be a hex digest'})
+
+    if action == 'lookup':
+        existing = reference_media(cur, schema, digest, body.get('user_id'))
+        cur.connection.commit()
+        if existing:
+            payload = {'success': True, 'exists': True, 'url': cdn_url(existing['object_key'])}
+            variants = image_variants(s3, cur, schema, existing, digest)
+            if variants:
+                payload['variants'] = variants
+            return response(200, payload)
+        return response(200, {'success': True, 'exists': False})
+
+    if action == 'confirm':
+        file_key = media_key(digest)
+        # HEAD под блокировкой хеша: параллельный release либо уже удалил файл, либо дождётся регистрации
+        lock_digest(cur, digest)
+        head = s3.head_object(Bucket=S3_BUCKET, Key=file_key)
+        file_key = register_media(cur, schema, digest, file_key, head.get('ContentType'),
+                                  head['ContentLength'], body.get('user_id'))
+        cur.connection.commit()
+        payload = {'success': True, 'url': cdn_url(file_key)}
+        if (head.get('ContentType') or '').startswith('image/'):
+            variants = store_variants(s3, cur, schema, file_key, digest)
+            if variants:
+                payload['variants'] = variants
+        return response(200, payload)
+
+    if action == 'release':
+        if body.get('user_id') is None:
+            return response(400, {'error': 'user_id is required'})
+        ref_count = release_media(s3, cur, schema, digest, body['user_id'])
+        if ref_count is None:
+            cur.connection.rollback()
+            return response(404, {'error': 'No reference to release'})
+        cur.connection.commit()
+        return response(200, {'success': True, 'ref_count': ref_count})
+
+    return response(400, {'error': 'Invalid action'})
+
+def multipart(s3, body: dict) -> dict:
+    '''Управление multipart-загрузкой: start / presign_parts / complete / abort'''
+    action = body.get('action')
+
+    if action == 'multipart_start':
+        file_type = body.get('type', 'photo')
+        file_key = make_key(file_type, body.get('user_id'))
+        upload = s3.create_multipart_upload(
+            Bucket=S3_BUCKET, Key=file_key,
+            ContentType=content_type_map.get(file_type, 'application/octet-stream')
+        )
+        return response(200, {'success': True, 'upload_id': upload['UploadId'], 'key': file_key,
+                              'max_part_size': MULTIPART_MAX_PART_SIZE})
+
+    file_key = body.get('key')
+    upload_id = body.get('upload_id')
+
+    if action == 'multipart_presign_parts':
+        urls = {
+            str(n): s3.generate_presigned_url(
+                'upload_part',
+                Params={'Bucket': S3_BUCKET, 'Key': file_key, 'UploadId': upload_id, 'PartNumber': n},
+                ExpiresIn=PRESIGN_EXPIRES
+            )
+            for n in body.get('part_numbers', [])
+        }
+        return response(200, {'success': True, 'urls': urls})
+
+    if action == 'multipart_complete':
+        parts = sorted(
+            ({'PartNumber': int(p['part_number']), 'ETag': p['etag']} for p in body.get('parts', [])),
+            key=lambda p: p['PartNumber']
+        )
+        s3.complete_multipart_upload(
+            Bucket=S3_BUCKET, Key=file_key, UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+        return response(200, {'success': True, 'key': file_key, 'url': cdn_url(file_key)})
+
+    if action == 'multipart_abort':
+        s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=file_key, UploadId=upload_id)
+        return response(200, {'success': True})
+
+    return response(400, {'error': 'Invalid action'})
+
+def upload_part(s3, event: dict, timings: dict) -> dict:
+    '''PUT с сырым телом части (без JSON и base64 на стороне клиента): в памяти только одна часть.
+
+    Байты части приходят только в base64 (isBase64Encoded): клиент шлёт её как
+    application/octet-stream. Тело, которое шлюз уже декодировал как текст,
+    исходных байтов не восстанавливает, поэтому такая часть отклоняется.
+    '''
+    params = event.get('queryStringParameters') or {}
+    if not event.get('isBase64Encoded'):
+        return response(400, {'error': 'Part body must be binary: send it with Content-Type: application/octet-stream'})
+    part = base64.b64decode(event.get('body') or '')
+
+    if not part or len(part) > MULTIPART_MAX_PART_SIZE:
+        return response(400, {'error': f'Part size must be 1..{MULTIPART_MAX_PART_SIZE} bytes'})
+
+    started = time.perf_counter()
+    result = s3.upload_part(
+        Bucket=S3_BUCKET, Key=params.get('key'), UploadId=params.get('upload_id'),
+        PartNumber=int(params.get('part_number', 1)), Body=part
+    )
+    timings['s3part'] = (time.perf_counter() - started) * 1000
+    return response(200, {'success': True, 'part_number': int(params.get('part_number', 1)), 'etag': result['ETag']}, timings)
+
+@profiled('upload')
 def handler(event: dict, context) -> dict:
     '''API для загрузки фото, видео, аудио файлов в S3'''
     method = event.get('httpMethod', 'GET')
-    
+
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
+        return preflight('POST, PUT, OPTIONS')
+
+    if method not in ('POST', 'PUT'):
+        return response(405, {'error': 'Method not allowed'})
+
+    count('invocations')
     try:
+        started = time.perf_counter()
+        s3 = s3_client()
+        timings = {'s3client': (time.perf_counter() - started) * 1000}
+
+        if method == 'PUT':
+            return upload_part(s3, event, timings)
+
         body = json.loads(event.get('body', '{}'))
-        file_data = body.get('file')
-        file_type = body.get('type', 'photo')
-        user_id = body.get('user_id')
-        
-        if not file_data:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'No file data provided'}),
-                'isBase64Encoded': False
-            }
-        
-        file_bytes = base64.b64decode(file_data)
-        
-        s3 = boto3.client('s3',
-            endpoint_url='https://bucket.poehali.dev',
-            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
-        )
-        
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        ext_map = {'photo': 'jpg', 'video': 'mp4', 'voice': 'ogg', 'avatar': 'jpg', 'banner': 'jpg'}
-        ext = ext_map.get(file_type, 'jpg')
-        
-        file_key = f'speaky/{file_type}s/{user_id}_{timestamp}.{ext}'
-        
-        content_type_map = {
-            'photo': 'image/jpeg',
-            'video': 'video/mp4',
-            'voice': 'audio/ogg',
-            'avatar': 'image/jpeg',
-            'banner': 'image/jpeg'
-        }
-        
-        s3.put_object(
-            Bucket='files',
-            Key=file_key,
-            Body=file_bytes,
-            ContentType=content_type_map.get(file_type, 'application/octet-stream')
-        )
-        
-        cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{file_key}"
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'success': True, 'url': cdn_url}),
-            'isBase64Encoded': False
-        }
-        
+        action = body.get('action')
+
+        if action == 'metrics':
+            with metrics_lock:
+                return response(200, dict(metrics))
+        if action and action.startswith('multipart_'):
+            return multipart(s3, body)
+
+        schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+        pool = get_pool()
+        with phase('connect'):
+            conn = pool.getconn()
+        cur = conn.cursor(cursor_factory=TupleCursor)
+        try:
+            if action == 'presign':
+                return presign(s3, cur, schema, body)
+            if action in ('lookup', 'confirm', 'release'):
+                return media(s3, cur, schema, body)
+
+            # Файл целиком в base64 внутри JSON (небольшие аватарки); хранится один раз по sha256
+            file_data = body.get('file')
+            file_type = body.get('type', 'photo')
+            user_id = body.get('user_id')
+
+            if not file_data:
+                return response(400, {'error': 'No file data provided'})
+
+            file_bytes = base64.b64decode(file_data)
+            digest = sha256_of(io.BytesIO(file_bytes))
+
+            lock_digest(cur, digest)
+            existing = reference_media(cur, schema, digest, user_id)
+            if existing:
+                conn.commit()
+                payload = {'success': True, 'url': cdn_url(existing['object_key']), 'deduplicated': True}
+                variants = image_variants(s3, cur, schema, existing, digest)
+                if variants:
+                    payload['variants'] = variants
+                return response(200, payload, timings)
+
+            sniffed = sniff_content_type(file_bytes) if file_type in IMAGE_TYPES else None
+            content_type = sniffed or content_type_map.get(file_type, 'application/octet-stream')
+            timings['s3put'] = put_file(s3, media_key(digest), file_bytes, content_type)
+            file_key = register_media(cur, schema, digest, media_key(digest), content_type, len(file_bytes), user_id)
+            conn.commit()
+
+            payload = {'success': True, 'url': cdn_url(file_key), 'deduplicated': False}
+            if sniffed:
+                # Инстанс замораживается после ответа, поэтому ступени рендерятся до него
+                started = time.perf_counter()
+                variants = store_variants(s3, cur, schema, file_key, digest, file_bytes)
+                timings['variants'] = (time.perf_counter() - started) * 1000
+                if variants:
+                    payload['variants'] = variants
+            return response(200, payload, timings)
+        finally:
+            cur.close()
+            pool.putconn(conn)
+
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        record_error(e)
+        return response(500, {'error': str(e)})
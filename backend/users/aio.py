@@ -0,0 +1,143 @@
+'''Асинхронный handler функции users (HANDLER_MODE=async, см. конец index.py).
+
+Частые чтения идут через пул asyncpg (aiodb.py) без потока на запрос, а
+экран профиля собирается из независимых запросов (профиль, счётчики,
+друзья) параллельно на разных соединениях пула. SQL, кеши и сборка ответов
+общие с index.py, поэтому ответы совпадают с синхронным режимом. Записи и
+остальные действия выполняет синхронный handler в пуле потоков.
+'''
+import asyncio
+import os
+
+from aiodb import fetch, fetchrow, fetchtuples, get_async_pool, run_sync
+from cache import MISSING, ensure_listener, snapshot
+from friends import FRIENDS_DEFAULT_LIMIT, FRIENDS_MAX_LIMIT, friends_query
+from index import (
+    SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, STATS_FIELDS, blocked_sql, by_username_sql, error_response, friends_cache,
+    friends_page, search_cache, search_page, search_query, stats_sql, sync_handler, user_cache, user_sql
+)
+from instrument import profiled
+from presence import lookup_sql, parse_ids, presence_of
+from runtime import response
+
+
+def as_id(raw):
+    '''id из query string: asyncpg, в отличие от литералов psycopg2, строку в integer не приводит'''
+    return int(raw) if raw not in (None, '') else None
+
+
+async def get_user(pool, schema: str, user_id: int) -> dict:
+    user = user_cache.get(user_id)
+    if user is MISSING:
+        user = await fetchrow(pool, user_sql(schema), (user_id,))
+        if user:
+            user_cache.set(user_id, user)
+    return user
+
+
+async def get_stats(pool, schema: str, user_id: int) -> dict:
+    return await fetchrow(pool, stats_sql(schema), (user_id,)) or dict.fromkeys(STATS_FIELDS, 0)
+
+
+async def all_friends(pool, schema: str, user_id: int) -> list:
+    friends = friends_cache.get(user_id)
+    if friends is MISSING:
+        friends = await fetch(pool, *friends_query(schema, user_id))
+        friends_cache.set(user_id, friends)
+    return friends
+
+
+async def stats(pool, schema: str, params: dict) -> dict:
+    return response(200, await get_stats(pool, schema, as_id(params.get('user_id'))))
+
+
+async def profile(pool, schema: str, params: dict) -> dict:
+    # Три независимых запроса — на трёх соединениях пула одновременно
+    user_id = as_id(params.get('user_id'))
+    user, counters, friends = await asyncio.gather(
+        get_user(pool, schema, user_id),
+        get_stats(pool, schema, user_id),
+        all_friends(pool, schema, user_id)
+    )
+    if not user:
+        return response(404, {'error': 'User not found'})
+    return response(200, {'user': user, 'stats': counters, 'friends': friends})
+
+
+async def cache_stats(pool, schema: str, params: dict) -> dict:
+    return response(200, snapshot())
+
+
+async def friends(pool, schema: str, params: dict) -> dict:
+    user_id = as_id(params.get('user_id'))
+    if any(key in params for key in ('limit', 'cursor', 'online', 'mutual')):
+        limit = min(int(params.get('limit') or FRIENDS_DEFAULT_LIMIT), FRIENDS_MAX_LIMIT)
+        rows = await fetch(pool, *friends_query(
+            schema, user_id, limit + 1,
+            after_id=int(params.get('cursor') or 0),
+            online_only=params.get('online') == '1',
+            with_mutual=params.get('mutual') == '1'
+        ))
+        return response(200, friends_page(rows, limit))
+    return response(200, await all_friends(pool, schema, user_id))
+
+
+async def presence(pool, schema: str, params: dict) -> dict:
+    try:
+        user_ids = parse_ids(params.get('user_ids'))
+    except ValueError as e:
+        return response(400, {'error': str(e)})
+
+    rows = await fetchtuples(pool, lookup_sql(schema), (user_ids,)) if user_ids else []
+    return response(200, {'presence': presence_of(rows)})
+
+
+async def blocked(pool, schema: str, params: dict) -> dict:
+    return response(200, await fetch(pool, blocked_sql(schema), (as_id(params.get('user_id')),)))
+
+
+async def search(pool, schema: str, params: dict) -> dict:
+    if params.get('q'):
+        limit = min(int(params.get('limit') or SEARCH_DEFAULT_LIMIT), SEARCH_MAX_LIMIT)
+        key = (params['q'].strip().lower(), limit, params.get('cursor'))
+        result = search_cache.get(key)
+        if result is MISSING:
+            rows = await fetch(pool, *search_query(schema, params['q'], limit, params.get('cursor')))
+            result = search_page(rows, limit)
+            search_cache.set(key, result)
+        return response(200, result)
+
+    username = params.get('username', '').strip()
+    return response(200, {'user': await fetchrow(pool, by_username_sql(schema), (username,))})
+
+
+READS = {
+    'stats': stats,
+    'profile': profile,
+    'cache_stats': cache_stats,
+    'friends': friends,
+    'presence': presence,
+    'blocked': blocked,
+    'search': search
+}
+
+
+async def handler(event: dict, context) -> dict:
+    '''API для управления профилем, друзьями, черным списком (асинхронный режим)'''
+    params = event.get('queryStringParameters', {}) or {}
+    read = READS.get(params.get('action')) if event.get('httpMethod', 'GET') == 'GET' else None
+    if read is None:
+        # Синхронный handler профилирует себя сам
+        return await run_sync(sync_handler, event, context)
+    return await serve(event, context)
+
+
+@profiled('users')
+async def serve(event: dict, context) -> dict:
+    '''Чтения из READS; ошибки — тем же error_response, что в синхронном handler'''
+    params = event['queryStringParameters']
+    ensure_listener()
+    try:
+        return await READS[params['action']](await get_async_pool(), os.environ['MAIN_DB_SCHEMA'], params)
+    except Exception as e:
+        return error_response(e)
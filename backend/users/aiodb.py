@@ -0,0 +1,103 @@
+'''Пул asyncpg для асинхронного режима функции (HANDLER_MODE=async, см. aio.py).
+
+Запросы пишутся так же, как для psycopg2 (%s и %(name)s), и переводятся в
+нумерованные параметры asyncpg функцией numbered(), поэтому SQL у обоих
+режимов общий. Пул создаётся на event loop, в котором его впервые попросили:
+платформа и локальный стенд держат один loop на процесс.
+
+Значения параметров asyncpg не приводит из строк, как это делает сервер для
+литералов psycopg2: id из query string нужно передавать числами. timestamptz
+asyncpg отдаёт в UTC, как psycopg2 при TimeZone=UTC на сервере.
+'''
+import asyncio
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncpg
+
+_PARAM = re.compile(r'%\((\w+)\)s|%s|%%')
+
+_pools = {}
+_executor = None
+
+
+def numbered(query: str, params=()) -> tuple:
+    '''SQL с параметрами psycopg2 -> (SQL с $1, $2, ..., список значений)'''
+    values = []
+    names = {}
+
+    def replace(match) -> str:
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            values.append(params[len(values)])
+            return f'${len(values)}'
+        if name not in names:
+            values.append(params[name])
+            names[name] = len(values)
+        return f'${names[name]}'
+
+    return _PARAM.sub(replace, query), values
+
+
+async def get_async_pool() -> asyncpg.Pool:
+    loop = asyncio.get_running_loop()
+    if loop not in _pools:
+        # Задача, а не готовый пул: параллельные первые запросы ждут одно создание
+        _pools[loop] = asyncio.ensure_future(asyncpg.create_pool(
+            os.environ['DATABASE_URL'],
+            min_size=int(os.environ.get('ASYNC_POOL_MIN_SIZE', '1')),
+            max_size=int(os.environ.get('ASYNC_POOL_MAX_SIZE', '10')),
+            max_inactive_connection_lifetime=float(os.environ.get('ASYNC_POOL_IDLE_LIFETIME', '300')),
+            timeout=5
+        ))
+    try:
+        return await _pools[loop]
+    except Exception:
+        _pools.pop(loop, None)
+        raise
+
+
+async def fetch(conn, query: str, params=()) -> list:
+    '''Строки как список dict; conn — соединение или сам пул (тогда соединение берётся на один запрос)'''
+    query, values = numbered(query, params)
+    return [dict(row) for row in await conn.fetch(query, *values)]
+
+
+async def fetchtuples(conn, query: str, params=()) -> list:
+    '''Строки как asyncpg.Record: распаковываются как кортежи TupleCursor'''
+    query, values = numbered(query, params)
+    return await conn.fetch(query, *values)
+
+
+async def fetchrow(conn, query: str, params=()):
+    query, values = numbered(query, params)
+    row = await conn.fetchrow(query, *values)
+    return dict(row) if row is not None else None
+
+
+async def fetchval(conn, query: str, params=()):
+    query, values = numbered(query, params)
+    return await conn.fetchval(query, *values)
+
+
+async def run_sync(fn, *args):
+    '''Синхронная функция в отдельном пуле потоков: действия, у которых нет асинхронной версии'''
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(int(os.environ.get('ASYNC_SYNC_WORKERS', '16')), thread_name_prefix='sync')
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+def pool_stats() -> dict:
+    '''Размер пулов asyncpg процесса (для /__stats локального стенда)'''
+    stats = {'size': 0, 'idle': 0, 'max_size': 0}
+    for task in _pools.values():
+        if task.done() and not task.cancelled() and task.exception() is None:
+            pool = task.result()
+            stats['size'] += pool.get_size()
+            stats['idle'] += pool.get_idle_size()
+            stats['max_size'] += pool.get_max_size()
+    return stats
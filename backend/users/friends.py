@@ -0,0 +1,68 @@
+'''Граф друзей: дружба хранится одним ребром (user_id, friend_id), поэтому
+друзья пользователя — объединение двух индексных выборок, а не OR в JOIN'''
+from datetime import datetime, timezone
+
+from presence import ONLINE_WINDOW
+
+FRIENDS_DEFAULT_LIMIT = 50
+FRIENDS_MAX_LIMIT = 200
+
+
+def friend_ids_sql(schema: str, user_param: str) -> str:
+    '''Подзапрос id друзей: обе ветки UNION идут по своим индексам
+    (UNIQUE(user_id, friend_id) и idx_friendships_friend_id)'''
+    return f'''
+        SELECT friend_id AS id FROM {schema}.friendships
+        WHERE user_id = {user_param} AND status = 'accepted'
+        UNION
+        SELECT user_id AS id FROM {schema}.friendships
+        WHERE friend_id = {user_param} AND status = 'accepted'
+    '''
+
+
+def friends_query(schema: str, user_id, limit: int = None, after_id: int = None,
+                  online_only: bool = False, with_mutual: bool = False) -> tuple:
+    '''(SQL, параметры) друзей по возрастанию id; keyset-пагинация по id, опционально только
+    онлайн (show_online и last_seen в окне присутствия) и число общих друзей
+    (считается лишь для строк страницы)'''
+    params = {'user_id': user_id, 'after_id': after_id or 0,
+              'online_since': datetime.now(timezone.utc) - ONLINE_WINDOW}
+    filters = ' AND u.show_online AND u.last_seen > %(online_since)s' if online_only else ''
+    limit_sql = ''
+    if limit:
+        params['limit'] = limit
+        limit_sql = 'LIMIT %(limit)s'
+
+    mutual_select = ''
+    mutual_join = ''
+    if with_mutual:
+        mutual_select = ', m.mutual_count'
+        mutual_join = f'''
+            LEFT JOIN LATERAL (
+                SELECT COUNT(*) AS mutual_count
+                FROM ({friend_ids_sql(schema, 'page.id')}) theirs
+                WHERE theirs.id IN (SELECT id FROM mine)
+            ) m ON TRUE
+        '''
+
+    return f'''
+        WITH mine AS ({friend_ids_sql(schema, '%(user_id)s')}),
+        page AS (
+            SELECT u.id, u.nickname, u.username, u.avatar_url, u.show_online
+            FROM mine
+            JOIN {schema}.users u ON u.id = mine.id
+            WHERE u.id > %(after_id)s AND u.id <> %(user_id)s{filters}
+            ORDER BY u.id
+            {limit_sql}
+        )
+        SELECT page.*{mutual_select}
+        FROM page
+        {mutual_join}
+        ORDER BY page.id
+    ''', params
+
+
+def list_friends(cur, schema: str, user_id, limit: int = None, after_id: int = None,
+                 online_only: bool = False, with_mutual: bool = False) -> list:
+    cur.execute(*friends_query(schema, user_id, limit, after_id, online_only, with_mutual))
+    return cur.records()
@@ -1,26 +1,248 @@
+import base64
 import json
 import os
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
 
+from cache import MISSING, TTLCache, commit, ensure_listener, on_invalidate, publish_invalidation, snapshot
+from chatlist import list_page, list_page_query, sync_token
+from db import get_pool
+from instrument import phase, profiled, record_error
+from friends import FRIENDS_DEFAULT_LIMIT, FRIENDS_MAX_LIMIT, friends_query, list_friends
+from presence import lookup, parse_ids
+from runtime import TupleCursor, preflight, response
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 50
+
+# Части ответа bootstrap (fields=...) и размер первой страницы чатов в нём
+BOOTSTRAP_FIELDS = ('user', 'stats', 'friends', 'blocked', 'chats')
+BOOTSTRAP_CHATS_LIMIT = 20
+
+# Горячие поисковые запросы (одни и те же префиксы от многих клиентов)
+search_cache = TTLCache(
+    'search',
+    max_size=int(os.environ.get('SEARCH_CACHE_SIZE', '1024')),
+    ttl=float(os.environ.get('SEARCH_CACHE_TTL', '30'))
+)
+
+# Профили и списки друзей по id пользователя (права администратора из кеша не читаются)
+user_cache = TTLCache(
+    'users',
+    max_size=int(os.environ.get('USER_CACHE_SIZE', '4096')),
+    ttl=float(os.environ.get('USER_CACHE_TTL', '30'))
+)
+friends_cache = TTLCache(
+    'friends',
+    max_size=int(os.environ.get('USER_CACHE_SIZE', '4096')),
+    ttl=float(os.environ.get('USER_CACHE_TTL', '30'))
+)
+
+on_invalidate('user', lambda user_id: user_cache.delete(int(user_id)))
+on_invalidate('friends', lambda user_id: friends_cache.delete(int(user_id)))
+# В списке друзей есть ник, аватар и онлайн, поэтому изменение профиля сбрасывает списки с этим пользователем
+on_invalidate('user', lambda user_id: friends_cache.delete_where(
+    lambda owner_id, friends: any(f['id'] == int(user_id) for f in friends)
+))
+
+STATS_FIELDS = (
+    'friends_count', 'groups_count', 'channels_count',
+    'gifts_received_count', 'gifts_sent_count',
+    'transactions_count', 'topup_total', 'spent_total'
+)
+
+def user_sql(schema: str) -> str:
+    return f'''
+        SELECT id, phone, nickname, username, avatar_url, banner_url,
+               verified, enots, is_admin, language, theme, created_at
+        FROM {schema}.users
+        WHERE id = %s
+    '''
+
+def get_user(cur, schema: str, user_id) -> dict:
+    user = user_cache.get(int(user_id))
+    if user is MISSING:
+        cur.execute(user_sql(schema), (user_id,))
+        user = cur.record()
+        if user:
+            user_cache.set(int(user_id), user)
+    return user
+
+def is_admin(cur, schema: str, user_id) -> bool:
+    '''Права проверяются по БД, а не по кешу профилей: снятый флаг действует сразу'''
+    cur.execute(f'SELECT is_admin FROM {schema}.users WHERE id = %s', (user_id,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+def all_friends(cur, schema: str, user_id) -> list:
+    friends = friends_cache.get(int(user_id))
+    if friends is MISSING:
+        friends = list_friends(cur, schema, user_id)
+        friends_cache.set(int(user_id), friends)
+    return friends
+
+def stats_sql(schema: str) -> str:
+    # Счётчики ведут триггеры V0011; строки ещё нет только у пользователя без связей
+    return f'''
+        SELECT friends_count, groups_count, channels_count,
+               gifts_received_count, gifts_sent_count,
+               transactions_count, topup_total, spent_total
+        FROM {schema}.user_stats
+        WHERE user_id = %s
+    '''
+
+def blocked_sql(schema: str) -> str:
+    return f'''
+        SELECT u.id, u.nickname, u.username, u.avatar_url
+        FROM {schema}.users u
+        JOIN {schema}.blocked_users b ON b.blocked_user_id = u.id
+        WHERE b.user_id = %s
+    '''
+
+def by_username_sql(schema: str) -> str:
+    return f'''
+        SELECT id, phone, nickname, username, avatar_url, banner_url, 
+               verified, enots, is_admin, language
+        FROM {schema}.users
+        WHERE username = %s
+    '''
+
+def encode_search_cursor(score: float, user_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{score!r}|{user_id}'.encode()).decode().rstrip('=')
+
+def decode_search_cursor(cursor: str) -> tuple:
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    score, user_id = raw.split('|')
+    return float(score), int(user_id)
+
+def like_escape(term: str) -> str:
+    '''%, _ и \\ из запроса — буквальные символы в LIKE, а не шаблон'''
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_query(schema: str, query: str, limit: int, cursor: str = None) -> tuple:
+    '''(SQL, параметры) поиска по username и nickname: префикс выше нечёткого совпадения, keyset-курсор по (score, id).
+
+    Префиксы идут по btree text_pattern_ops, нечёткое совпадение — по GIN pg_trgm;
+    для запросов короче трёх символов триграммы бесполезны, остаётся только префикс.
+    '''
+    term = query.strip().lower().lstrip('@')
+    params = {
+        'term': term,
+        'username': f'@{term}',
+        'username_prefix': f'@{like_escape(term)}%',
+        'prefix': f'{like_escape(term)}%',
+        'limit': limit + 1
+    }
+    fuzzy = len(term) >= 3
+    where = "lower(username) LIKE %(username_prefix)s OR lower(nickname) LIKE %(prefix)s"
+    if fuzzy:
+        where += " OR lower(username) %% %(term)s OR %(term)s <%% lower(nickname)"
+    score = '''GREATEST(
+        CASE WHEN lower(username) = %(username)s THEN 3.0::float8
+             WHEN lower(username) LIKE %(username_prefix)s THEN 2.0::float8 ELSE 0.0::float8 END,
+        CASE WHEN lower(nickname) LIKE %(prefix)s THEN 1.5::float8 ELSE 0.0::float8 END'''
+    score += ''',
+        similarity(lower(username), %(term)s)::float8,
+        word_similarity(%(term)s, lower(nickname))::float8
+    )''' if fuzzy else ')'
+    after = ''
+    if cursor:
+        params['cursor_score'], params['cursor_id'] = decode_search_cursor(cursor)
+        after = 'WHERE (score, id) < (%(cursor_score)s, %(cursor_id)s)'
+    
+    return f'''
+        SELECT * FROM (
+            SELECT id, nickname, username, avatar_url, verified, {score} AS score
+            FROM {schema}.users
+            WHERE {where}
+        ) ranked
+        {after}
+        ORDER BY score DESC, id DESC
+        LIMIT %(limit)s
+    ''', params
+
+def search_page(rows: list, limit: int) -> dict:
+    next_cursor = encode_search_cursor(rows[limit - 1]['score'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return {'users': rows[:limit], 'next_cursor': next_cursor}
+
+def search_users(cur, schema: str, query: str, limit: int, cursor: str = None) -> dict:
+    cur.execute(*search_query(schema, query, limit, cursor))
+    return search_page(cur.records(), limit)
+
+def friends_page(rows: list, limit: int) -> dict:
+    '''Постраничный режим friends: {'friends': [...], 'next_cursor': id последнего}'''
+    return {'friends': rows[:limit], 'next_cursor': rows[limit - 1]['id'] if len(rows) > limit else None}
+
+def bootstrap_fields(raw: str) -> list:
+    '''fields=user,chats -> части ответа bootstrap; без fields — все'''
+    if not raw:
+        return list(BOOTSTRAP_FIELDS)
+    fields = [field.strip() for field in raw.split(',') if field.strip()]
+    unknown = sorted(set(fields) - set(BOOTSTRAP_FIELDS))
+    if unknown:
+        raise ValueError(f'Unknown fields: {", ".join(unknown)}; available: {", ".join(BOOTSTRAP_FIELDS)}')
+    return fields
+
+def bootstrap(conn, cur, schema: str, user_id: int, fields: list, params: dict) -> dict:
+    '''Стартовые данные клиента после входа одним вызовом вместо stats, friends, blocked и списка чатов.
+
+    Все части читаются на одном соединении в одной транзакции REPEATABLE READ
+    READ ONLY, то есть из одного снимка: friends_count совпадает с длиной
+    friends, а sync_token первой страницы чатов — xmin этого же снимка.
+    Прочитанные профиль и друзья заодно кладутся в кеши. None — нет пользователя.
+    '''
+    cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+    try:
+        cur.execute(user_sql(schema), (user_id,))
+        user = cur.record()
+        if not user:
+            return None
+        user_cache.set(user_id, user)
+        result = {'user': user} if 'user' in fields else {}
+        
+        if 'stats' in fields:
+            cur.execute(stats_sql(schema), (user_id,))
+            result['stats'] = cur.record() or dict.fromkeys(STATS_FIELDS, 0)
+        if 'friends' in fields:
+            cur.execute(*friends_query(schema, user_id))
+            result['friends'] = cur.records()
+            friends_cache.set(user_id, result['friends'])
+        if 'blocked' in fields:
+            cur.execute(blocked_sql(schema), (user_id,))
+            result['blocked'] = cur.records()
+        if 'chats' in fields:
+            # Первая страница chats?action=list: дальше клиент листает по next_cursor и догоняет по since
+            order = params.get('order', '')
+            query, values, limit = list_page_query(
+                schema, user_id, {'order': order, 'limit': params.get('chats_limit') or BOOTSTRAP_CHATS_LIMIT}
+            )
+            token = {'sync_token': sync_token(cur)}
+            cur.execute(query, values)
+            result['chats'] = list_page(cur.records(), limit, order, token)
+        return result
+    finally:
+        conn.rollback()
+
+def error_response(error: Exception) -> dict:
+    '''Исключение обработчика -> ответ: неверный ввод клиента — 400, остальное — 500 с записью в профиль'''
+    if isinstance(error, (ValueError, TypeError, psycopg2.DataError)):
+        return response(400, {'error': str(error)})
+    record_error(error)
+    return response(500, {'error': str(error)})
+
+@profiled('users')
 def handler(event: dict, context) -> dict:
     '''API для управления профилем, друзьями, черным списком'''
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return preflight('GET, POST, PUT, OPTIONS')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    ensure_listener()
+    pool = get_pool()
+    with phase('connect'):
+        conn = pool.getconn()
+    cur = conn.cursor(cursor_factory=TupleCursor)
     schema = os.environ['MAIN_DB_SCHEMA']
     
     try:
@@ -30,71 +252,80 @@ def handler(event: dict, context) -> dict:
             action = params.get('action')
             
             if action == 'stats':
-                cur.execute(f'''
-                    SELECT 
-                        (SELECT COUNT(*) FROM {schema}.friendships WHERE user_id = %s AND status = 'accepted') as friends_count,
-                        (SELECT COUNT(DISTINCT chat_id) FROM {schema}.chat_members WHERE user_id = %s 
-                         AND chat_id IN (SELECT id FROM {schema}.chats WHERE type = 'group')) as groups_count,
-                        (SELECT COUNT(DISTINCT chat_id) FROM {schema}.chat_members WHERE user_id = %s 
-                         AND chat_id IN (SELECT id FROM {schema}.chats WHERE type = 'channel')) as channels_count
-                ''', (user_id, user_id, user_id))
+                cur.execute(stats_sql(schema), (user_id,))
+                
+                stats = cur.record() or dict.fromkeys(STATS_FIELDS, 0)
+                return response(200, stats)
+            
+            elif action == 'profile':
+                # Экран профиля одним запросом: профиль, счётчики и друзья (в async-режиме — параллельно, см. aio.py)
+                user = get_user(cur, schema, user_id)
+                if not user:
+                    return response(404, {'error': 'User not found'})
                 
-                stats = dict(cur.fetchone())
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(stats),
-                    'isBase64Encoded': False
-                }
+                cur.execute(stats_sql(schema), (user_id,))
+                stats = cur.record() or dict.fromkeys(STATS_FIELDS, 0)
+                return response(200, {'user': user, 'stats': stats, 'friends': all_friends(cur, schema, user_id)})
+            
+            elif action == 'bootstrap':
+                # Всё для стартового экрана одним вызовом и одним снимком; fields=... урезает ответ
+                try:
+                    fields = bootstrap_fields(params.get('fields'))
+                except ValueError as e:
+                    return response(400, {'error': str(e)})
+                
+                result = bootstrap(conn, cur, schema, int(user_id), fields, params)
+                if result is None:
+                    return response(404, {'error': 'User not found'})
+                return response(200, result)
+            
+            elif action == 'cache_stats':
+                return response(200, snapshot())
             
             elif action == 'friends':
-                cur.execute(f'''
-                    SELECT u.id, u.nickname, u.username, u.avatar_url, u.show_online
-                    FROM {schema}.users u
-                    JOIN {schema}.friendships f ON (f.friend_id = u.id OR f.user_id = u.id)
-                    WHERE (f.user_id = %s OR f.friend_id = %s) AND f.status = 'accepted' AND u.id != %s
-                ''', (user_id, user_id, user_id))
+                if any(key in params for key in ('limit', 'cursor', 'online', 'mutual')):
+                    limit = min(int(params.get('limit') or FRIENDS_DEFAULT_LIMIT), FRIENDS_MAX_LIMIT)
+                    rows = list_friends(
+                        cur, schema, user_id, limit + 1,
+                        after_id=int(params.get('cursor') or 0),
+                        online_only=params.get('online') == '1',
+                        with_mutual=params.get('mutual') == '1'
+                    )
+                    return response(200, friends_page(rows, limit))
                 
-                friends = [dict(row) for row in cur.fetchall()]
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(friends),
-                    'isBase64Encoded': False
-                }
+                return response(200, all_friends(cur, schema, user_id))
+            
+            elif action == 'presence':
+                # Присутствие друзей пачкой: пульсы копит chats и сбрасывает в users.last_seen
+                try:
+                    user_ids = parse_ids(params.get('user_ids'))
+                except ValueError as e:
+                    return response(400, {'error': str(e)})
+                
+                return response(200, {'presence': lookup(cur, schema, user_ids)})
             
             elif action == 'blocked':
-                cur.execute(f'''
-                    SELECT u.id, u.nickname, u.username, u.avatar_url
-                    FROM {schema}.users u
-                    JOIN {schema}.blocked_users b ON b.blocked_user_id = u.id
-                    WHERE b.user_id = %s
-                ''', (user_id,))
+                cur.execute(blocked_sql(schema), (user_id,))
                 
-                blocked = [dict(row) for row in cur.fetchall()]
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(blocked),
-                    'isBase64Encoded': False
-                }
+                blocked = cur.records()
+                return response(200, blocked)
+            
+            elif action == 'search' and params.get('q'):
+                limit = min(int(params.get('limit') or SEARCH_DEFAULT_LIMIT), SEARCH_MAX_LIMIT)
+                key = (params['q'].strip().lower(), limit, params.get('cursor'))
+                result = search_cache.get(key)
+                if result is MISSING:
+                    result = search_users(cur, schema, params['q'], limit, params.get('cursor'))
+                    search_cache.set(key, result)
+                
+                return response(200, result)
             
             elif action == 'search':
                 username = params.get('username', '').strip()
-                cur.execute(f'''
-                    SELECT id, phone, nickname, username, avatar_url, banner_url, 
-                           verified, enots, is_admin, language
-                    FROM {schema}.users
-                    WHERE username = %s
-                ''', (username,))
+                cur.execute(by_username_sql(schema), (username,))
                 
-                user = cur.fetchone()
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'user': dict(user) if user else None}),
-                    'isBase64Encoded': False
-                }
+                user = cur.record()
+                return response(200, {'user': user})
         
         elif method == 'PUT':
             body = json.loads(event.get('body', '{}'))
@@ -134,75 +365,58 @@ def handler(event: dict, context) -> dict:
                               verified, enots, is_admin, language, theme
                 ''', values)
                 
-                user = dict(cur.fetchone())
-                conn.commit()
+                user = cur.record()
+                publish_invalidation(cur, 'user', user['id'])
+                commit(conn)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'user': user}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True, 'user': user})
             
             elif action == 'verify_user':
                 admin_id = body.get('admin_id')
                 target_user_id = body.get('user_id')
                 
-                cur.execute(f'SELECT is_admin FROM {schema}.users WHERE id = %s', (admin_id,))
-                is_admin = cur.fetchone()
-                
-                if not is_admin or not is_admin['is_admin']:
-                    return {
-                        'statusCode': 403,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Admin access required'}),
-                        'isBase64Encoded': False
-                    }
+                if not is_admin(cur, schema, admin_id):
+                    return response(403, {'error': 'Admin access required'})
                 
                 cur.execute(f'''
                     UPDATE {schema}.users SET verified = TRUE WHERE id = %s
                     RETURNING id, nickname, username, verified
                 ''', (target_user_id,))
                 
-                user = dict(cur.fetchone())
-                conn.commit()
+                user = cur.record()
+                publish_invalidation(cur, 'user', user['id'])
+                commit(conn)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'user': user}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True, 'user': user})
             
             elif action == 'unverify_user':
                 admin_id = body.get('admin_id')
                 target_user_id = body.get('user_id')
                 
-                cur.execute(f'SELECT is_admin FROM {schema}.users WHERE id = %s', (admin_id,))
-                is_admin = cur.fetchone()
-                
-                if not is_admin or not is_admin['is_admin']:
-                    return {
-                        'statusCode': 403,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Admin access required'}),
-                        'isBase64Encoded': False
-                    }
+                if not is_admin(cur, schema, admin_id):
+                    return response(403, {'error': 'Admin access required'})
                 
                 cur.execute(f'''
                     UPDATE {schema}.users SET verified = FALSE WHERE id = %s
                     RETURNING id, nickname, username, verified
                 ''', (target_user_id,))
                 
-                user = dict(cur.fetchone())
+                user = cur.record()
+                publish_invalidation(cur, 'user', user['id'])
+                commit(conn)
+                
+                return response(200, {'success': True, 'user': user})
+            
+            elif action == 'repair_stats':
+                if not is_admin(cur, schema, body.get('admin_id')):
+                    return response(403, {'error': 'Admin access required'})
+                
+                # Полный пересчёт user_stats: исправляет расхождения со счётчиками триггеров
+                cur.execute(f'SELECT {schema}.user_stats_repair()')
+                fixed = cur.fetchone()[0]
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'user': user}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True, 'fixed': fixed})
         
         elif method == 'POST':
             body = json.loads(event.get('body', '{}'))
@@ -219,12 +433,7 @@ def handler(event: dict, context) -> dict:
                 ''', (user_id, blocked_user_id))
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True})
             
             elif action == 'unblock':
                 blocked_user_id = body.get('blocked_user_id')
@@ -235,56 +444,41 @@ def handler(event: dict, context) -> dict:
                 ''', (user_id, blocked_user_id))
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True})
             
             elif action == 'add_friend':
                 friend_username = body.get('friend_username')
                 
                 cur.execute(f'SELECT id FROM {schema}.users WHERE username = %s', (friend_username,))
-                friend = cur.fetchone()
+                friend = cur.record()
                 
                 if not friend:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'User not found'}),
-                        'isBase64Encoded': False
-                    }
+                    return response(404, {'error': 'User not found'})
                 
                 cur.execute(f'''
                     INSERT INTO {schema}.friendships (user_id, friend_id, status)
                     VALUES (%s, %s, 'pending')
                     ON CONFLICT (user_id, friend_id) DO NOTHING
                 ''', (user_id, friend['id']))
-                conn.commit()
+                publish_invalidation(cur, 'friends', user_id)
+                publish_invalidation(cur, 'friends', friend['id'])
+                commit(conn)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+                return response(200, {'success': True})
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return response(405, {'error': 'Method not allowed'})
         
     except Exception as e:
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return error_response(e)
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        pool.putconn(conn)
+
+# Синхронный handler под своим именем: aio.py отдаёт ему действия без асинхронной версии
+sync_handler = handler
+
+# HANDLER_MODE=async: точкой входа становится асинхронный handler из aio.py
+if os.environ.get('HANDLER_MODE') == 'async':
+    import aio
+    handler = aio.handler
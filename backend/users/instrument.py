@@ -0,0 +1,275 @@
+'''Профилирование вызовов функции: фазы обработчика, каждый SQL-оператор, медленные запросы с EXPLAIN.
+
+Включается PROFILE=1 при холодном старте. Выключенный слой ничего не
+оборачивает: profiled() возвращает исходный handler, phase() — общий
+nullcontext, соединения пула создаются без подмены курсоров.
+
+Во включённом режиме после каждого вызова в stdout пишется одна JSON-строка
+(функция, action, статус, фазы, число и время запросов, медленные запросы
+с планом), а GET ?action=prometheus отдаёт накопленные метрики процесса в
+текстовом формате Prometheus.
+'''
+import contextlib
+import contextvars
+import inspect
+import json
+import os
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extensions
+
+import db
+
+ENABLED = os.environ.get('PROFILE') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+SQL_LOG_CHARS = 500
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_current = contextvars.ContextVar('speaky_profile', default=None)
+_noop = contextlib.nullcontext()
+
+
+class Profile:
+    '''Замеры одного вызова'''
+
+    def __init__(self, function: str, method: str, action: str):
+        self.function = function
+        self.method = method
+        self.action = action
+        self.phases = {}
+        self.queries = 0
+        self.query_ms = 0.0
+        self.slow = []
+        self.error = None
+
+    def add_phase(self, name: str, ms: float):
+        self.phases[name] = self.phases.get(name, 0.0) + ms
+
+
+@contextlib.contextmanager
+def _timed_phase(profile: Profile, name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(name, (time.perf_counter() - started) * 1000)
+
+
+def phase(name: str):
+    '''with phase('connect'): ... — время попадает в фазы текущего вызова'''
+    profile = _current.get() if ENABLED else None
+    return _timed_phase(profile, name) if profile is not None else _noop
+
+
+def record_error(error: Exception):
+    '''Сохраняет тип и стек исключения, которое обработчик превратил в ответ 500'''
+    profile = _current.get() if ENABLED else None
+    if profile is not None:
+        profile.error = {'type': type(error).__name__, 'message': str(error),
+                         'traceback': traceback.format_exc(limit=8)}
+
+
+def _explain(conn, query, params) -> list:
+    '''План медленного запроса отдельным курсором внутри savepoint: ошибка EXPLAIN не ломает транзакцию'''
+    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+        return None
+    cur = psycopg2.extensions.connection.cursor(conn)
+    try:
+        cur.execute('SAVEPOINT speaky_explain')
+        try:
+            cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+            plan = cur.fetchone()[0]
+            cur.execute('RELEASE SAVEPOINT speaky_explain')
+            return plan if isinstance(plan, list) else json.loads(plan)
+        except psycopg2.Error:
+            cur.execute('ROLLBACK TO SAVEPOINT speaky_explain')
+            return None
+    finally:
+        cur.close()
+
+
+def _record_query(cur, query, params, started: float):
+    profile = _current.get()
+    if profile is None:
+        return
+    ms = (time.perf_counter() - started) * 1000
+    profile.queries += 1
+    profile.query_ms += ms
+    if ms >= SLOW_QUERY_MS:
+        sql = query.decode() if isinstance(query, bytes) else query
+        profile.slow.append({'sql': ' '.join(sql.split())[:SQL_LOG_CHARS], 'ms': round(ms, 2),
+                             'plan': _explain(cur.connection, sql, params)})
+
+
+_instrumented = {}
+
+
+def instrumented_cursor(base: type) -> type:
+    '''Подкласс курсора функции, замеряющий каждый execute'''
+    if base not in _instrumented:
+        class Instrumented(base):
+            def execute(self, query, vars=None):
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    _record_query(self, query, vars, started)
+
+            def executemany(self, query, vars_list):
+                started = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    _record_query(self, query, None, started)
+
+        Instrumented.__name__ = f'Instrumented{base.__name__}'
+        _instrumented[base] = Instrumented
+    return _instrumented[base]
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+        return super().cursor(*args, cursor_factory=instrumented_cursor(base), **kwargs)
+
+
+class Metrics:
+    '''Накопительные счётчики процесса для текстового снимка Prometheus'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.phases = {}
+        self.queries = {}
+        self.slow = {}
+
+    def observe(self, profile: Profile, status: int, total_ms: float):
+        key = (profile.function, profile.action)
+        with self._lock:
+            self.requests[key + (str(status),)] = self.requests.get(key + (str(status),), 0) + 1
+            buckets, total, count = self.durations.get(key, ([0] * len(BUCKETS_MS), 0.0, 0))
+            buckets = [n + (total_ms <= le) for n, le in zip(buckets, BUCKETS_MS)]
+            self.durations[key] = (buckets, total + total_ms, count + 1)
+            for name, ms in profile.phases.items():
+                self.phases[key + (name,)] = self.phases.get(key + (name,), 0.0) + ms
+            count_q, ms_q = self.queries.get(key, (0, 0.0))
+            self.queries[key] = (count_q + profile.queries, ms_q + profile.query_ms)
+            if profile.slow:
+                self.slow[key] = self.slow.get(key, 0) + len(profile.slow)
+
+    def prometheus(self) -> str:
+        def labels(function, action, **extra) -> str:
+            pairs = {'function': function, 'action': action or 'none', **extra}
+            return ','.join(f'{k}="{v}"' for k, v in pairs.items())
+
+        lines = ['# TYPE speaky_requests_total counter']
+        with self._lock:
+            for (function, action, status), n in sorted(self.requests.items()):
+                lines.append(f'speaky_requests_total{{{labels(function, action, status=status)}}} {n}')
+            lines.append('# TYPE speaky_request_duration_seconds histogram')
+            for (function, action), (buckets, total, count) in sorted(self.durations.items()):
+                for le, n in zip(BUCKETS_MS, buckets):
+                    lines.append(f'speaky_request_duration_seconds_bucket'
+                                 f'{{{labels(function, action, le=le / 1000)}}} {n}')
+                lines.append(f'speaky_request_duration_seconds_bucket{{{labels(function, action, le="+Inf")}}} {count}')
+                lines.append(f'speaky_request_duration_seconds_sum{{{labels(function, action)}}} {total / 1000:.6f}')
+                lines.append(f'speaky_request_duration_seconds_count{{{labels(function, action)}}} {count}')
+            lines.append('# TYPE speaky_phase_seconds_total counter')
+            for (function, action, name), ms in sorted(self.phases.items()):
+                lines.append(f'speaky_phase_seconds_total{{{labels(function, action, phase=name)}}} {ms / 1000:.6f}')
+            lines.append('# TYPE speaky_sql_queries_total counter')
+            lines.append('# TYPE speaky_sql_seconds_total counter')
+            for (function, action), (count, ms) in sorted(self.queries.items()):
+                lines.append(f'speaky_sql_queries_total{{{labels(function, action)}}} {count}')
+                lines.append(f'speaky_sql_seconds_total{{{labels(function, action)}}} {ms / 1000:.6f}')
+            lines.append('# TYPE speaky_slow_queries_total counter')
+            for (function, action), n in sorted(self.slow.items()):
+                lines.append(f'speaky_slow_queries_total{{{labels(function, action)}}} {n}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def _action(event: dict) -> str:
+    action = (event.get('queryStringParameters') or {}).get('action')
+    if action or event.get('httpMethod') == 'GET':
+        return action or ''
+    try:
+        return json.loads(event.get('body') or '{}').get('action') or ''
+    except (ValueError, AttributeError):
+        return ''
+
+
+def _prometheus_response() -> dict:
+    return {'statusCode': 200, 'headers': {'Content-Type': 'text/plain; version=0.0.4'},
+            'body': metrics.prometheus(), 'isBase64Encoded': False}
+
+
+def _finish(function: str, profile: Profile, token, started: float, status: int):
+    '''Итог вызова: метрики процесса и JSON-строка в stdout'''
+    total_ms = (time.perf_counter() - started) * 1000
+    _current.reset(token)
+    profile.add_phase('query', profile.query_ms)
+    metrics.observe(profile, status, total_ms)
+    print(json.dumps({
+        'event': 'request', 'function': function, 'method': profile.method, 'action': profile.action,
+        'status': status, 'ms': round(total_ms, 2),
+        'phases': {name: round(ms, 2) for name, ms in profile.phases.items()},
+        'queries': profile.queries, 'slow_queries': profile.slow, 'error': profile.error
+    }, ensure_ascii=False, default=str), flush=True)
+
+
+def profiled(function: str):
+    '''Декоратор handler облачной функции, в том числе async; выключенный возвращает handler как есть'''
+    def wrap(fn):
+        if not ENABLED:
+            return fn
+
+        if inspect.iscoroutinefunction(fn):
+            async def instrumented(event: dict, context):
+                profile = Profile(function, event.get('httpMethod', 'GET'), _action(event))
+                if profile.method == 'GET' and profile.action == 'prometheus':
+                    return _prometheus_response()
+                token = _current.set(profile)
+                started = time.perf_counter()
+                status = 500
+                try:
+                    result = await fn(event, context)
+                    status = result.get('statusCode', 200)
+                    return result
+                except Exception as e:
+                    record_error(e)
+                    raise
+                finally:
+                    _finish(function, profile, token, started, status)
+        else:
+            def instrumented(event: dict, context):
+                profile = Profile(function, event.get('httpMethod', 'GET'), _action(event))
+                if profile.method == 'GET' and profile.action == 'prometheus':
+                    return _prometheus_response()
+                token = _current.set(profile)
+                started = time.perf_counter()
+                status = 500
+                try:
+                    result = fn(event, context)
+                    status = result.get('statusCode', 200)
+                    return result
+                except Exception as e:
+                    record_error(e)
+                    raise
+                finally:
+                    _finish(function, profile, token, started, status)
+
+        instrumented.__wrapped__ = fn
+        instrumented.__doc__ = fn.__doc__
+        return instrumented
+    return wrap
+
+
+if ENABLED:
+    db.connection_factory = InstrumentedConnection
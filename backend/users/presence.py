@@ -0,0 +1,46 @@
+'''Чтение присутствия для функции users: users.last_seen (V0015) и show_online.
+
+Пульсы принимает и пишет в БД функция chats (PresenceStore в её presence.py);
+здесь те же помощники чтения без хранилища процесса — в users пульсов нет.
+Время скрыто у тех, кто выключил show_online.
+'''
+import os
+from datetime import datetime, timedelta, timezone
+
+ONLINE_WINDOW = timedelta(seconds=float(os.environ.get('PRESENCE_ONLINE_WINDOW', '60')))
+PRESENCE_MAX_IDS = 500
+
+
+def parse_ids(raw: str) -> list:
+    '''user_ids=1,2,3 без повторов, не больше PRESENCE_MAX_IDS'''
+    ids = list(dict.fromkeys(int(part) for part in (raw or '').split(',') if part.strip()))
+    if len(ids) > PRESENCE_MAX_IDS:
+        raise ValueError(f'user_ids must contain at most {PRESENCE_MAX_IDS} items')
+    return ids
+
+
+def lookup_sql(schema: str) -> str:
+    return f'SELECT id, show_online, last_seen FROM {schema}.users WHERE id = ANY(%s)'
+
+
+def presence_of(rows: list, local: dict = None) -> list:
+    '''Строки (id, show_online, last_seen) из БД и пульсы процесса {id: время} -> [{id, online, last_seen}]'''
+    local = local or {}
+    now = datetime.now(timezone.utc)
+    result = []
+    for user_id, show_online, last_seen in rows:
+        if show_online is False:
+            result.append({'id': user_id, 'online': False, 'last_seen': None})
+            continue
+        last_seen = max(filter(None, (last_seen, local.get(user_id))), default=None)
+        result.append({'id': user_id, 'online': bool(last_seen and now - last_seen < ONLINE_WINDOW),
+                       'last_seen': last_seen})
+    return result
+
+
+def lookup(cur, schema: str, user_ids: list) -> list:
+    '''Присутствие пачки пользователей одним запросом: [{id, online, last_seen}]'''
+    if not user_ids:
+        return []
+    cur.execute(lookup_sql(schema), (user_ids,))
+    return presence_of(cur.fetchall())
@@ -0,0 +1,93 @@
+'''Общее ядро ответов функций: JSON-кодирование, неизменяемые заголовки и курсор со строками-кортежами.
+
+Функции деплоятся по отдельности, поэтому копия модуля лежит в каждой
+(как db.py). orjson используется, если установлен; без него тот же вывод
+даёт стандартный json.
+'''
+import datetime
+import decimal
+import json
+
+import psycopg2.extensions
+
+from instrument import phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FrozenHeaders(dict):
+    '''Один экземпляр заголовков на все ответы процесса; дополнять копией {**headers, ...}'''
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('shared response headers are read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+JSON_HEADERS = FrozenHeaders({'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'})
+
+_preflights = {}
+
+
+def preflight(methods: str, headers: str = 'Content-Type') -> dict:
+    '''Ответ на OPTIONS; собирается один раз на набор методов и заголовков запроса'''
+    if (methods, headers) not in _preflights:
+        _preflights[methods, headers] = FrozenHeaders({
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': headers
+        })
+    return raw_response(200, '', _preflights[methods, headers])
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    return str(obj)
+
+
+def dumps(payload) -> str:
+    '''JSON тела ответа; datetime — ISO 8601 в обоих режимах'''
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default).decode()
+    return json.dumps(payload, default=_default)
+
+
+def raw_response(status: int, body: str, headers: dict = JSON_HEADERS) -> dict:
+    '''Ответ с уже собранным телом: JSON, склеенный по частям, или пустое тело 304'''
+    return {'statusCode': status, 'headers': headers, 'body': body, 'isBase64Encoded': False}
+
+
+def response(status: int, payload, headers: dict = JSON_HEADERS) -> dict:
+    with phase('serialize'):
+        body = dumps(payload)
+    return raw_response(status, body, headers)
+
+
+class TupleCursor(psycopg2.extensions.cursor):
+    '''Строки остаются кортежами, которые psycopg2 строит в C; имена колонок — через columns.
+
+    record()/records() собирают dict один раз на строку (zip по именам колонок)
+    вместо RealDictRow с последующим dict(row).
+    '''
+
+    @property
+    def columns(self) -> dict:
+        '''{имя колонки: индекс в кортеже} для текущего результата'''
+        return {column[0]: index for index, column in enumerate(self.description)}
+
+    def record(self):
+        row = self.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in self.description], row))
+
+    def records(self, rows: list = None) -> list:
+        '''Строки результата (или уже полученные rows того же запроса) как список dict'''
+        names = [column[0] for column in self.description]
+        return [dict(zip(names, row)) for row in (self.fetchall() if rows is None else rows)]
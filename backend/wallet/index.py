@@ -0,0 +1,195 @@
+import json
+import os
+
+import psycopg2.errors
+
+from cache import commit, ensure_listener
+from db import get_pool
+from instrument import phase, profiled, record_error
+from ledger import GIFTS, MAX_AMOUNT, MAX_RECIPIENTS, InsufficientFunds, UnknownUsers, find_missing, transfer
+from runtime import TupleCursor, preflight, response
+
+HISTORY_DEFAULT_LIMIT = 50
+HISTORY_MAX_LIMIT = 200
+
+def parse_recipients(body: dict, sender_id: int) -> list:
+    '''recipient_ids (или один recipient_id) без повторов; отправитель сам себе не дарит'''
+    raw = body.get('recipient_ids')
+    if raw is None and body.get('recipient_id') is not None:
+        raw = [body['recipient_id']]
+    if not isinstance(raw, list) or not 1 <= len(raw) <= MAX_RECIPIENTS:
+        raise ValueError(f'recipient_ids must contain 1..{MAX_RECIPIENTS} items')
+    recipients = list(dict.fromkeys(int(user_id) for user_id in raw))
+    if sender_id in recipients:
+        raise ValueError('Cannot send to yourself')
+    return recipients
+
+def parse_amount(value) -> int:
+    amount = int(value or 0)
+    if not 0 < amount <= MAX_AMOUNT:
+        raise ValueError(f'amount must be in 1..{MAX_AMOUNT}')
+    return amount
+
+def parse_gift(value) -> int:
+    gift_id = int(value or 0)
+    if gift_id not in GIFTS:
+        raise ValueError('Unknown gift_id')
+    return gift_id
+
+@profiled('wallet')
+def handler(event: dict, context) -> dict:
+    '''API кошелька: баланс, история, пополнение, покупка и подарки енотиков'''
+    method = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return preflight('GET, POST, OPTIONS')
+    
+    ensure_listener()
+    pool = get_pool()
+    with phase('connect'):
+        conn = pool.getconn()
+    cur = conn.cursor(cursor_factory=TupleCursor)
+    schema = os.environ['MAIN_DB_SCHEMA']
+    
+    try:
+        if method == 'GET':
+            params = event.get('queryStringParameters', {}) or {}
+            action = params.get('action')
+            user_id = params.get('user_id')
+            
+            if action == 'balance':
+                # Баланс не кешируется: после списания клиент должен видеть новое значение
+                cur.execute(f'SELECT id, enots FROM {schema}.users WHERE id = %s', (user_id,))
+                balance = cur.record()
+                if not balance:
+                    return response(404, {'error': 'User not found'})
+                return response(200, balance)
+            
+            elif action == 'transactions':
+                limit = min(int(params.get('limit') or HISTORY_DEFAULT_LIMIT), HISTORY_MAX_LIMIT)
+                cursor = params.get('cursor')
+                cur.execute(f'''
+                    SELECT id, type, amount, description, transfer_id, created_at
+                    FROM {schema}.transactions
+                    WHERE user_id = %s AND (%s::int IS NULL OR id < %s)
+                    ORDER BY id DESC
+                    LIMIT %s
+                ''', (user_id, cursor, cursor, limit + 1))
+                
+                rows = cur.records()
+                next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+                return response(200, {'transactions': rows[:limit], 'next_cursor': next_cursor})
+            
+            elif action == 'catalog':
+                gifts = [{'id': gift_id, 'emoji': emoji, 'name': name, 'price': price}
+                         for gift_id, (emoji, name, price) in GIFTS.items()]
+                return response(200, gifts)
+            
+            elif action == 'reconcile':
+                cur.execute(f'SELECT is_admin FROM {schema}.users WHERE id = %s', (params.get('admin_id'),))
+                admin = cur.fetchone()
+                
+                if not admin or not admin[0]:
+                    return response(403, {'error': 'Admin access required'})
+                
+                # Балансы, разошедшиеся с журналом, и сумма всех проводок (должна быть 0)
+                cur.execute(f'SELECT user_id, enots, ledger FROM {schema}.wallet_discrepancies()')
+                discrepancies = cur.records()
+                cur.execute(f'SELECT COALESCE(SUM(amount), 0) FROM {schema}.wallet_ledger')
+                total = cur.fetchone()[0]
+                
+                return response(200, {'discrepancies': discrepancies, 'ledger_total': total})
+        
+        elif method == 'POST':
+            body = json.loads(event.get('body', '{}'))
+            action = body.get('action')
+            key = body.get('idempotency_key')
+            
+            if action == 'topup':
+                admin_id = body.get('admin_id')
+                cur.execute(f'SELECT is_admin FROM {schema}.users WHERE id = %s', (admin_id,))
+                admin = cur.fetchone()
+                
+                if not admin or not admin[0]:
+                    return response(403, {'error': 'Admin access required'})
+                
+                user_id = int(body.get('user_id'))
+                amount = parse_amount(body.get('amount'))
+                result = transfer(
+                    cur, schema, 'topup', int(admin_id), key, {user_id: amount},
+                    [(user_id, 'topup', amount, body.get('description') or 'Пополнение')],
+                    system_account='issuance', account_id=user_id
+                )
+                commit(conn)
+                
+                return response(200, result)
+            
+            elif action == 'purchase':
+                user_id = int(body.get('user_id'))
+                gift_id = parse_gift(body.get('gift_id'))
+                emoji, name, price = GIFTS[gift_id]
+                result = transfer(
+                    cur, schema, 'purchase', user_id, key, {user_id: -price},
+                    [(user_id, 'purchase', price, f'{emoji} {name}')],
+                    system_account='shop', gift=(gift_id, [user_id])
+                )
+                commit(conn)
+                
+                return response(200, result)
+            
+            elif action == 'send_gift':
+                # Подарок многим получателям: одно списание price × N и N подарков в одной транзакции
+                user_id = int(body.get('user_id'))
+                gift_id = parse_gift(body.get('gift_id'))
+                recipients = parse_recipients(body, user_id)
+                missing = find_missing(cur, schema, recipients)
+                if missing:
+                    return response(404, {'error': 'Users not found', 'user_ids': missing})
+                
+                emoji, name, price = GIFTS[gift_id]
+                total = price * len(recipients)
+                result = transfer(
+                    cur, schema, 'gift', user_id, key, {user_id: -total},
+                    [(user_id, 'gift_sent', total, f'{emoji} {name} × {len(recipients)}')],
+                    system_account='shop', gift=(gift_id, recipients, user_id)
+                )
+                commit(conn)
+                
+                return response(200, {**result, 'recipients': len(recipients)})
+            
+            elif action == 'transfer':
+                # Енотики многим получателям: amount каждому, списание amount × N
+                user_id = int(body.get('user_id'))
+                amount = parse_amount(body.get('amount'))
+                recipients = parse_recipients(body, user_id)
+                deltas = {user_id: -amount * len(recipients), **dict.fromkeys(recipients, amount)}
+                description = body.get('description') or 'Перевод енотиков'
+                history = [(user_id, 'gift_sent', amount * len(recipients), description)]
+                history += [(recipient_id, 'gift_received', amount, description) for recipient_id in recipients]
+                result = transfer(cur, schema, 'transfer', user_id, key, deltas, history)
+                commit(conn)
+                
+                return response(200, {**result, 'recipients': len(recipients)})
+        
+        return response(400, {'error': 'Invalid action'})
+    
+    except ValueError as e:
+        conn.rollback()
+        return response(400, {'error': str(e)})
+    except InsufficientFunds:
+        conn.rollback()
+        return response(402, {'error': 'Insufficient funds'})
+    except UnknownUsers as e:
+        conn.rollback()
+        return response(404, {'error': 'Users not found', 'user_ids': e.user_ids})
+    except psycopg2.errors.ForeignKeyViolation:
+        # Инициатор перевода не существует
+        conn.rollback()
+        return response(404, {'error': 'User not found'})
+    except Exception as e:
+        record_error(e)
+        conn.rollback()
+        return response(500, {'error': str(e)})
+    finally:
+        cur.close()
+        pool.putconn(conn)
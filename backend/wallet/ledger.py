@@ -0,0 +1,159 @@
+'''Движения енотиков (V0014): баланс в users.enots, двойная запись в wallet_ledger.
+
+Перевод выполняется в транзакции вызывающего кода в таком порядке:
+1. claim() — строка wallet_transfers с ключом идемпотентности. Повтор с тем же
+   ключом ждёт на уникальном индексе, пока первый запрос не завершится, и после
+   его COMMIT получает уже записанный перевод вместо второго списания.
+2. apply_deltas() — балансы меняются одним UPDATE с условием enots + delta >= 0.
+   Если счетов несколько, строки users сначала блокируются в порядке id, так что
+   встречные переводы не взаимоблокируются. Строка отправителя заблокирована
+   до COMMIT, поэтому параллельные списания с одного счёта не теряются.
+3. Проводки, история transactions и подарки пишутся по одному оператору на
+   таблицу, сколько бы ни было получателей: триггеры user_stats и проверка
+   баланса проводок срабатывают один раз.
+'''
+from cache import publish_invalidations
+
+# Каталог магазина (цены в енотиках); клиент присылает только gift_id
+GIFTS = {
+    1: ('🎁', 'Подарок', 100),
+    2: ('🌹', 'Роза', 50),
+    3: ('🎂', 'Торт', 150),
+    4: ('🎈', 'Шарик', 30),
+    5: ('💎', 'Бриллиант', 500),
+    6: ('👑', 'Корона', 300),
+    7: ('🏆', 'Кубок', 200),
+    8: ('⭐', 'Звезда', 80),
+    9: ('🔥', 'Огонь', 120),
+    10: ('💝', 'Сердце', 90),
+    11: ('🎵', 'Музыка', 60),
+    12: ('🍕', 'Пицца', 70)
+}
+
+MAX_RECIPIENTS = 1000
+MAX_AMOUNT = 1_000_000
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+class UnknownUsers(Exception):
+    def __init__(self, user_ids: list):
+        super().__init__(f'Users not found: {user_ids}')
+        self.user_ids = user_ids
+
+
+def claim(cur, schema: str, kind: str, initiator_id: int, idempotency_key: str, amount: int):
+    '''id нового перевода или None, если перевод с этим ключом уже проведён'''
+    cur.execute(f'''
+        INSERT INTO {schema}.wallet_transfers (kind, initiator_id, idempotency_key, amount)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (initiator_id, idempotency_key) WHERE idempotency_key IS NOT NULL DO NOTHING
+        RETURNING id
+    ''', (kind, initiator_id, idempotency_key, amount))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def replay(cur, schema: str, initiator_id: int, idempotency_key: str, account_id: int) -> dict:
+    '''Ответ на повтор: уже проведённый перевод и текущий баланс account_id'''
+    cur.execute(f'''
+        SELECT t.id, t.kind, t.amount, u.enots
+        FROM {schema}.wallet_transfers t
+        JOIN {schema}.users u ON u.id = %s
+        WHERE t.initiator_id = %s AND t.idempotency_key = %s
+    ''', (account_id, initiator_id, idempotency_key))
+    transfer_id, kind, amount, enots = cur.fetchone()
+    return {'success': True, 'duplicate': True, 'transfer_id': transfer_id, 'kind': kind,
+            'amount': amount, 'enots': enots}
+
+
+def find_missing(cur, schema: str, user_ids: list) -> list:
+    cur.execute(f'SELECT id FROM {schema}.users WHERE id = ANY(%s)', (user_ids,))
+    found = {user_id for user_id, in cur.fetchall()}
+    return [user_id for user_id in user_ids if user_id not in found]
+
+
+def apply_deltas(cur, schema: str, deltas: dict) -> dict:
+    '''Меняет балансы {user_id: delta}; возвращает {user_id: новый баланс}'''
+    ids = sorted(deltas)
+    if len(ids) > 1:
+        # FOR NO KEY UPDATE не мешает внешним ключам на users (KEY SHARE) из других транзакций
+        cur.execute(f'''
+            SELECT id FROM {schema}.users WHERE id = ANY(%s) ORDER BY id FOR NO KEY UPDATE
+        ''', (ids,))
+        found = {user_id for user_id, in cur.fetchall()}
+        if len(found) < len(ids):
+            raise UnknownUsers([user_id for user_id in ids if user_id not in found])
+
+    cur.execute(f'''
+        UPDATE {schema}.users u SET enots = u.enots + d.delta
+        FROM unnest(%s::int[], %s::int[]) AS d(id, delta)
+        WHERE u.id = d.id AND u.enots + d.delta >= 0
+        RETURNING u.id, u.enots
+    ''', (ids, [deltas[user_id] for user_id in ids]))
+    balances = dict(cur.fetchall())
+    if len(balances) < len(ids):
+        if len(ids) == 1 and find_missing(cur, schema, ids):
+            raise UnknownUsers(ids)
+        raise InsufficientFunds()
+    return balances
+
+
+def post(cur, schema: str, transfer_id: int, deltas: dict, system_account: str = None):
+    '''Проводки перевода: по счёту на пользователя, остаток — на системный счёт'''
+    accounts = ['user'] * len(deltas)
+    user_ids = list(deltas)
+    amounts = list(deltas.values())
+    if system_account:
+        accounts.append(system_account)
+        user_ids.append(None)
+        amounts.append(-sum(amounts))
+    cur.execute(f'''
+        INSERT INTO {schema}.wallet_ledger (transfer_id, account, user_id, amount)
+        SELECT %s, e.account, e.user_id, e.amount
+        FROM unnest(%s::varchar[], %s::int[], %s::bigint[]) AS e(account, user_id, amount)
+    ''', (transfer_id, accounts, user_ids, amounts))
+
+
+def record_history(cur, schema: str, transfer_id: int, entries: list):
+    '''Строки transactions (user_id, type, amount, description) одним оператором'''
+    user_ids, types, amounts, descriptions = (list(column) for column in zip(*entries))
+    cur.execute(f'''
+        INSERT INTO {schema}.transactions (user_id, type, amount, description, transfer_id)
+        SELECT h.user_id, h.type, h.amount, h.description, %s
+        FROM unnest(%s::int[], %s::varchar[], %s::int[], %s::text[]) AS h(user_id, type, amount, description)
+    ''', (transfer_id, user_ids, types, amounts, descriptions))
+
+
+def grant_gifts(cur, schema: str, gift_id: int, recipient_ids: list, from_user_id: int = None):
+    emoji, name, _ = GIFTS[gift_id]
+    cur.execute(f'''
+        INSERT INTO {schema}.user_gifts (user_id, gift_emoji, gift_name, from_user_id)
+        SELECT recipient_id, %s, %s, %s FROM unnest(%s::int[]) recipient_id
+    ''', (emoji, name, from_user_id, recipient_ids))
+
+
+def transfer(cur, schema: str, kind: str, initiator_id: int, idempotency_key: str, deltas: dict,
+             history: list, system_account: str = None, gift: tuple = None, account_id: int = None) -> dict:
+    '''Проводит перевод целиком; COMMIT остаётся за вызывающим кодом.
+
+    gift — (gift_id, получатели, от кого) для подарков, выдаваемых этим же переводом;
+    в ответе баланс account_id (по умолчанию инициатора).
+    '''
+    account_id = account_id or initiator_id
+    amount = sum(delta for delta in deltas.values() if delta > 0) or -sum(deltas.values())
+    transfer_id = claim(cur, schema, kind, initiator_id, idempotency_key, amount)
+    if transfer_id is None:
+        return replay(cur, schema, initiator_id, idempotency_key, account_id)
+
+    balances = apply_deltas(cur, schema, deltas)
+    post(cur, schema, transfer_id, deltas, system_account)
+    record_history(cur, schema, transfer_id, history)
+    if gift:
+        grant_gifts(cur, schema, *gift)
+    # Профили с балансом кешируют users и auth
+    publish_invalidations(cur, 'user', sorted(deltas))
+    return {'success': True, 'transfer_id': transfer_id, 'kind': kind, 'amount': amount,
+            'enots': balances[account_id]}
@@ -0,0 +1,125 @@
+'''Общие помощники для бенчмарков backend-функций на локальном PostgreSQL'''
+import atexit
+import importlib
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+import psycopg2
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKEND = ROOT / 'backend'
+MIGRATIONS = ROOT / 'db_migrations'
+
+
+def load_modules(function: str) -> dict:
+    '''Импортирует backend/<function>/index.py изолированно от других функций.
+
+    У каждой функции свои index.py и db.py, поэтому после импорта их модули
+    убираются из sys.modules, чтобы следующая функция получила свои копии.
+    Возвращает модули этой функции по имени ('index', 'db', ...).
+    '''
+    path = str(BACKEND / function)
+    before = set(sys.modules)
+    sys.path.insert(0, path)
+    modules = {}
+    try:
+        importlib.import_module('index')
+    finally:
+        sys.path.remove(path)
+        for name in set(sys.modules) - before:
+            file = getattr(sys.modules[name], '__file__', None) or ''
+            if file.startswith(path):
+                modules[name] = sys.modules.pop(name)
+    return modules
+
+
+def load_function(function: str):
+    return load_modules(function)['index']
+
+
+def load_handler(function: str):
+    return load_function(function).handler
+
+
+def start_local_s3(port: int = 5055) -> None:
+    '''Поднимает moto server, если S3_ENDPOINT_URL не задан (pip install "moto[server]")'''
+    if os.environ.get('S3_ENDPOINT_URL'):
+        return
+    # Отдельный процесс: moto хранит объекты в памяти, и в том же процессе они попали бы в замеры
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    atexit.register(server.terminate)
+    os.environ['S3_ENDPOINT_URL'] = f'http://127.0.0.1:{port}'
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    for _ in range(50):
+        try:
+            urllib.request.urlopen(os.environ['S3_ENDPOINT_URL'])
+            return
+        except OSError:
+            time.sleep(0.2)
+
+
+def connect():
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def schema() -> str:
+    return os.environ.setdefault('MAIN_DB_SCHEMA', 'public')
+
+
+def apply_migrations(conn):
+    '''Накатывает db_migrations/V*.sql в MAIN_DB_SCHEMA (для чистой локальной базы)'''
+    with conn.cursor() as cur:
+        cur.execute(f'CREATE SCHEMA IF NOT EXISTS {schema()}')
+        cur.execute(f'SET search_path TO {schema()}')
+        cur.execute('CREATE TABLE IF NOT EXISTS bench_applied_migrations (name TEXT PRIMARY KEY)')
+        cur.execute('SELECT name FROM bench_applied_migrations')
+        applied = {row[0] for row in cur.fetchall()}
+        for migration in sorted(MIGRATIONS.glob('V*.sql')):
+            if migration.name in applied:
+                continue
+            cur.execute(migration.read_text())
+            cur.execute('INSERT INTO bench_applied_migrations (name) VALUES (%s)', (migration.name,))
+        cur.execute('RESET search_path')
+    conn.commit()
+
+
+def ensure_user(cur, phone: str = '+70000000001', nickname: str = 'bench') -> int:
+    cur.execute(f'''
+        INSERT INTO {schema()}.users (phone, nickname, username)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (phone) DO UPDATE SET nickname = EXCLUDED.nickname
+        RETURNING id
+    ''', (phone, nickname, f'@{nickname}'))
+    return cur.fetchone()[0]
+
+
+def create_chat(cur, name: str, user_id: int, chat_type: str = 'group') -> int:
+    cur.execute(f'''
+        INSERT INTO {schema()}.chats (type, name, created_by) VALUES (%s, %s, %s) RETURNING id
+    ''', (chat_type, name, user_id))
+    return cur.fetchone()[0]
+
+
+def percentile(samples: list, p: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def report(title: str, samples_ms: list):
+    print(f'{title:<40} n={len(samples_ms):<6} '
+          f'p50={percentile(samples_ms, 50):8.2f}ms '
+          f'p95={percentile(samples_ms, 95):8.2f}ms '
+          f'p99={percentile(samples_ms, 99):8.2f}ms')
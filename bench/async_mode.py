@@ -0,0 +1,152 @@
+'''Синхронный и асинхронный режимы chats и users (HANDLER_MODE) под высокой конкурентностью.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/async_mode.py --concurrency 64,256,1024 --seconds 20
+
+Поднимает bench/devserver.py дважды — --mode sync и --mode async — с одним и
+тем же числом соединений к БД (--connections уходит и в DB_POOL_MAX_SIZE, и
+в ASYNC_POOL_MAX_SIZE). Сначала сверяет ответы режимов на одни и те же чтения
+(list целиком, страницей и дельтой, members, presence, stats, profile,
+friends, blocked, search): статус, тело и ETag должны совпасть. Затем на
+каждой конкурентности гоняет смесь запросов load.py против обоих стендов
+по очереди и печатает rps и p50/p99 по сценариям рядом.
+
+Пользователи и чаты берутся из базы, как в load.py (например, после bench/seed.py).
+'''
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from urllib.parse import urlencode
+
+from _common import percentile, start_local_s3
+from load import Sample, measure, parse_mix, scenarios
+
+BENCH = Path(__file__).resolve().parent
+MODES = ('sync', 'async')
+# Токен дельты — xmin снимка на момент запроса, от режима он не зависит, но между двумя запросами может сдвинуться
+VOLATILE = ('sync_token',)
+
+
+def start(mode: str, port: int, connections: int) -> str:
+    env = {**os.environ, 'DB_POOL_MAX_SIZE': str(connections), 'ASYNC_POOL_MAX_SIZE': str(connections)}
+    server = subprocess.Popen([sys.executable, str(BENCH / 'devserver.py'), '--mode', mode, '--port', str(port)],
+                              env=env, stdout=subprocess.DEVNULL)
+    atexit.register(server.terminate)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'{url}/__stats')
+            return url
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit(f'devserver --mode {mode} exited with {server.returncode}')
+            time.sleep(0.2)
+    raise SystemExit(f'devserver --mode {mode} did not start on {url}')
+
+
+def get(url: str, function: str, query: dict) -> tuple:
+    try:
+        with urllib.request.urlopen(f'{url}/{function}?{urlencode(query)}') as reply:
+            status, headers, body = reply.status, reply.headers, reply.read()
+    except urllib.error.HTTPError as e:
+        status, headers, body = e.code, e.headers, e.read()
+    payload = json.loads(body) if body else None
+    if isinstance(payload, dict):
+        payload = {key: value for key, value in payload.items() if key not in VOLATILE}
+    return status, headers.get('ETag'), payload
+
+
+def parity_requests(sample: Sample, count: int) -> list:
+    requests = []
+    for _ in range(count):
+        user_id, _, nickname, chat_id = sample.pick()
+        requests += [
+            ('chats', {'action': 'list', 'user_id': user_id}),
+            ('chats', {'action': 'list', 'user_id': user_id, 'order': 'activity', 'limit': 5}),
+            ('chats', {'action': 'list', 'user_id': user_id, 'since': 1}),
+            ('chats', {'action': 'members', 'chat_id': chat_id}),
+            ('chats', {'action': 'presence', 'user_ids': user_id, 'chat_id': chat_id}),
+            ('users', {'action': 'stats', 'user_id': user_id}),
+            ('users', {'action': 'profile', 'user_id': user_id}),
+            ('users', {'action': 'friends', 'user_id': user_id}),
+            ('users', {'action': 'friends', 'user_id': user_id, 'limit': 10, 'mutual': 1}),
+            ('users', {'action': 'blocked', 'user_id': user_id}),
+            ('users', {'action': 'search', 'q': nickname[:4]})
+        ]
+    return requests
+
+
+def check_parity(urls: dict, requests: list):
+    '''Оба режима отвечают одинаково; следующая страница списка — по курсору из ответа'''
+    for function, query in requests:
+        replies = {mode: get(url, function, query) for mode, url in urls.items()}
+        assert replies['sync'] == replies['async'], f'{function} {query}: {replies}'
+        status, _, payload = replies['sync']
+        assert status == 200, f'{function} {query}: {status} {payload}'
+        if isinstance(payload, dict) and payload.get('next_cursor') and query.get('action') == 'list':
+            follow = {**query, 'cursor': payload['next_cursor']}
+            replies = {mode: get(url, function, follow) for mode, url in urls.items()}
+            assert replies['sync'] == replies['async'], f'{function} {follow}: {replies}'
+    print(f'parity: {len(requests)} requests answered identically by both modes')
+
+
+def compare(results: dict, seconds: float):
+    print(f'{"scenario":<12} ' + ' '.join(f'{mode + " rps":>10} {"p50":>7} {"p99":>8} {"err":>5}' for mode in MODES))
+    names = sorted(results['sync'].latencies, key=lambda name: -len(results['sync'].latencies[name]))
+    for name in [*names, 'total']:
+        cells = []
+        for mode in MODES:
+            run = results[mode]
+            if name == 'total':
+                samples = [ms for values in run.latencies.values() for ms in values]
+                errors = sum(run.errors.values())
+            else:
+                samples, errors = run.latencies.get(name, []), run.errors.get(name, 0)
+            if not samples:
+                cells.append(f'{"-":>10} {"-":>7} {"-":>8} {"-":>5}')
+                continue
+            cells.append(f'{len(samples) / seconds:>10.1f} {percentile(samples, 50):>7.2f} '
+                         f'{percentile(samples, 99):>8.2f} {errors:>5}')
+        print(f'{name:<12} ' + ' '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', default='64,256,1024', help='уровни конкурентности через запятую')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--connections', type=int, default=20, help='соединений к БД на функцию в каждом режиме')
+    parser.add_argument('--port', type=int, default=8100, help='sync на --port, async на --port + 1')
+    parser.add_argument('--sample', type=int, default=5000)
+    parser.add_argument('--parity', type=int, default=30, help='сколько пользователей сверить между режимами')
+    parser.add_argument('--mix', default='list=25,members=15,presence=10,stats=10,profile=15,friends=10,'
+                                         'user_search=10,send=5')
+    args = parser.parse_args()
+
+    # Один moto server на оба стенда: каждый devserver иначе поднимал бы свой на том же порту
+    start_local_s3()
+    urls = {mode: start(mode, args.port + index, args.connections) for index, mode in enumerate(MODES)}
+    sample = Sample(args.sample)
+    check_parity(urls, parity_requests(sample, args.parity))
+
+    build = scenarios(sample)
+    mix = parse_mix(args.mix)
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        results = {}
+        for mode, url in urls.items():
+            results[mode] = asyncio.run(measure(url, build, mix, concurrency, args.seconds, args.warmup))
+        stats = {mode: json.loads(urllib.request.urlopen(f'{url}/__stats').read()) for mode, url in urls.items()}
+        print(f'\nconcurrency={concurrency} seconds={args.seconds} connections={args.connections} '
+              f'(sync pool waits: chats {stats["sync"]["chats"]["waits"]}, users {stats["sync"]["users"]["waits"]})')
+        compare(results, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
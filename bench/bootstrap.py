@@ -0,0 +1,168 @@
+'''Бенчмарк users?action=bootstrap против стартового веера запросов клиента.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/bootstrap.py --migrate --friends 300 --chats 200
+
+Создаёт пользователя с --friends друзьями, --blocked заблокированными и
+--chats чатами. Печатает p50/p99 веера (users stats, friends, blocked и
+chats list первой страницей — четыре вызова и четыре соединения из пулов)
+против одного bootstrap, размер ответа с fields и без, и проверяет, что
+первая страница чатов в bootstrap совпадает с chats?action=list. Затем
+--threads потоков переключают дружбы, пока основной поток зовёт bootstrap:
+в одном снимке friends_count всегда равен длине friends.
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+import psycopg2.errors
+
+from _common import apply_migrations, connect, ensure_user, load_modules, report, schema, timed
+
+FAN_OUT = (
+    ('users', {'action': 'stats'}),
+    ('users', {'action': 'friends'}),
+    ('users', {'action': 'blocked'}),
+    ('chats', {'action': 'list', 'limit': '20'})
+)
+
+
+def seed(conn, friends: int, blocked: int, chats: int) -> tuple:
+    s = schema()
+    prefix = uuid.uuid4().hex[:6]
+    with conn.cursor() as cur:
+        user_id = ensure_user(cur, f'+7b{prefix}', f'bench-bootstrap-{prefix}')
+        cur.execute(f'''
+            INSERT INTO {s}.users (phone, nickname, username)
+            SELECT '+7f' || %(prefix)s || i, 'friend ' || i, '@f' || %(prefix)s || i
+            FROM generate_series(1, %(total)s) i
+            RETURNING id
+        ''', {'prefix': prefix, 'total': friends + blocked})
+        others = sorted(row[0] for row in cur.fetchall())
+        friend_ids, blocked_ids = others[:friends], others[friends:]
+        cur.execute(f'''
+            INSERT INTO {s}.friendships (user_id, friend_id, status)
+            SELECT %s, unnest(%s::int[]), 'accepted'
+        ''', (user_id, friend_ids))
+        cur.execute(f'''
+            INSERT INTO {s}.blocked_users (user_id, blocked_user_id)
+            SELECT %s, unnest(%s::int[])
+        ''', (user_id, blocked_ids))
+        cur.execute(f'''
+            WITH created AS (
+                INSERT INTO {s}.chats (type, name, created_by)
+                SELECT 'group', 'bench bootstrap ' || g, %(user_id)s
+                FROM generate_series(1, %(chats)s) g
+                RETURNING id
+            )
+            INSERT INTO {s}.chat_members (chat_id, user_id, role)
+            SELECT id, %(user_id)s, 'member' FROM created
+        ''', {'user_id': user_id, 'chats': chats})
+    conn.commit()
+    return user_id, friend_ids
+
+
+def get(handler, params: dict) -> dict:
+    result = handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+    assert result['statusCode'] == 200, result['body']
+    return result
+
+
+def checkouts(modules: dict) -> int:
+    stats = modules['db'].get_pool().stats()
+    return stats['hits'] + stats['misses']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--friends', type=int, default=300)
+    parser.add_argument('--blocked', type=int, default=20)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4, help='потоков, переключающих дружбы во время проверки снимка')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--migrate', action='store_true', help='накатить db_migrations перед прогоном')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    user_id, friend_ids = seed(conn, args.friends, args.blocked, args.chats)
+    functions = {name: load_modules(name) for name in ('users', 'chats')}
+    users = functions['users']['index']
+
+    fan_out = []
+    used = {name: checkouts(modules) for name, modules in functions.items()}
+    for _ in range(args.runs):
+        # Кеши друзей и профиля сбрасываются, как у холодного инстанса после входа
+        users.friends_cache.clear()
+        users.user_cache.clear()
+        started = time.perf_counter()
+        for function, params in FAN_OUT:
+            get(functions[function]['index'].handler, {**params, 'user_id': str(user_id)})
+        fan_out.append((time.perf_counter() - started) * 1000)
+    per_call = sum(checkouts(modules) - used[name] for name, modules in functions.items()) / args.runs
+    report(f'fan-out: {len(FAN_OUT)} calls, {per_call:.0f} connections', fan_out)
+
+    sizes = {}
+    for fields in (None, 'user,chats'):
+        params = {'action': 'bootstrap', 'user_id': str(user_id), **({'fields': fields} if fields else {})}
+        samples = []
+        used = checkouts(functions['users'])
+        for _ in range(args.runs):
+            users.friends_cache.clear()
+            users.user_cache.clear()
+            result, ms = timed(get, users.handler, params)
+            samples.append(ms)
+        per_call = (checkouts(functions['users']) - used) / args.runs
+        sizes[fields] = len(result['body'])
+        report(f'bootstrap fields={fields or "all"}: {sizes[fields] // 1024} KiB, {per_call:.0f} connection', samples)
+    print(f'fields=user,chats trims the payload by {1 - sizes["user,chats"] / sizes[None]:.0%}')
+
+    body = json.loads(get(users.handler, {'action': 'bootstrap', 'user_id': str(user_id)})['body'])
+    page = json.loads(get(functions['chats']['index'].handler,
+                          {'action': 'list', 'user_id': str(user_id), 'limit': '20'})['body'])
+    assert body['chats']['chats'] == page['chats'] and body['chats']['next_cursor'] == page['next_cursor'], \
+        'bootstrap chats differ from the first chats list page'
+    assert set(body) == {'user', 'stats', 'friends', 'blocked', 'chats'}
+    assert len(body['blocked']) == args.blocked
+
+    # Дружбы переключаются между accepted и pending; триггер V0011 меняет friends_count в той же транзакции
+    deadline = time.monotonic() + args.seconds
+    toggles = [0]
+
+    def toggler():
+        writer = connect()
+        with writer.cursor() as cur:
+            while time.monotonic() < deadline:
+                try:
+                    cur.execute(f'''
+                        UPDATE {schema()}.friendships
+                        SET status = CASE WHEN status = 'accepted' THEN 'pending' ELSE 'accepted' END
+                        WHERE user_id = %s AND friend_id = ANY(%s)
+                    ''', (user_id, random.sample(friend_ids, min(5, len(friend_ids)))))
+                    writer.commit()
+                    toggles[0] += 1
+                except psycopg2.errors.DeadlockDetected:
+                    writer.rollback()
+        writer.close()
+
+    threads = [threading.Thread(target=toggler) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    checks = 0
+    params = {'action': 'bootstrap', 'user_id': str(user_id), 'fields': 'stats,friends'}
+    while time.monotonic() < deadline:
+        body = json.loads(get(users.handler, params)['body'])
+        assert body['stats']['friends_count'] == len(body['friends']), \
+            f'snapshot mismatch: friends_count {body["stats"]["friends_count"]}, friends {len(body["friends"])}'
+        checks += 1
+    for thread in threads:
+        thread.join()
+    print(f'ok: {checks} bootstraps consistent under {toggles[0]} concurrent friendship updates')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''Бенчмарк chats?action=list для пользователя в тысячах чатов: весь список, страницы, 304 и дельта.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/chat_list.py --migrate --chats 5000
+
+Для каждого режима печатает p50/p99 и размер ответа, для полного списка —
+пик памяти Python (tracemalloc) на вызов. Затем пишет сообщения в --touch
+чатов, выводит пользователя из одного и проверяет, что дельта since=<sync_token>
+возвращает ровно эти изменения.
+'''
+import argparse
+import json
+import tracemalloc
+
+from _common import apply_migrations, connect, ensure_user, load_handler, report, schema, timed
+
+
+def seed(conn, chats: int) -> int:
+    s = schema()
+    with conn.cursor() as cur:
+        user_id = ensure_user(cur, '+70000000020', 'bench-chat-list')
+        cur.execute(f'SELECT COUNT(*) FROM {s}.chat_members WHERE user_id = %s', (user_id,))
+        missing = chats - cur.fetchone()[0]
+        if missing > 0:
+            cur.execute(f'''
+                WITH created AS (
+                    INSERT INTO {s}.chats (type, name, created_by)
+                    SELECT (ARRAY['group', 'channel'])[1 + g %% 2], 'bench list ' || g, %(user_id)s
+                    FROM generate_series(1, %(missing)s) g
+                    RETURNING id
+                )
+                INSERT INTO {s}.chat_members (chat_id, user_id, role)
+                SELECT id, %(user_id)s, 'member' FROM created
+            ''', {'user_id': user_id, 'missing': missing})
+            cur.execute(f'''
+                INSERT INTO {s}.messages (chat_id, sender_id, message_text, media_type)
+                SELECT cm.chat_id, %s, 'hello from ' || cm.chat_id, 'text'
+                FROM {s}.chat_members cm
+                WHERE cm.user_id = %s
+            ''', (user_id, user_id))
+            cur.execute(f'ANALYZE {s}.chat_members')
+    conn.commit()
+    return user_id
+
+
+def get(handler, params: dict, headers: dict = None) -> dict:
+    return handler({'httpMethod': 'GET', 'queryStringParameters': {'action': 'list', **params},
+                    'headers': headers or {}}, None)
+
+
+def measure(title: str, handler, params: dict, runs: int, headers: dict = None) -> dict:
+    samples = []
+    for _ in range(runs):
+        result, ms = timed(get, handler, params, headers)
+        samples.append(ms)
+    report(f'{title} ({len(result["body"]) // 1024} KiB)', samples)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--touch', type=int, default=25)
+    parser.add_argument('--migrate', action='store_true', help='накатить db_migrations перед прогоном')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    user_id = seed(conn, args.chats)
+    handler = load_handler('chats')
+    base = {'user_id': str(user_id), 'order': 'activity'}
+
+    full = measure('full list', handler, base, args.runs)
+    tracemalloc.start()
+    get(handler, base)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'full list: {len(json.loads(full["body"]))} chats, python peak {peak / 2**20:.1f} MiB per call')
+
+    measure('not modified (If-None-Match)', handler, base, args.runs, {'If-None-Match': full['headers']['ETag']})
+
+    pages, cursor, samples, token = 0, None, [], None
+    while True:
+        result, ms = timed(get, handler, {**base, 'limit': str(args.limit), **({'cursor': cursor} if cursor else {})})
+        body = json.loads(result['body'])
+        token = token or body.get('sync_token')
+        samples.append(ms)
+        pages += 1
+        cursor = body['next_cursor']
+        if not cursor:
+            break
+    report(f'page of {args.limit} ({pages} pages)', samples)
+
+    s = schema()
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            SELECT chat_id FROM {s}.chat_members WHERE user_id = %s ORDER BY chat_id LIMIT %s
+        ''', (user_id, args.touch + 1))
+        chat_ids = [chat_id for chat_id, in cur.fetchall()]
+        touched, left = chat_ids[:-1], chat_ids[-1]
+        cur.execute(f'''
+            INSERT INTO {s}.messages (chat_id, sender_id, message_text, media_type)
+            SELECT chat_id, %s, 'delta', 'text' FROM unnest(%s::int[]) chat_id
+        ''', (user_id, touched))
+        cur.execute(f'DELETE FROM {s}.chat_members WHERE chat_id = %s AND user_id = %s', (left, user_id))
+    conn.commit()
+
+    delta = json.loads(measure('delta since first page', handler, {**base, 'since': token}, args.runs)['body'])
+    changed = sorted(chat['id'] for chat in delta['chats'])
+    assert changed == sorted(touched), f'delta returned {len(changed)} chats, expected {len(touched)}'
+    assert delta['removed'] == [left], delta['removed']
+    print(f'delta: {len(changed)} changed, removed {delta["removed"]}')
+
+    with conn.cursor() as cur:
+        cur.execute(f'INSERT INTO {s}.chat_members (chat_id, user_id, role) VALUES (%s, %s, %s)', (left, user_id, 'member'))
+    conn.commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+'''Локальный стенд: auth, users, chats, upload и wallet за одним HTTP-сервером по маршрутам func2url.json.
+
+    DATABASE_URL=postgresql://localhost/speaky DB_POOL_MAX_SIZE=20 python bench/devserver.py --port 8000
+
+Функция доступна и по имени (/chats), и по пути из func2url.json
+(/a18ead87-...), так что фронтенд переключается на стенд заменой хоста.
+HTTP-запрос превращается в event облачной функции; к ответу добавляются
+X-Query-Count (SQL-операторов за вызов) и Server-Timing: handler;dur=...
+GET /__stats отдаёт состояние пулов соединений каждой функции. С PROFILE=1
+функции дополнительно пишут JSON-строку профиля на каждый вызов (см. instrument.py).
+
+Без S3_ENDPOINT_URL поднимается локальный moto server (см. _common.start_local_s3).
+
+--mode async (или HANDLER_MODE=async) включает асинхронные handler chats и
+users (aio.py): стенд становится asyncio-сервером с одним event loop, а
+синхронные функции выполняются в его пуле потоков. У chats и users в этом
+режиме нет X-Query-Count: запросы asyncpg идут мимо счётчика курсоров psycopg2.
+'''
+import argparse
+import asyncio
+import base64
+import inspect
+import json
+import os
+import threading
+import time
+import types
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import psycopg2.extensions
+
+from _common import BACKEND, apply_migrations, connect, load_modules, schema, start_local_s3
+
+FUNCTIONS = ('auth', 'users', 'chats', 'upload', 'wallet')
+# Такие тела платформа передаёт в base64 (isBase64Encoded), остальные — строкой
+BINARY_TYPES = ('application/octet-stream', 'image/', 'video/', 'audio/')
+
+_local = threading.local()
+_counted = {}
+
+
+def counted_cursor(base: type) -> type:
+    '''Подкласс курсора функции, который считает операторы в счётчике текущего потока'''
+    if base not in _counted:
+        class Counted(base):
+            def execute(self, query, vars=None):
+                _local.queries = getattr(_local, 'queries', 0) + 1
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                _local.queries = getattr(_local, 'queries', 0) + 1
+                return super().executemany(query, vars_list)
+
+        Counted.__name__ = f'Counted{base.__name__}'
+        _counted[base] = Counted
+    return _counted[base]
+
+
+def counting_connection(base: type) -> type:
+    '''Соединение, курсоры которого считают операторы; base — фабрика самой функции (PROFILE=1)'''
+    class CountingConnection(base):
+        def cursor(self, *args, **kwargs):
+            cursor_base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+            return super().cursor(*args, cursor_factory=counted_cursor(cursor_base), **kwargs)
+
+    return CountingConnection
+
+
+def load_functions() -> dict:
+    '''Имя функции -> её модули; пул каждой функции создаётся на считающем соединении'''
+    functions = {}
+    for name in FUNCTIONS:
+        functions[name] = load_modules(name)
+        db = functions[name]['db']
+        db.connection_factory = counting_connection(db.connection_factory or psycopg2.extensions.connection)
+    return functions
+
+
+def build_routes(functions: dict) -> dict:
+    '''Путь -> (имя функции, модули): /<имя> и путь из func2url.json'''
+    func2url = json.loads((BACKEND / 'func2url.json').read_text())
+    routes = {}
+    for name, modules in functions.items():
+        routes[f'/{name}'] = (name, modules)
+        if name in func2url:
+            routes[urlsplit(func2url[name]).path.rstrip('/')] = (name, modules)
+    return routes
+
+
+def pool_stats(functions: dict) -> dict:
+    stats = {}
+    for name, modules in functions.items():
+        stats[name] = modules['db'].get_pool().stats()
+        if 'aiodb' in modules:
+            stats[name]['async'] = modules['aiodb'].pool_stats()
+    return stats
+
+
+def build_event(method: str, target: str, headers: dict, raw: bytes, name: str) -> tuple:
+    '''HTTP-запрос -> (event, context) облачной функции'''
+    url = urlsplit(target)
+    content_type = next((value for key, value in headers.items() if key.lower() == 'content-type'), '')
+    is_text = not content_type.startswith(BINARY_TYPES)
+    event = {
+        'httpMethod': method,
+        'path': url.path,
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(url.query)),
+        'body': raw.decode() if is_text else base64.b64encode(raw).decode(),
+        'isBase64Encoded': not is_text,
+        'requestContext': {'requestId': uuid.uuid4().hex}
+    }
+    context = types.SimpleNamespace(request_id=event['requestContext']['requestId'], function_name=name)
+    return event, context
+
+
+def failure(error: Exception) -> dict:
+    return {'statusCode': 502, 'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': f'{type(error).__name__}: {error}'}), 'isBase64Encoded': False}
+
+
+def finish(result: dict, elapsed: float, queries: int = None) -> tuple:
+    '''Ответ функции -> (заголовки, тело) с X-Query-Count и Server-Timing'''
+    headers = dict(result.get('headers') or {})
+    if queries is not None:
+        headers['X-Query-Count'] = str(queries)
+    timing = f'handler;dur={elapsed:.1f}'
+    headers['Server-Timing'] = f'{headers["Server-Timing"]}, {timing}' if 'Server-Timing' in headers else timing
+    body = result.get('body') or ''
+    body = base64.b64decode(body) if result.get('isBase64Encoded') else body.encode()
+    return headers, body
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    functions = {}
+    routes = {}
+    verbose = False
+
+    def do_request(self):
+        url = urlsplit(self.path)
+        if url.path == '/__stats':
+            return self.reply(200, {'Content-Type': 'application/json'}, json.dumps(pool_stats(self.functions)).encode())
+
+        route = self.routes.get(url.path.rstrip('/'))
+        if route is None:
+            return self.reply(404, {'Content-Type': 'application/json'}, b'{"error": "Unknown function"}')
+        name, modules = route
+
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        event, context = build_event(self.command, self.path, dict(self.headers), raw, name)
+
+        _local.queries = 0
+        started = time.perf_counter()
+        try:
+            result = modules['index'].handler(event, context)
+        except Exception as e:
+            result = failure(e)
+        elapsed = (time.perf_counter() - started) * 1000
+
+        headers, body = finish(result, elapsed, _local.queries)
+        if self.verbose:
+            print(f'{self.command} {self.path} -> {result["statusCode"]} {elapsed:.1f}ms {_local.queries}q', flush=True)
+        self.reply(result['statusCode'], headers, body)
+
+    def reply(self, status: int, headers: dict, body: bytes):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_OPTIONS = do_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AsyncServer:
+    '''HTTP/1.1 с keep-alive на asyncio: асинхронные handler ждутся в loop, синхронные идут в пул потоков'''
+
+    def __init__(self, functions: dict, routes: dict, verbose: bool = False):
+        self.functions = functions
+        self.routes = routes
+        self.verbose = verbose
+
+    async def call(self, modules: dict, event: dict, context) -> tuple:
+        handler = modules['index'].handler
+        if inspect.iscoroutinefunction(handler):
+            return await handler(event, context), None
+
+        def counted():
+            _local.queries = 0
+            return handler(event, context), _local.queries
+
+        return await asyncio.get_running_loop().run_in_executor(None, counted)
+
+    async def dispatch(self, method: str, target: str, headers: dict, raw: bytes) -> tuple:
+        path = urlsplit(target).path
+        if path == '/__stats':
+            return 200, {'Content-Type': 'application/json'}, json.dumps(pool_stats(self.functions)).encode()
+        route = self.routes.get(path.rstrip('/'))
+        if route is None:
+            return 404, {'Content-Type': 'application/json'}, b'{"error": "Unknown function"}'
+        name, modules = route
+
+        event, context = build_event(method, target, headers, raw, name)
+        started = time.perf_counter()
+        try:
+            result, queries = await self.call(modules, event, context)
+        except Exception as e:
+            result, queries = failure(e), None
+        elapsed = (time.perf_counter() - started) * 1000
+        if self.verbose:
+            print(f'{method} {target} -> {result["statusCode"]} {elapsed:.1f}ms', flush=True)
+        return (result['statusCode'], *finish(result, elapsed, queries))
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                method, target, _ = line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    key, _, value = line.decode().partition(':')
+                    headers[key.strip()] = value.strip()
+                length = next((value for key, value in headers.items() if key.lower() == 'content-length'), 0)
+                raw = await reader.readexactly(int(length))
+
+                status, out, body = await self.dispatch(method, target, headers, raw)
+                head = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+                head += [f'{key}: {value}' for key, value in out.items()]
+                head.append(f'Content-Length: {len(body)}')
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + body)
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, host: str, port: int):
+        server = await asyncio.start_server(self.serve, host, port, limit=2 ** 20)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=('sync', 'async'), default=os.environ.get('HANDLER_MODE') or 'sync')
+    parser.add_argument('--migrate', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    schema()
+    # Режим читается функциями при импорте (конец index.py chats и users)
+    os.environ['HANDLER_MODE'] = args.mode
+    if args.migrate:
+        apply_migrations(connect())
+    start_local_s3()
+
+    functions = load_functions()
+    upload = functions['upload']['index']
+    s3 = upload.s3_client()
+    try:
+        s3.create_bucket(Bucket=upload.S3_BUCKET)
+    except s3.exceptions.ClientError:
+        pass
+    routes = build_routes(functions)
+    for path, (name, _) in sorted(routes.items()):
+        print(f'http://{args.host}:{args.port}{path} -> {name} ({args.mode})')
+
+    if args.mode == 'async':
+        asyncio.run(AsyncServer(functions, routes, args.verbose).run(args.host, args.port))
+        return
+
+    Handler.functions = functions
+    Handler.routes = routes
+    Handler.verbose = args.verbose
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
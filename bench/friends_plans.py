@@ -0,0 +1,92 @@
+'''Страж планов users/friends.py: ни одна форма запроса друзей не должна сканировать friendships целиком.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/friends_plans.py
+
+enable_seqscan = off заставляет планировщик взять индекс, если он вообще
+применим, поэтому проверка не зависит от объёма данных. Каждая форма должна
+читать обратное направление UNION через idx_friendships_friend_id (V0010) и
+не содержать Seq Scan по friendships. Выход с кодом 1, если это не так
+(например, после возврата к OR в JOIN или удаления индекса).
+'''
+import argparse
+import json
+import sys
+
+from _common import BACKEND, apply_migrations, connect, schema
+
+sys.path.insert(0, str(BACKEND / 'users'))
+from friends import list_friends  # noqa: E402
+
+REVERSE_INDEX = 'idx_friendships_friend_id'
+
+
+class ExplainCursor:
+    '''Вместо выполнения запроса сохраняет его EXPLAIN (FORMAT JSON)'''
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.plan = None
+
+    def execute(self, sql, params=None):
+        self.cur.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = self.cur.fetchone()[0]
+        self.plan = plan if isinstance(plan, list) else json.loads(plan)
+
+    def records(self):
+        return []
+
+
+def seq_scans(node: dict, table: str) -> list:
+    found = [node] if node.get('Node Type') == 'Seq Scan' and node.get('Relation Name') == table else []
+    for child in node.get('Plans', []):
+        found += seq_scans(child, table)
+    return found
+
+
+def index_names(node: dict) -> set:
+    found = {node['Index Name']} if 'Index Name' in node else set()
+    for child in node.get('Plans', []):
+        found |= index_names(child)
+    return found
+
+
+def check(plan: dict) -> list:
+    '''Проблемы плана: пустой список, если форма читает friendships только по индексам'''
+    problems = []
+    if seq_scans(plan, 'friendships'):
+        problems.append('Seq Scan on friendships')
+    if REVERSE_INDEX not in index_names(plan):
+        problems.append(f'{REVERSE_INDEX} not used')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+
+    shapes = {
+        'full list': {},
+        'page': {'limit': 51, 'after_id': 100},
+        'online only': {'limit': 51, 'online_only': True},
+        'with mutual counts': {'limit': 51, 'with_mutual': True},
+    }
+    failed = False
+    with conn.cursor() as cur:
+        cur.execute('SET enable_seqscan = off')
+        explain = ExplainCursor(cur)
+        for name, kwargs in shapes.items():
+            list_friends(explain, schema(), 1, **kwargs)
+            problems = check(explain.plan[0]['Plan'])
+            failed |= bool(problems)
+            print(f'{name:<22} {"FAIL: " + "; ".join(problems) if problems else "ok"}')
+    conn.rollback()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
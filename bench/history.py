@@ -0,0 +1,93 @@
+'''Бенчмарк chats?action=history: keyset-страницы на чате с миллионами сообщений.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/history.py --messages 2000000
+
+Показывает p50/p99 на страницу у свежего конца, при листании назад и на
+случайной глубине; для сравнения — тот же срез через OFFSET.
+'''
+import argparse
+import json
+import random
+
+from _common import apply_migrations, connect, create_chat, ensure_user, load_function, percentile, report, schema, timed
+
+
+def seed_chat(conn, messages: int) -> int:
+    s = schema()
+    name = f'bench-history-{messages}'
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT id FROM {s}.chats WHERE name = %s', (name,))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        user_id = ensure_user(cur)
+        chat_id = create_chat(cur, name, user_id)
+        cur.execute(f'''
+            INSERT INTO {s}.messages (chat_id, sender_id, message_text, media_type, created_at)
+            SELECT %s, %s, 'message #' || g, 'text', now() - (%s - g) * interval '1 second'
+            FROM generate_series(1, %s) g
+        ''', (chat_id, user_id, messages, messages))
+        cur.execute(f'ANALYZE {s}.messages')
+    conn.commit()
+    return chat_id
+
+
+def page(handler, chat_id: int, limit: int, before: str = None) -> dict:
+    params = {'action': 'history', 'chat_id': str(chat_id), 'limit': str(limit)}
+    if before:
+        params['before'] = before
+    response = handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+    return json.loads(response['body'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--migrate', action='store_true', help='накатить db_migrations перед прогоном')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    chat_id = seed_chat(conn, args.messages)
+    chats = load_function('chats')
+    handler = chats.handler
+
+    latest = [timed(page, handler, chat_id, args.limit)[1] for _ in range(args.pages)]
+    report('latest page', latest)
+
+    walk, cursor = [], None
+    for _ in range(args.pages):
+        body, ms = timed(page, handler, chat_id, args.limit, cursor)
+        walk.append(ms)
+        cursor = body['before_cursor']
+    report(f'walk back {args.pages} pages', walk)
+
+    s = schema()
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT min(id), max(id) FROM {s}.messages WHERE chat_id = %s', (chat_id,))
+        low, high = cur.fetchone()
+        deep, offset = [], []
+        for _ in range(args.pages):
+            cur.execute(f'SELECT created_at, id FROM {s}.messages WHERE id = %s', (random.randint(low, high),))
+            created_at, message_id = cur.fetchone()
+            deep.append(timed(page, handler, chat_id, args.limit, chats.encode_cursor(created_at, message_id))[1])
+
+            depth = high - message_id
+            _, ms = timed(cur.execute, f'''
+                SELECT id, chat_id, sender_id, message_text, media_type, media_url, reply_to, created_at
+                FROM {s}.messages WHERE chat_id = %s
+                ORDER BY created_at DESC, id DESC OFFSET %s LIMIT %s
+            ''', (chat_id, depth, args.limit))
+            cur.fetchall()
+            offset.append(ms)
+        conn.rollback()
+    report('keyset at random depth', deep)
+    report('OFFSET at same depth (SQL only)', offset)
+    print(f'keyset/offset p50 ratio: {percentile(deep, 50) / percentile(offset, 50):.3f}')
+
+
+if __name__ == '__main__':
+    main()
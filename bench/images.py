@@ -0,0 +1,66 @@
+'''Бенчмарк лестницы разрешений upload/images.py (без S3 и БД).
+
+    python bench/images.py --images 40 --workers 1 4
+
+Печатает изображений в секунду (и на одно ядро) для фото с телефона и
+аватарок, а также сколько байт экономит рендер списка из 50 чатов, если
+брать 64px WebP вместо оригинальных аватарок.
+'''
+import argparse
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from _common import BACKEND
+
+sys.path.insert(0, str(BACKEND / 'upload'))
+from images import render_variants  # noqa: E402
+
+
+def synthetic_jpeg(width: int, height: int, seed: int) -> bytes:
+    '''Градиент с шумом: сжимается примерно как фотография, а не как заливка'''
+    gradient = Image.linear_gradient('L').resize((width, height)).rotate(seed * 37 % 360)
+    noise = Image.effect_noise((width, height), 40 + seed % 20)
+    image = Image.merge('RGB', (gradient, noise, Image.blend(gradient, noise, 0.5)))
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def throughput(images: list, workers: int) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(render_variants, images))
+    return len(images) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--chat-list', type=int, default=50, help='аватарок на один рендер списка чатов')
+    args = parser.parse_args()
+
+    datasets = {
+        'phone photo 4032x3024': [synthetic_jpeg(4032, 3024, i) for i in range(args.images)],
+        'avatar 800x800': [synthetic_jpeg(800, 800, i) for i in range(args.images)]
+    }
+    for name, images in datasets.items():
+        for workers in sorted(set(args.workers)):
+            rate = throughput(images, workers)
+            print(f'{name:<24} workers={workers:<3} {rate:7.1f} img/s  {rate / workers:7.1f} img/s per core')
+
+    avatars = datasets['avatar 800x800'][:args.chat_list]
+    original = sum(len(a) for a in avatars)
+    thumbs = sum(len(render_variants(a)[64]) for a in avatars)
+    print(f'chat list of {len(avatars)} avatars: original {original / 1024:.0f} KB, '
+          f'64px webp {thumbs / 1024:.0f} KB, saved {(original - thumbs) / 1024:.0f} KB '
+          f'({100 * (1 - thumbs / original):.1f}%)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''Бенчмарк записи сообщений: chats send (по одному) против send_batch.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/ingest.py --messages 20000
+
+Печатает rows/sec для каждого режима и проверяет, что повтор пачки с теми же
+idempotency_key не создаёт новых строк.
+'''
+import argparse
+import json
+import time
+import uuid
+
+from _common import apply_migrations, connect, create_chat, ensure_user, load_handler
+
+
+def post(handler, body: dict) -> dict:
+    response = handler({'httpMethod': 'POST', 'body': json.dumps(body)}, None)
+    assert response['statusCode'] == 200, response['body']
+    return json.loads(response['body'])
+
+
+def single(handler, chat_id: int, user_id: int, total: int) -> float:
+    started = time.perf_counter()
+    for i in range(total):
+        post(handler, {'action': 'send', 'chat_id': chat_id, 'user_id': user_id,
+                       'message_text': f'single #{i}', 'idempotency_key': uuid.uuid4().hex})
+    return total / (time.perf_counter() - started)
+
+
+def batched(handler, chat_id: int, user_id: int, total: int, batch: int) -> tuple:
+    started = time.perf_counter()
+    sent = []
+    for offset in range(0, total, batch):
+        items = [{'message_text': f'batch #{i}', 'idempotency_key': uuid.uuid4().hex}
+                 for i in range(offset, min(offset + batch, total))]
+        post(handler, {'action': 'send_batch', 'chat_id': chat_id, 'user_id': user_id, 'messages': items})
+        sent.append(items)
+    return total / (time.perf_counter() - started), sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=10_000)
+    parser.add_argument('--batches', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    with conn.cursor() as cur:
+        user_id = ensure_user(cur)
+        chat_id = create_chat(cur, f'bench-ingest-{uuid.uuid4().hex[:8]}', user_id)
+    conn.commit()
+
+    handler = load_handler('chats')
+    baseline = single(handler, chat_id, user_id, min(args.messages, 2000))
+    print(f'{"send x1":<20} {baseline:10.0f} rows/sec')
+
+    last = None
+    for batch in args.batches:
+        rate, last = batched(handler, chat_id, user_id, args.messages, batch)
+        print(f'{"send_batch x" + str(batch):<20} {rate:10.0f} rows/sec  ({rate / baseline:.1f}x)')
+
+    replay = post(handler, {'action': 'send_batch', 'chat_id': chat_id, 'user_id': user_id, 'messages': last[0]})
+    assert all(m['duplicate'] for m in replay['messages']), 'retry created duplicates'
+    print(f'retry of {len(last[0])} messages: all reported as duplicates')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+'''Асинхронный генератор нагрузки на локальный стенд (bench/devserver.py).
+
+    python bench/load.py --url http://127.0.0.1:8000 --concurrency 64 --seconds 60 \
+        --mix list=30,history=25,members=10,send=10,search=5,stats=5,friends=5,user_search=5,login=5
+
+Сценарии: list, history, members, send, search, presence (chats), stats,
+profile, friends, user_search (users) и login (auth).
+
+Пользователи и чаты для запросов берутся из базы (DATABASE_URL), например
+после bench/seed.py. Каждый воркер держит своё keep-alive соединение и шлёт
+запросы подряд, выбирая сценарий по весам --mix. Для каждого сценария
+печатаются rps, p50/p95/p99, доля ошибок и среднее число SQL-операторов на
+запрос (заголовок X-Query-Count от стенда).
+'''
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+from _common import connect, percentile, schema
+
+WORDS = ['привет', 'встреча', 'музыка', 'проект', 'release', 'concert', 'weekend', 'фото']
+
+
+class Sample:
+    '''Случайные пользователи (id, телефон, ник) и их чаты для построения запросов'''
+
+    def __init__(self, size: int):
+        conn = connect()
+        with conn.cursor() as cur:
+            cur.execute(f'''
+                SELECT cm.user_id, u.phone, u.nickname, cm.chat_id
+                FROM {schema()}.chat_members cm TABLESAMPLE SYSTEM (10)
+                JOIN {schema()}.users u ON u.id = cm.user_id
+                LIMIT %s
+            ''', (size,))
+            self.rows = cur.fetchall()
+        conn.close()
+        if not self.rows:
+            raise SystemExit('no chat members to sample: run bench/seed.py first')
+
+    def pick(self) -> tuple:
+        return random.choice(self.rows)
+
+
+def scenarios(sample: Sample) -> dict:
+    '''Имя -> функция, возвращающая (функция, метод, query, тело)'''
+    def list_chats():
+        user_id, _, _, _ = sample.pick()
+        return 'chats', 'GET', {'action': 'list', 'user_id': user_id, 'order': 'activity'}, None
+
+    def history():
+        _, _, _, chat_id = sample.pick()
+        return 'chats', 'GET', {'action': 'history', 'chat_id': chat_id, 'limit': 50}, None
+
+    def members():
+        _, _, _, chat_id = sample.pick()
+        return 'chats', 'GET', {'action': 'members', 'chat_id': chat_id}, None
+
+    def send():
+        user_id, _, _, chat_id = sample.pick()
+        return 'chats', 'POST', {}, {'action': 'send', 'chat_id': chat_id, 'user_id': user_id,
+                                     'message_text': f'{random.choice(WORDS)} {uuid.uuid4().hex[:6]}',
+                                     'idempotency_key': uuid.uuid4().hex}
+
+    def search():
+        user_id, _, _, _ = sample.pick()
+        return 'chats', 'GET', {'action': 'search', 'user_id': user_id, 'q': random.choice(WORDS)}, None
+
+    def stats():
+        user_id, _, _, _ = sample.pick()
+        return 'users', 'GET', {'action': 'stats', 'user_id': user_id}, None
+
+    def profile():
+        user_id, _, _, _ = sample.pick()
+        return 'users', 'GET', {'action': 'profile', 'user_id': user_id}, None
+
+    def presence():
+        user_ids = sorted({sample.pick()[0] for _ in range(50)})
+        return 'chats', 'GET', {'action': 'presence', 'user_ids': ','.join(map(str, user_ids))}, None
+
+    def friends():
+        user_id, _, _, _ = sample.pick()
+        return 'users', 'GET', {'action': 'friends', 'user_id': user_id, 'limit': 50}, None
+
+    def user_search():
+        _, _, nickname, _ = sample.pick()
+        return 'users', 'GET', {'action': 'search', 'q': nickname[:random.randint(2, 6)]}, None
+
+    def login():
+        _, phone, _, _ = sample.pick()
+        return 'auth', 'POST', {}, {'action': 'login', 'phone': phone}
+
+    return {'list': list_chats, 'history': history, 'members': members, 'send': send, 'search': search,
+            'stats': stats, 'profile': profile, 'presence': presence, 'friends': friends,
+            'user_search': user_search, 'login': login}
+
+
+class Client:
+    '''Минимальный HTTP/1.1-клиент с keep-alive поверх asyncio streams'''
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, body: bytes = b'') -> tuple:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = (f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n\r\n')
+        try:
+            self.writer.write(head.encode() + body)
+            await self.writer.drain()
+            status = int((await self.reader.readline()).split()[1])
+            headers = {}
+            while (line := await self.reader.readline()) not in (b'\r\n', b''):
+                key, _, value = line.decode().partition(':')
+                headers[key.strip().lower()] = value.strip()
+            payload = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        except (OSError, IndexError, ValueError, asyncio.IncompleteReadError):
+            self.close()
+            raise
+        return status, headers, payload
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def report(self, seconds: float):
+        print(f'{"scenario":<12} {"req":>7} {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+              f'{"err %":>6} {"q/req":>6}')
+        names = sorted(self.latencies, key=lambda name: -len(self.latencies[name]))
+        everything = [ms for name in names for ms in self.latencies[name]]
+        for name, samples, queries, errors in [
+            *((n, self.latencies[n], self.queries[n], self.errors[n]) for n in names),
+            ('total', everything, [q for n in names for q in self.queries[n]], sum(self.errors.values()))
+        ]:
+            if not samples:
+                continue
+            print(f'{name:<12} {len(samples):>7} {len(samples) / seconds:>8.1f} '
+                  f'{percentile(samples, 50):>8.2f} {percentile(samples, 95):>8.2f} {percentile(samples, 99):>8.2f} '
+                  f'{100 * errors / len(samples):>6.2f} {sum(queries) / max(len(queries), 1):>6.2f}')
+
+
+async def worker(client: Client, base: str, mix: list, weights: list, build: dict, deadline: float,
+                 results: Results, record_after: float):
+    while time.monotonic() < deadline:
+        name = random.choices(mix, weights)[0]
+        function, method, query, body = build[name]()
+        path = f'{base}/{function}' + (f'?{urlencode(query)}' if query else '')
+        started = time.perf_counter()
+        try:
+            status, headers, _ = await client.request(method, path, json.dumps(body).encode() if body else b'')
+        except (OSError, IndexError, ValueError, asyncio.IncompleteReadError):
+            status, headers = 599, {}
+        elapsed = (time.perf_counter() - started) * 1000
+        if time.monotonic() < record_after:
+            continue
+        results.latencies[name].append(elapsed)
+        if 'x-query-count' in headers:
+            results.queries[name].append(int(headers['x-query-count']))
+        if status >= 400:
+            results.errors[name] += 1
+    client.close()
+
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+async def measure(url: str, build: dict, mix: dict, concurrency: int, seconds: float, warmup: float) -> Results:
+    '''concurrency воркеров шлют смесь mix в течение warmup + seconds; замеры — только после прогрева'''
+    url = urlsplit(url)
+    results = Results()
+    now = time.monotonic()
+    record_after = now + warmup
+    deadline = record_after + seconds
+    await asyncio.gather(*(
+        worker(Client(url.hostname, url.port or 80), url.path.rstrip('/'), list(mix), list(mix.values()),
+               build, deadline, results, record_after)
+        for _ in range(concurrency)
+    ))
+    return results
+
+
+async def run(args):
+    build = scenarios(Sample(args.sample))
+    mix = parse_mix(args.mix)
+    unknown = set(mix) - set(build)
+    if unknown:
+        raise SystemExit(f'unknown scenarios: {", ".join(sorted(unknown))}; available: {", ".join(build)}')
+
+    results = await measure(args.url, build, mix, args.concurrency, args.seconds, args.warmup)
+    print(f'concurrency={args.concurrency} seconds={args.seconds} warmup={args.warmup}')
+    results.report(args.seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--sample', type=int, default=5000, help='сколько пар (пользователь, чат) взять из базы')
+    parser.add_argument('--mix', default='list=30,history=25,members=10,send=10,search=5,stats=5,'
+                                         'friends=5,user_search=5,login=5')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''Бенчмарк импорта участников: chats add_member (по одному) против add_members.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/members.py --members 50000
+
+Создаёт пользователей generate_series, затем наполняет каналы тремя способами:
+по одному add_member, списком user_ids и копированием из уже заполненного
+канала. Печатает members/sec и проверяет, что повтор импорта ничего не добавляет.
+'''
+import argparse
+import json
+import time
+import uuid
+
+from _common import apply_migrations, connect, create_chat, ensure_user, load_handler, schema
+
+
+def call(handler, method: str, body: dict) -> dict:
+    response = handler({'httpMethod': method, 'body': json.dumps(body)}, None)
+    assert response['statusCode'] == 200, response['body']
+    return json.loads(response['body'])
+
+
+def seed_users(cur, total: int) -> list:
+    prefix = uuid.uuid4().hex[:6]
+    cur.execute(f'''
+        INSERT INTO {schema()}.users (phone, nickname, username)
+        SELECT '+7b' || %(prefix)s || i, 'member ' || i, '@m' || %(prefix)s || i
+        FROM generate_series(1, %(total)s) i
+        RETURNING id
+    ''', {'prefix': prefix, 'total': total})
+    return sorted(row[0] for row in cur.fetchall())
+
+
+def bulk(handler, method: str, body: dict) -> dict:
+    '''Вызывает действие, пока не вернётся done, как это делал бы клиент'''
+    totals = {'added': 0, 'removed': 0, 'batches': 0, 'calls': 0}
+    cursor = None
+    while True:
+        result = call(handler, method, {**body, 'cursor': cursor})
+        for key in ('added', 'removed', 'batches'):
+            totals[key] += result.get(key, 0)
+        totals['calls'] += 1
+        if result['done']:
+            return totals
+        cursor = result['next_cursor']
+
+
+def rate(fn, count: int) -> tuple:
+    started = time.perf_counter()
+    result = fn()
+    return count / (time.perf_counter() - started), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=50_000)
+    parser.add_argument('--single', type=int, default=2000, help='сколько добавить по одному для базовой линии')
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    with conn.cursor() as cur:
+        owner = ensure_user(cur)
+        user_ids = seed_users(cur, args.members)
+        chats = [create_chat(cur, f'bench-members-{name}-{uuid.uuid4().hex[:8]}', owner, 'channel')
+                 for name in ('single', 'list', 'copy')]
+    conn.commit()
+
+    handler = load_handler('chats')
+    single_ids = user_ids[:args.single]
+    baseline, _ = rate(lambda: [call(handler, 'POST', {'action': 'add_member', 'chat_id': chats[0], 'user_id': u})
+                                for u in single_ids], len(single_ids))
+    print(f'{"add_member x1":<24} {baseline:10.0f} members/sec')
+
+    list_rate, result = rate(lambda: bulk(handler, 'POST', {'action': 'add_members', 'chat_id': chats[1],
+                                                            'user_ids': user_ids}), len(user_ids))
+    print(f'{"add_members user_ids":<24} {list_rate:10.0f} members/sec  ({list_rate / baseline:.1f}x, '
+          f'{result["batches"]} batches, {result["calls"]} calls)')
+    assert result['added'] == len(user_ids), result
+
+    copy_rate, result = rate(lambda: bulk(handler, 'POST', {'action': 'add_members', 'chat_id': chats[2],
+                                                            'source_chat_id': chats[1]}), len(user_ids))
+    print(f'{"add_members source_chat":<24} {copy_rate:10.0f} members/sec  ({copy_rate / baseline:.1f}x)')
+    assert result['added'] == len(user_ids), result
+
+    replay = bulk(handler, 'POST', {'action': 'add_members', 'chat_id': chats[1], 'user_ids': user_ids})
+    assert replay['added'] == 0, 'replay added duplicates'
+    print(f'replay of {len(user_ids)} user_ids: nothing added')
+
+    remove_rate, result = rate(lambda: bulk(handler, 'DELETE', {'action': 'remove_members', 'chat_id': chats[2],
+                                                                'user_ids': user_ids}), len(user_ids))
+    print(f'{"remove_members":<24} {remove_rate:10.0f} members/sec')
+    assert result['removed'] == len(user_ids), result
+
+
+if __name__ == '__main__':
+    main()
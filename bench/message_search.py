@@ -0,0 +1,99 @@
+'''Бенчмарк chats?action=search на синтетическом корпусе в десятки миллионов сообщений.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/message_search.py --messages 20000000
+
+Корпус: --chats чатов, у пользователя-читателя --member-chats из них; тексты
+склеены из русского и английского словаря. Печатает p50/p99 для поиска по
+всем чатам пользователя, по одному чату и для следующей страницы.
+'''
+import argparse
+import json
+import random
+
+from _common import apply_migrations, connect, create_chat, ensure_user, load_handler, report, schema, timed
+
+WORDS = ['привет', 'встреча', 'завтра', 'документы', 'проект', 'отпуск', 'билеты', 'концерт', 'деньги', 'машина',
+         'hello', 'meeting', 'tomorrow', 'documents', 'project', 'vacation', 'tickets', 'concert', 'money', 'car',
+         'погода', 'работа', 'фотографии', 'weather', 'work', 'photos', 'дедлайн', 'deadline', 'релиз', 'release']
+
+
+def seed(conn, messages: int, chats: int, member_chats: int, batch: int = 1_000_000) -> tuple:
+    s = schema()
+    with conn.cursor() as cur:
+        reader = ensure_user(cur, '+70000000002', 'bench_reader')
+        writer = ensure_user(cur)
+        cur.execute(f"SELECT id FROM {s}.chats WHERE name LIKE 'bench-search-%%' ORDER BY id")
+        chat_ids = [row[0] for row in cur.fetchall()]
+        if len(chat_ids) < chats:
+            chat_ids += [create_chat(cur, f'bench-search-{i}', writer) for i in range(len(chat_ids), chats)]
+            cur.execute(f'''
+                INSERT INTO {s}.chat_members (chat_id, user_id)
+                SELECT unnest(%s::int[]), %s ON CONFLICT DO NOTHING
+            ''', (chat_ids[:member_chats], reader))
+        cur.execute(f'SELECT count(*) FROM {s}.messages WHERE chat_id = ANY(%s)', (chat_ids,))
+        existing = cur.fetchone()[0]
+        conn.commit()
+        for start in range(existing, messages, batch):
+            # WHERE g > 0 делает подзапрос коррелированным, иначе текст сгенерируется один раз
+            cur.execute(f'''
+                INSERT INTO {s}.messages (chat_id, sender_id, message_text, media_type, created_at)
+                SELECT (%(chats)s::int[])[1 + (g %% %(n_chats)s)], %(writer)s,
+                       array_to_string(ARRAY(
+                           SELECT (%(words)s::text[])[1 + floor(random() * %(n_words)s)::int]
+                           FROM generate_series(1, 6 + g %% 10) w WHERE g > 0
+                       ), ' '),
+                       'text', now() - (%(total)s - g) * interval '1 second'
+                FROM generate_series(%(start)s, %(end)s) g
+            ''', {'chats': chat_ids, 'n_chats': len(chat_ids), 'writer': writer, 'words': WORDS,
+                  'n_words': len(WORDS), 'total': messages, 'start': start + 1, 'end': min(start + batch, messages)})
+            conn.commit()
+            print(f'seeded {min(start + batch, messages)} / {messages}')
+        cur.execute(f'ANALYZE {s}.messages')
+    conn.commit()
+    return reader, chat_ids[:member_chats]
+
+
+def search(handler, user_id: int, q: str, chat_id: int = None, before: str = None) -> dict:
+    params = {'action': 'search', 'user_id': str(user_id), 'q': q}
+    if chat_id:
+        params['chat_id'] = str(chat_id)
+    if before:
+        params['before'] = before
+    return json.loads(handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)['body'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=20_000_000)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--member-chats', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    reader, chat_ids = seed(conn, args.messages, args.chats, args.member_chats)
+    handler = load_handler('chats')
+
+    queries = {
+        'one word, all chats': lambda: (random.choice(WORDS), None),
+        'two words, all chats': lambda: (' '.join(random.sample(WORDS, 2)), None),
+        'phrase, all chats': lambda: (f'"{" ".join(random.sample(WORDS, 2))}"', None),
+        'one word, one chat': lambda: (random.choice(WORDS), random.choice(chat_ids)),
+    }
+    for name, make in queries.items():
+        report(name, [timed(search, handler, reader, *make())[1] for _ in range(args.queries)])
+
+    pages = []
+    for _ in range(args.queries):
+        word = random.choice(WORDS)
+        first = search(handler, reader, word)
+        if first['next_cursor']:
+            pages.append(timed(search, handler, reader, word, None, first['next_cursor'])[1])
+    report('next page', pages)
+
+
+if __name__ == '__main__':
+    main()
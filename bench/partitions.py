@@ -0,0 +1,156 @@
+'''Проверка и замеры секционирования messages: перенос legacy, архив в S3, история через архив.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/partitions.py --migrate --messages 200000 --months 18
+
+Сообщения одного чата раскладываются равномерно по последним --months
+месяцам. Скрипт снимает всю историю чата постранично, затем гоняет
+maintain_partitions (перенос legacy и секции вперёд) и archive_messages
+(--keep-months) через handler chats и после каждого шага сверяет, что
+страницы назад (before) и вперёд (after) отдают те же id в том же порядке.
+Печатает время шагов и p50/p99 страниц из БД и из архива.
+'''
+import argparse
+import json
+
+from _common import apply_migrations, connect, create_chat, ensure_user, load_modules, report, schema, start_local_s3, timed
+
+
+def seed_chat(conn, messages: int, months: int) -> tuple:
+    s = schema()
+    with conn.cursor() as cur:
+        admin_id = ensure_user(cur, '+70000000019', 'bench-partitions')
+        cur.execute(f'UPDATE {s}.users SET is_admin = TRUE WHERE id = %s', (admin_id,))
+        name = f'bench-partitions-{messages}-{months}'
+        cur.execute(f'SELECT id FROM {s}.chats WHERE name = %s', (name,))
+        row = cur.fetchone()
+        if row:
+            chat_id = row[0]
+        else:
+            chat_id = create_chat(cur, name, admin_id)
+            cur.execute(f'''
+                INSERT INTO {s}.messages (chat_id, sender_id, message_text, media_type, created_at)
+                SELECT %(chat_id)s, %(user_id)s, 'message #' || g, 'text',
+                       date_trunc('month', LOCALTIMESTAMP) - make_interval(months => %(months)s)
+                       + (g - 1) * (make_interval(months => %(months)s) / %(total)s)
+                FROM generate_series(1, %(total)s) g
+            ''', {'chat_id': chat_id, 'user_id': admin_id, 'months': months, 'total': messages})
+            cur.execute(f'ANALYZE {s}.messages')
+    conn.commit()
+    return chat_id, admin_id
+
+
+def call(handler, method: str, payload: dict) -> dict:
+    if method == 'GET':
+        result = handler({'httpMethod': 'GET', 'queryStringParameters': payload}, None)
+    else:
+        result = handler({'httpMethod': method, 'body': json.dumps(payload)}, None)
+    body = json.loads(result['body'])
+    assert result['statusCode'] == 200, body
+    return body
+
+
+def walk(handler, chat_id: int, limit: int) -> tuple:
+    '''Вся история назад от свежего конца и обратно вперёд; (id назад, id вперёд, мс на страницу)'''
+    backward, forward, samples = [], [], []
+    params = {'action': 'history', 'chat_id': str(chat_id), 'limit': str(limit)}
+    cursor = None
+    while True:
+        body, ms = timed(call, handler, 'GET', {**params, **({'before': cursor} if cursor else {})})
+        samples.append(ms)
+        backward = [m['id'] for m in body['messages']] + backward
+        if not body['has_more']:
+            break
+        cursor = body['before_cursor']
+
+    cursor = body['after_cursor']
+    forward = [m['id'] for m in body['messages']]
+    while True:
+        body, ms = timed(call, handler, 'GET', {**params, 'after': cursor})
+        samples.append(ms)
+        forward += [m['id'] for m in body['messages']]
+        if not body['has_more']:
+            break
+        cursor = body['after_cursor']
+    return backward, forward, samples
+
+
+def partitions(conn) -> list:
+    with conn.cursor() as cur:
+        cur.execute('''
+            SELECT c.relname, c.reltuples::bigint
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+            ORDER BY c.relname
+        ''', (f'{schema()}.messages',))
+        rows = cur.fetchall()
+    conn.rollback()
+    return rows
+
+
+def check(label: str, expected: list, backward: list, forward: list):
+    assert backward == expected, f'{label}: history walking back differs'
+    assert forward == expected, f'{label}: history walking forward differs'
+    print(f'{label}: {len(expected)} messages match in both directions')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--months', type=int, default=18)
+    parser.add_argument('--keep-months', type=int, default=6)
+    parser.add_argument('--limit', type=int, default=200)
+    parser.add_argument('--migrate', action='store_true', help='накатить db_migrations перед прогоном')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    start_local_s3()
+    chat_id, admin_id = seed_chat(conn, args.messages, args.months)
+    modules = load_modules('chats')
+    handler = modules['index'].handler
+    s3 = modules['partitions'].s3_client()
+    try:
+        s3.create_bucket(Bucket=modules['partitions'].S3_BUCKET)
+    except s3.exceptions.ClientError:
+        pass
+
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT id FROM {schema()}.messages WHERE chat_id = %s ORDER BY created_at, id', (chat_id,))
+        expected = [message_id for message_id, in cur.fetchall()]
+    conn.rollback()
+    print(f'partitions before: {len(partitions(conn))}')
+    backward, forward, samples = walk(handler, chat_id, args.limit)
+    check('before maintenance', expected, backward, forward)
+    report('history page (before maintenance)', samples)
+
+    total_ms, created, steps = 0.0, 0, 0
+    while True:
+        body, ms = timed(call, handler, 'PUT', {'action': 'maintain_partitions', 'admin_id': admin_id})
+        total_ms += ms
+        created += body['created']
+        steps += len(body['split'])
+        if not body['split']:
+            break
+    print(f'maintain_partitions: {created} partitions created, {steps} months split from legacy '
+          f'in {total_ms:.0f}ms, legacy left: {body["legacy"]}')
+    for name, rows in partitions(conn):
+        print(f'  {name:<20} ~{rows} rows')
+    backward, forward, samples = walk(handler, chat_id, args.limit)
+    check('after split', expected, backward, forward)
+    report('history page (partitioned)', samples)
+
+    if body['legacy']:
+        print('messages_legacy still holds the current month: archive step skipped')
+        return
+    body, ms = timed(call, handler, 'PUT', {'action': 'archive_messages', 'admin_id': admin_id,
+                                             'keep_months': args.keep_months})
+    archived = sum(month['messages'] for month in body['archived'])
+    print(f'archive_messages: {len(body["archived"])} months, {archived} messages in {ms:.0f}ms')
+    backward, forward, samples = walk(handler, chat_id, args.limit)
+    check('after archive', expected, backward, forward)
+    report('history page (online + archive)', samples)
+
+
+if __name__ == '__main__':
+    main()
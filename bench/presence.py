@@ -0,0 +1,121 @@
+'''Бенчмарк присутствия: поток пульсов через chats и пачечная запись last_seen.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/presence.py --migrate --users 5000 --threads 16 --seconds 20
+
+--threads потоков шлют chats heartbeat и typing за случайных из --users
+пользователей. Печатает пульсы/сек, сколько flush и строк UPDATE это стоило
+(против одного UPDATE на пульс), p50/p99 запроса присутствия на --ids
+пользователей через chats и users, и проверяет, что без финального flush
+у каждого пульсовавшего пользователя есть last_seen в БД и он онлайн: запись
+делает сам запрос с пульсом.
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+from _common import apply_migrations, connect, load_modules, report, schema, timed
+
+
+def seed(conn, total: int) -> list:
+    prefix = uuid.uuid4().hex[:6]
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            INSERT INTO {schema()}.users (phone, nickname, username)
+            SELECT '+7p' || %(prefix)s || i, 'presence ' || i, '@p' || %(prefix)s || i
+            FROM generate_series(1, %(total)s) i
+            RETURNING id
+        ''', {'prefix': prefix, 'total': total})
+        user_ids = sorted(row[0] for row in cur.fetchall())
+    conn.commit()
+    return user_ids
+
+
+def post(handler, body: dict) -> dict:
+    result = handler({'httpMethod': 'POST', 'body': json.dumps(body)}, None)
+    assert result['statusCode'] == 200, result['body']
+    return json.loads(result['body'])
+
+
+def get(handler, params: dict) -> dict:
+    result = handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+    assert result['statusCode'] == 200, result['body']
+    return json.loads(result['body'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--typing', type=float, default=0.3, help='доля typing среди запросов')
+    parser.add_argument('--ids', type=int, default=200, help='размер пачки в запросе присутствия')
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--migrate', action='store_true', help='накатить db_migrations перед прогоном')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    user_ids = seed(conn, args.users)
+    chats = load_modules('chats')
+    store = chats['presence'].store
+    handler = chats['index'].handler
+
+    pulsed = set()
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def worker():
+        while time.monotonic() < deadline:
+            user_id = random.choice(user_ids)
+            if random.random() < args.typing:
+                body = {'action': 'typing', 'user_id': user_id, 'chat_id': user_id % 100 + 1}
+            else:
+                body = {'action': 'heartbeat', 'user_id': user_id}
+            _, ms = timed(post, handler, body)
+            with lock:
+                pulsed.add(user_id)
+                samples.append(ms)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    stats = store.stats()
+    print(f'{stats["heartbeats"]} pulses in {elapsed:.1f}s ({stats["heartbeats"] / elapsed:.0f}/s) '
+          f'from {len(pulsed)} users: {stats["flushes"]} flushes, {stats["rows_written"]} rows written '
+          f'({stats["rows_written"] / max(stats["heartbeats"], 1):.1%} of pulses)')
+    report('heartbeat/typing request', samples)
+
+    assert stats['dirty'] == 0, f'{stats["dirty"]} pulses left unwritten after their requests'
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            SELECT COUNT(*) FROM {schema()}.users WHERE id = ANY(%s) AND last_seen IS NULL
+        ''', (sorted(pulsed),))
+        unseen = cur.fetchone()[0]
+    conn.rollback()
+    assert unseen == 0, f'{unseen} pulsed users have no last_seen in the database'
+
+    batch = sorted(random.sample(sorted(pulsed), min(args.ids, len(pulsed))))
+    params = {'action': 'presence', 'user_ids': ','.join(map(str, batch))}
+    users = load_modules('users')['index'].handler
+    for title, fn in (('chats presence', handler), ('users presence (database only)', users)):
+        runs = []
+        for _ in range(args.runs):
+            body, ms = timed(get, fn, params)
+            runs.append(ms)
+        online = sum(entry['online'] for entry in body['presence'])
+        assert online == len(batch), f'{title}: {online} of {len(batch)} pulsed users online'
+        report(f'{title} ({len(batch)} ids)', runs)
+
+
+if __name__ == '__main__':
+    main()
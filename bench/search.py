@@ -0,0 +1,91 @@
+'''Бенчмарк users?action=search&q= на таблице из миллиона пользователей.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/search.py --users 1000000 --target-ms 30
+
+Кеш горячих запросов отключён (SEARCH_CACHE_TTL=0), чтобы мерить сам запрос;
+отдельной строкой — повтор того же запроса с кешем.
+'''
+import argparse
+import json
+import os
+import random
+
+os.environ['SEARCH_CACHE_TTL'] = '0'
+
+from _common import apply_migrations, connect, load_function, percentile, report, schema, timed  # noqa: E402
+
+NAMES = ['alexander', 'maria', 'dmitry', 'anna', 'sergey', 'elena', 'ivan', 'olga', 'nikita', 'daria',
+         'mikhail', 'sofia', 'andrey', 'polina', 'pavel', 'ksenia', 'artem', 'victoria', 'egor', 'alina']
+
+
+def seed(conn, users: int):
+    s = schema()
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {s}.users WHERE phone LIKE '+78%%'")
+        existing = cur.fetchone()[0]
+        if existing >= users:
+            return
+        cur.execute(f'''
+            INSERT INTO {s}.users (phone, nickname, username)
+            SELECT '+78' || lpad(g::text, 10, '0'),
+                   initcap((%(names)s::text[])[1 + g %% 20]) || ' ' || initcap((%(names)s::text[])[1 + (g / 20) %% 20]),
+                   '@' || (%(names)s::text[])[1 + g %% 20] || '_' || g
+            FROM generate_series(%(start)s, %(end)s) g
+            ON CONFLICT DO NOTHING
+        ''', {'names': NAMES, 'start': existing + 1, 'end': users})
+        cur.execute(f'ANALYZE {s}.users')
+    conn.commit()
+
+
+def search(handler, q: str, cursor: str = None) -> dict:
+    params = {'action': 'search', 'q': q, 'limit': '20'}
+    if cursor:
+        params['cursor'] = cursor
+    return json.loads(handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)['body'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--target-ms', type=float, default=30.0, help='целевой p99 на запрос')
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    seed(conn, args.users)
+    users = load_function('users')
+
+    typo = lambda name: name[:2] + name[3] + name[2] + name[4:]
+    workloads = {
+        'short prefix (2 chars)': lambda: random.choice(NAMES)[:2],
+        'prefix': lambda: random.choice(NAMES)[:5],
+        'exact username': lambda: f'@{random.choice(NAMES)}_{random.randint(1, args.users)}',
+        'fuzzy (typo)': lambda: typo(random.choice(NAMES)),
+    }
+    failed = False
+    for name, make in workloads.items():
+        samples = [timed(search, users.handler, make())[1] for _ in range(args.queries)]
+        report(name, samples)
+        failed |= percentile(samples, 99) > args.target_ms
+
+    pages, cursor = [], None
+    for _ in range(min(args.queries, 50)):
+        body, ms = timed(search, users.handler, 'alex', cursor)
+        pages.append(ms)
+        cursor = body['next_cursor']
+        if not cursor:
+            break
+    report('next pages of "alex"', pages)
+
+    users.search_cache.ttl = 60
+    search(users.handler, 'maria')
+    report('cached repeat', [timed(search, users.handler, 'maria')[1] for _ in range(args.queries)])
+
+    print('p99 target', 'MISSED' if failed else 'met', f'({args.target_ms} ms)')
+
+
+if __name__ == '__main__':
+    main()
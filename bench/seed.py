@@ -0,0 +1,238 @@
+'''Наполняет схему V0001 данными реалистичного объёма для локального стенда и нагрузочных тестов.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/seed.py --users 100000 --messages 2000000
+
+Всё генерируется на стороне PostgreSQL (generate_series, random()) пачками по
+--batch строк, каждая пачка — своя транзакция, поэтому триггеры chat_stats и
+user_stats отрабатывают на уровне оператора, а прогресс виден по ходу.
+Распределения намеренно скошены: немного больших каналов и «горячих» чатов,
+много маленьких групп и личных переписок. Повторный запуск добавляет ещё
+один независимый набор (префикс телефонов и username уникален на прогон).
+'''
+import argparse
+import time
+import uuid
+
+from _common import apply_migrations, connect, schema
+
+NAMES = ['Алексей', 'Мария', 'Иван', 'Анна', 'Дмитрий', 'Елена', 'Сергей', 'Ольга', 'Никита', 'Ксения',
+         'Alex', 'Kate', 'John', 'Emma', 'Max', 'Lena', 'Artem', 'Sofia', 'Pavel', 'Daria']
+PHRASES = ['привет, как дела?', 'созвонимся вечером', 'скинь фото с концерта', 'встреча переносится на завтра',
+           'отличная идея, давай', 'кто идёт на матч в субботу?', 'посмотри новый релиз', 'я уже в пути',
+           'hello there', 'see you tomorrow', 'check the new playlist', 'meeting moved to friday',
+           'great job on the release', 'where are we going tonight?', 'sending the documents now']
+WORDS = ['музыка', 'кино', 'работа', 'отпуск', 'футбол', 'кофе', 'погода', 'проект', 'music', 'deadline',
+         'coffee', 'weekend', 'travel', 'game', 'photo', 'release', 'concert', 'report']
+GIFTS = [('🎁', 'Подарок'), ('🌹', 'Роза'), ('🧸', 'Мишка'), ('💎', 'Бриллиант'), ('🎂', 'Торт')]
+
+
+class Seeder:
+    def __init__(self, conn, batch: int):
+        self.conn = conn
+        self.batch = batch
+        self.tag = uuid.uuid4().hex[:5]
+
+    def step(self, title: str, total: int, sql: str, params: dict = None):
+        '''Выполняет sql для диапазонов [lo, hi] по total строк пачками, печатая прогресс'''
+        started = time.perf_counter()
+        done = 0
+        with self.conn.cursor() as cur:
+            for lo in range(1, total + 1, self.batch):
+                hi = min(lo + self.batch - 1, total)
+                cur.execute(sql, {**(params or {}), 'lo': lo, 'hi': hi, 'tag': self.tag})
+                self.conn.commit()
+                done += max(cur.rowcount, 0)
+                elapsed = time.perf_counter() - started
+                print(f'\r{title:<14} {hi:>10}/{total} rows={done:<10} {done / elapsed:9.0f} rows/sec',
+                      end='', flush=True)
+        print()
+
+    def run(self, args):
+        s = schema()
+        with self.conn.cursor() as cur:
+            # Временные таблицы живут до конца сессии: порядковые номера -> id этого прогона
+            cur.execute('CREATE TEMP TABLE seed_users (n INTEGER PRIMARY KEY, id INTEGER NOT NULL)')
+            cur.execute('''CREATE TEMP TABLE seed_chats (n INTEGER PRIMARY KEY, id INTEGER NOT NULL,
+                                                         type TEXT NOT NULL, size INTEGER NOT NULL)''')
+            cur.execute('CREATE TEMP TABLE seed_members (n INTEGER PRIMARY KEY, chat_id INTEGER, ids INTEGER[])')
+        self.conn.commit()
+
+        self.step('users', args.users, f'''
+            WITH created AS (
+                INSERT INTO {s}.users (phone, nickname, username, language, show_online, enots, verified)
+                SELECT '+7s' || %(tag)s || '-' || i,
+                       (%(names)s::text[])[1 + floor(random() * cardinality(%(names)s::text[]))::int] || ' ' || i,
+                       '@seed_' || %(tag)s || '_' || i,
+                       CASE WHEN random() < 0.15 THEN 'en' ELSE 'ru' END,
+                       random() < 0.8,
+                       floor(random() * 500)::int,
+                       random() < 0.01
+                FROM generate_series(%(lo)s, %(hi)s) i
+                RETURNING id, username
+            )
+            INSERT INTO seed_users (n, id)
+            SELECT split_part(username, '_', 3)::int, id FROM created
+        ''', {'names': NAMES})
+
+        # Размер группы/канала — степенное распределение: медиана небольшая, хвост до max
+        chats_total = args.groups + args.channels + args.personal
+        self.step('chats', chats_total, f'''
+            WITH spec AS (
+                SELECT i,
+                       CASE WHEN i <= %(groups)s THEN 'group'
+                            WHEN i <= %(groups)s + %(channels)s THEN 'channel'
+                            ELSE 'personal' END AS type,
+                       1 + floor(random() * %(users)s)::int AS creator
+                FROM generate_series(%(lo)s, %(hi)s) i
+            ),
+            created AS (
+                INSERT INTO {s}.chats (type, name, created_by)
+                SELECT spec.type,
+                       CASE WHEN spec.type = 'personal' THEN NULL ELSE spec.type || ' ' || %(tag)s || ' #' || spec.i END,
+                       u.id
+                FROM spec JOIN seed_users u ON u.n = spec.creator
+                ORDER BY spec.i
+                RETURNING id, type, name
+            )
+            INSERT INTO seed_chats (n, id, type, size)
+            SELECT row_number() OVER (ORDER BY id) + %(lo)s - 1, id, type,
+                   CASE type
+                       WHEN 'personal' THEN 2
+                       WHEN 'group' THEN LEAST(%(max_group)s, 3 + floor(4 / power(random(), 0.9))::int)
+                       ELSE LEAST(%(max_channel)s, 20 + floor(50 / power(random(), 1.3))::int)
+                   END
+            FROM created
+        ''', {'groups': args.groups, 'channels': args.channels, 'users': args.users,
+              'max_group': args.max_group, 'max_channel': min(args.max_channel, args.users)})
+
+        self.step('members', chats_total, f'''
+            INSERT INTO {s}.chat_members (chat_id, user_id, role)
+            SELECT r.chat_id, u.id, CASE WHEN r.g = 1 THEN 'admin' ELSE 'member' END
+            FROM (
+                SELECT c.id AS chat_id, g, 1 + floor(random() * %(users)s)::int AS pick
+                FROM seed_chats c CROSS JOIN LATERAL generate_series(1, c.size) g
+                WHERE c.n BETWEEN %(lo)s AND %(hi)s
+                OFFSET 0
+            ) r
+            JOIN seed_users u ON u.n = r.pick
+            ON CONFLICT (chat_id, user_id) DO NOTHING
+        ''', {'users': args.users})
+
+        with self.conn.cursor() as cur:
+            cur.execute(f'''
+                INSERT INTO seed_members (n, chat_id, ids)
+                SELECT c.n, c.id, array_agg(m.user_id)
+                FROM seed_chats c JOIN {s}.chat_members m ON m.chat_id = c.id
+                GROUP BY c.n, c.id
+            ''')
+            cur.execute('SELECT max(n) FROM seed_members')
+            chats_with_members = cur.fetchone()[0] or 0
+        self.conn.commit()
+
+        # Чат выбирается со скосом к малым n: небольшая доля чатов получает большую часть сообщений.
+        # Время растёт с номером сообщения, поэтому история упорядочена как в живой базе.
+        self.step('messages', args.messages, f'''
+            INSERT INTO {s}.messages (chat_id, sender_id, message_text, media_type, created_at)
+            SELECT m.chat_id,
+                   m.ids[1 + floor(random() * cardinality(m.ids))::int],
+                   (%(phrases)s::text[])[1 + floor(random() * cardinality(%(phrases)s::text[]))::int] || ' ' ||
+                   (%(words)s::text[])[1 + floor(random() * cardinality(%(words)s::text[]))::int],
+                   CASE WHEN random() < 0.9 THEN 'text' ELSE 'photo' END,
+                   now() - make_interval(days => %(days)s) * (1 - r.i::float / %(total)s) + random() * interval '1 minute'
+            FROM (
+                SELECT i, 1 + floor(%(chats)s * power(random(), 3))::int AS pick
+                FROM generate_series(%(lo)s, %(hi)s) i
+                OFFSET 0
+            ) r
+            JOIN seed_members m ON m.n = r.pick
+        ''', {'phrases': PHRASES, 'words': WORDS, 'days': args.days, 'total': args.messages,
+              'chats': chats_with_members})
+
+        self.step('friendships', args.users * args.friends, f'''
+            INSERT INTO {s}.friendships (user_id, friend_id, status)
+            SELECT a.id, b.id, CASE WHEN random() < 0.85 THEN 'accepted' ELSE 'pending' END
+            FROM (
+                SELECT 1 + (i - 1) / %(friends)s AS a, 1 + floor(random() * %(users)s)::int AS b
+                FROM generate_series(%(lo)s, %(hi)s) i
+                OFFSET 0
+            ) r
+            JOIN seed_users a ON a.n = r.a
+            JOIN seed_users b ON b.n = r.b
+            WHERE a.id <> b.id
+            ON CONFLICT (user_id, friend_id) DO NOTHING
+        ''', {'friends': args.friends, 'users': args.users})
+
+        self.step('blocked', args.users // 20, f'''
+            INSERT INTO {s}.blocked_users (user_id, blocked_user_id)
+            SELECT a.id, b.id
+            FROM (
+                SELECT 1 + floor(random() * %(users)s)::int AS a, 1 + floor(random() * %(users)s)::int AS b
+                FROM generate_series(%(lo)s, %(hi)s) i
+                OFFSET 0
+            ) r
+            JOIN seed_users a ON a.n = r.a
+            JOIN seed_users b ON b.n = r.b
+            WHERE a.id <> b.id
+            ON CONFLICT (user_id, blocked_user_id) DO NOTHING
+        ''', {'users': args.users})
+
+        self.step('gifts', args.users // 4, f'''
+            INSERT INTO {s}.user_gifts (user_id, gift_emoji, gift_name, from_user_id)
+            SELECT a.id, g.emoji, g.name, b.id
+            FROM (
+                SELECT 1 + floor(random() * %(users)s)::int AS a, 1 + floor(random() * %(users)s)::int AS b,
+                       1 + floor(random() * %(gifts)s)::int AS k
+                FROM generate_series(%(lo)s, %(hi)s) i
+                OFFSET 0
+            ) r
+            JOIN seed_users a ON a.n = r.a
+            JOIN seed_users b ON b.n = r.b
+            JOIN unnest(%(emojis)s::text[], %(gift_names)s::text[]) WITH ORDINALITY AS g(emoji, name, k) ON g.k = r.k
+        ''', {'users': args.users, 'emojis': [e for e, _ in GIFTS], 'gift_names': [n for _, n in GIFTS],
+              'gifts': len(GIFTS)})
+
+        self.step('transactions', args.users, f'''
+            INSERT INTO {s}.transactions (user_id, type, amount, description)
+            SELECT u.id,
+                   (ARRAY['topup', 'purchase', 'gift_sent', 'gift_received'])[1 + floor(random() * 4)::int],
+                   10 * (1 + floor(random() * 50)::int),
+                   'seed'
+            FROM (
+                SELECT 1 + floor(random() * %(users)s)::int AS pick
+                FROM generate_series(%(lo)s, %(hi)s) i
+                OFFSET 0
+            ) r
+            JOIN seed_users u ON u.n = r.pick
+        ''', {'users': args.users})
+
+        self.conn.autocommit = True
+        with self.conn.cursor() as cur:
+            for table in ('users', 'chats', 'chat_members', 'messages', 'friendships', 'blocked_users',
+                          'user_gifts', 'transactions', 'chat_stats', 'user_stats'):
+                cur.execute(f'ANALYZE {s}.{table}')
+        print(f'seed {self.tag}: done, tables analyzed')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--groups', type=int, default=5_000)
+    parser.add_argument('--channels', type=int, default=300)
+    parser.add_argument('--personal', type=int, default=50_000)
+    parser.add_argument('--max-group', type=int, default=2_000)
+    parser.add_argument('--max-channel', type=int, default=50_000)
+    parser.add_argument('--messages', type=int, default=2_000_000)
+    parser.add_argument('--friends', type=int, default=20, help='исходящих заявок на пользователя')
+    parser.add_argument('--days', type=int, default=365, help='за сколько дней распределена история')
+    parser.add_argument('--batch', type=int, default=50_000)
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    Seeder(conn, args.batch).run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''Микробенчмарк ответа со списком участников: RealDictCursor + dict(row) + json.dumps
+против TupleCursor.records() + runtime.dumps (orjson, если установлен).
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/serialize.py --rows 1000
+    python bench/serialize.py --offline          # только сериализация, без базы
+
+С базой меряется весь путь от fetchall до тела ответа на чате с --rows
+участниками; --offline сравнивает только кодирование 1k строк того же вида.
+'''
+import argparse
+import datetime
+import json
+import sys
+import time
+import uuid
+
+from _common import BACKEND, apply_migrations, connect, create_chat, ensure_user, schema
+
+sys.path.insert(0, str(BACKEND / 'chats'))
+import runtime  # noqa: E402
+
+MEMBERS_SQL = '''
+    SELECT u.id, u.nickname, u.username, u.avatar_url, u.verified, cm.role, cm.joined_at
+    FROM {schema}.users u
+    JOIN {schema}.chat_members cm ON u.id = cm.user_id
+    WHERE cm.chat_id = %s
+'''
+
+
+def json_serial(obj):
+    '''Прежний default из chats/index.py'''
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError(f'Type {type(obj)} not serializable')
+
+
+def per_call_us(fn, iterations: int) -> float:
+    fn()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def offline(rows: int, iterations: int):
+    now = datetime.datetime.now()
+    members = [{'id': i, 'nickname': f'участник {i}', 'username': f'@member{i}',
+                'avatar_url': f'https://cdn.poehali.dev/speaky/media/ab/{i:064x}', 'verified': i % 7 == 0,
+                'role': 'member', 'joined_at': now} for i in range(rows)]
+    tuples = [tuple(m.values()) for m in members]
+    names = list(members[0])
+
+    results = {
+        'dict copy + json.dumps': per_call_us(
+            lambda: json.dumps([dict(m) for m in members], default=json_serial), iterations),
+        'zip records + runtime.dumps': per_call_us(
+            lambda: runtime.dumps([dict(zip(names, row)) for row in tuples]), iterations),
+    }
+    report(results, rows)
+
+
+def online(rows: int, iterations: int, migrate: bool):
+    import psycopg2.extras
+
+    conn = connect()
+    if migrate:
+        apply_migrations(conn)
+    with conn.cursor() as cur:
+        owner = ensure_user(cur)
+        chat_id = create_chat(cur, f'bench-serialize-{uuid.uuid4().hex[:8]}', owner, 'channel')
+        prefix = uuid.uuid4().hex[:6]
+        cur.execute(f'''
+            WITH created AS (
+                INSERT INTO {schema()}.users (phone, nickname, username)
+                SELECT '+7s' || %(prefix)s || i, 'участник ' || i, '@s' || %(prefix)s || i
+                FROM generate_series(1, %(rows)s) i
+                RETURNING id
+            )
+            INSERT INTO {schema()}.chat_members (chat_id, user_id) SELECT %(chat_id)s, id FROM created
+        ''', {'prefix': prefix, 'rows': rows, 'chat_id': chat_id})
+    conn.commit()
+
+    sql = MEMBERS_SQL.format(schema=schema())
+    real_dict = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    tuple_cursor = conn.cursor(cursor_factory=runtime.TupleCursor)
+
+    def before():
+        real_dict.execute(sql, (chat_id,))
+        return json.dumps([dict(m) for m in real_dict.fetchall()], default=json_serial)
+
+    def after():
+        tuple_cursor.execute(sql, (chat_id,))
+        return runtime.dumps(tuple_cursor.records())
+
+    assert json.loads(before()) == json.loads(after())
+    report({'RealDictCursor + json.dumps': per_call_us(before, iterations),
+            'TupleCursor + runtime.dumps': per_call_us(after, iterations)}, rows)
+    conn.rollback()
+
+
+def report(results: dict, rows: int):
+    print(f'orjson: {"yes" if runtime.orjson else "no"}')
+    baseline = next(iter(results.values()))
+    for name, us in results.items():
+        print(f'{name:<30} {rows} rows  {us:9.0f} us/response  ({baseline / us:.2f}x)')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--offline', action='store_true')
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    if args.offline:
+        offline(args.rows, args.iterations)
+    else:
+        online(args.rows, args.iterations, args.migrate)
+
+
+if __name__ == '__main__':
+    main()
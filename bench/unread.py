@@ -0,0 +1,157 @@
+'''Бенчмарк прочитанного: поток mark_read при прокрутке и бейджи непрочитанных в списке.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/unread.py --migrate --members 2000 --messages 5000
+
+Создаёт группу с --members участниками и --messages сообщениями, затем
+--threads потоков имитируют прокрутку: каждый участник отмечает прочитанным
+всё более поздние сообщения. Сообщения после вступления идут через
+send_batch, чтобы получить номера в чате (V0020): read_count отметки берётся
+из них. Печатает отметки/сек и сколько из них сдвинули водяной знак, потом
+сверяет, что водяной знак каждого участника — его последняя отметка, а
+unread_count в chats?action=list совпадает с честным COUNT(*) по messages. Отправка проверяется отдельно: у отправителя чат становится прочитанным.
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+from _common import apply_migrations, connect, create_chat, ensure_user, load_modules, report, schema, timed
+
+
+def seed(conn, members: int, messages: int) -> tuple:
+    s = schema()
+    prefix = uuid.uuid4().hex[:6]
+    with conn.cursor() as cur:
+        owner_id = ensure_user(cur, '+70000000023', 'bench-unread')
+        chat_id = create_chat(cur, f'bench-unread-{prefix}', owner_id)
+        cur.execute(f'''
+            INSERT INTO {s}.messages (chat_id, sender_id, message_text, media_type)
+            SELECT %s, %s, 'message #' || g, 'text' FROM generate_series(1, %s) g
+        ''', (chat_id, owner_id, messages))
+        cur.execute(f'''
+            WITH created AS (
+                INSERT INTO {s}.users (phone, nickname, username)
+                SELECT '+7r' || %(prefix)s || i, 'reader ' || i, '@r' || %(prefix)s || i
+                FROM generate_series(1, %(members)s) i
+                RETURNING id
+            )
+            INSERT INTO {s}.chat_members (chat_id, user_id, role)
+            SELECT %(chat_id)s, id, 'member' FROM created
+            RETURNING user_id
+        ''', {'prefix': prefix, 'members': members, 'chat_id': chat_id})
+        user_ids = sorted(row[0] for row in cur.fetchall())
+    conn.commit()
+    return chat_id, owner_id, user_ids
+
+
+def call(handler, method: str, payload: dict) -> dict:
+    if method == 'GET':
+        result = handler({'httpMethod': 'GET', 'queryStringParameters': payload}, None)
+    else:
+        result = handler({'httpMethod': method, 'body': json.dumps(payload)}, None)
+    assert result['statusCode'] == 200, result['body']
+    return json.loads(result['body'])
+
+
+def unread_in_list(handler, user_id: int, chat_id: int) -> int:
+    chats = call(handler, 'GET', {'action': 'list', 'user_id': str(user_id)})
+    return next(chat['unread_count'] for chat in chats if chat['id'] == chat_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--check', type=int, default=50, help='сколько участников сверить с COUNT(*)')
+    parser.add_argument('--migrate', action='store_true', help='накатить db_migrations перед прогоном')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    chat_id, owner_id, user_ids = seed(conn, args.members, args.messages)
+    modules = load_modules('chats')
+    handler = modules['index'].handler
+
+    unread = unread_in_list(handler, user_ids[0], chat_id)
+    assert unread == 0, f'new member sees {unread} unread messages from before joining'
+
+    # Сообщения после вступления — непрочитанные у всех участников
+    batch_max = modules['index'].SEND_BATCH_MAX
+    message_ids = []
+    for start in range(0, args.messages, batch_max):
+        batch = [{'message_text': f'unread #{n}'} for n in range(start, min(start + batch_max, args.messages))]
+        sent = call(handler, 'POST', {'action': 'send_batch', 'chat_id': chat_id, 'user_id': owner_id,
+                                      'messages': batch})
+        message_ids.extend(message['id'] for message in sent['messages'])
+    message_ids.sort()
+    assert unread_in_list(handler, user_ids[0], chat_id) == len(message_ids)
+
+    position = {user_id: 0 for user_id in user_ids}
+    samples = []
+    moved = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def worker():
+        while time.monotonic() < deadline:
+            user_id = random.choice(user_ids)
+            with lock:
+                # Прокрутка вперёд на несколько сообщений; иногда устаревшая отметка с другого устройства
+                step = random.randint(-3, 20)
+                if step > 0:
+                    position[user_id] = min(len(message_ids) - 1, position[user_id] + step)
+                    target = message_ids[position[user_id]]
+                else:
+                    target = message_ids[max(0, position[user_id] + step)]
+            result, ms = timed(call, handler, 'POST', {'action': 'mark_read', 'user_id': user_id,
+                                                       'chat_id': chat_id, 'message_id': target})
+            with lock:
+                samples.append(ms)
+                moved[0] += len(result['chats'])
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f'{len(samples)} marks in {elapsed:.1f}s ({len(samples) / elapsed:.0f}/s): '
+          f'{moved[0]} moved a watermark')
+    report('mark_read request', samples)
+
+    s = schema()
+    checked = random.sample(user_ids, min(args.check, len(user_ids)))
+    with conn.cursor() as cur:
+        cur.execute(f'''
+            SELECT cm.user_id, cm.last_read_message_id,
+                   (SELECT COUNT(*) FROM {s}.messages m WHERE m.chat_id = cm.chat_id AND m.id > cm.last_read_message_id)
+            FROM {s}.chat_members cm
+            WHERE cm.chat_id = %s AND cm.user_id = ANY(%s)
+        ''', (chat_id, checked))
+        rows = cur.fetchall()
+    conn.rollback()
+    list_samples = []
+    for user_id, watermark, expected in rows:
+        if position[user_id]:
+            assert watermark == message_ids[position[user_id]], f'user {user_id}: watermark {watermark}'
+        actual, ms = timed(unread_in_list, handler, user_id, chat_id)
+        list_samples.append(ms)
+        assert actual == expected, f'user {user_id}: list says {actual} unread, messages say {expected}'
+    report(f'list with unread badges ({len(rows)} users)', list_samples)
+
+    sender = user_ids[-1]
+    call(handler, 'POST', {'action': 'send', 'chat_id': chat_id, 'user_id': sender, 'message_text': 'read'})
+    assert unread_in_list(handler, sender, chat_id) == 0, 'sender has unread messages after sending'
+    receipts = call(handler, 'GET', {'action': 'receipts', 'chat_id': str(chat_id), 'message_id': str(message_ids[-1])})
+    print(f'ok: watermarks and unread counts match; last message read by {receipts["read_by"]}')
+
+
+if __name__ == '__main__':
+    main()
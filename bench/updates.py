@@ -0,0 +1,117 @@
+'''Нагрузочный тест доставки: опрос chats?action=list против long-poll action=updates.
+
+    DATABASE_URL=postgresql://localhost/speaky python bench/updates.py --clients 200 --seconds 30
+
+Клиенты сидят в одних и тех же чатах, писатель отправляет сообщения с заданной
+частотой. Для каждого режима печатается число транзакций PostgreSQL в секунду
+(pg_stat_database) и сколько ответов принесли клиентам новые сообщения.
+'''
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from _common import apply_migrations, connect, create_chat, ensure_user, load_function, schema
+
+
+def db_transactions(conn) -> int:
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_stat_clear_snapshot()')
+        cur.execute('SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()')
+        value = cur.fetchone()[0]
+    conn.rollback()
+    return value
+
+
+def seed(conn, clients: int, chats: int) -> tuple:
+    with conn.cursor() as cur:
+        user_ids = [ensure_user(cur, f'+7100{i:07d}', f'bench_updates_{i}') for i in range(clients + 1)]
+        chat_ids = [create_chat(cur, f'bench-updates-{uuid.uuid4().hex[:8]}', user_ids[0]) for _ in range(chats)]
+        cur.execute(f'''
+            INSERT INTO {schema()}.chat_members (chat_id, user_id)
+            SELECT c, u FROM unnest(%s::int[]) c, unnest(%s::int[]) u
+            ON CONFLICT DO NOTHING
+        ''', (chat_ids, user_ids))
+    conn.commit()
+    return user_ids, chat_ids
+
+
+def poll_client(handler, user_id: int, interval: float, stop: threading.Event, delivered: list):
+    seen = None
+    while not stop.is_set():
+        response = handler({'httpMethod': 'GET', 'queryStringParameters': {'action': 'list', 'user_id': str(user_id)}}, None)
+        latest = max([c['last_message_id'] or 0 for c in json.loads(response['body'])], default=0)
+        if seen is not None and latest > seen:
+            delivered.append(1)
+        seen = latest
+        stop.wait(interval)
+
+
+def longpoll_client(handler, user_id: int, stop: threading.Event, delivered: list):
+    cursor = None
+    while not stop.is_set():
+        params = {'action': 'updates', 'user_id': str(user_id), 'timeout': '5', **({'cursor': cursor} if cursor else {})}
+        body = json.loads(handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)['body'])
+        if cursor and body['events']:
+            delivered.append(1)
+        cursor = body['cursor']
+
+
+def writer(handler, user_id: int, chat_ids: list, rate: float, stop: threading.Event):
+    while not stop.is_set():
+        handler({'httpMethod': 'POST', 'body': json.dumps({
+            'action': 'send', 'chat_id': random.choice(chat_ids), 'user_id': user_id, 'message_text': 'ping'
+        })}, None)
+        stop.wait(1 / rate)
+
+
+def run(mode: str, chats_module, conn, user_ids: list, chat_ids: list, args) -> None:
+    stop = threading.Event()
+    delivered = []
+    if mode == 'poll':
+        clients = [threading.Thread(target=poll_client, args=(chats_module.handler, u, args.poll_interval, stop, delivered))
+                   for u in user_ids[1:]]
+    else:
+        clients = [threading.Thread(target=longpoll_client, args=(chats_module.handler, u, stop, delivered))
+                   for u in user_ids[1:]]
+    write = threading.Thread(target=writer, args=(chats_module.handler, user_ids[0], chat_ids, args.rate, stop))
+
+    before = db_transactions(conn)
+    started = time.perf_counter()
+    for thread in clients + [write]:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in clients + [write]:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    xacts = db_transactions(conn) - before
+    print(f'{mode:<10} clients={len(clients):<5} db xact/sec={xacts / elapsed:9.1f}  useful responses={len(delivered)}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--rate', type=float, default=5, help='сообщений в секунду от писателя')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--migrate', action='store_true')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.clients + 2))
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    user_ids, chat_ids = seed(conn, args.clients, args.chats)
+    chats_module = load_function('chats')
+
+    run('poll', chats_module, conn, user_ids, chat_ids, args)
+    run('long-poll', chats_module, conn, user_ids, chat_ids, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+'''Память и пропускная способность загрузки: base64-в-JSON, multipart через функцию, presigned PUT.
+
+    python bench/upload.py --sizes 10 100 1024
+
+Нужен DATABASE_URL с накатанными db_migrations (media_objects).
+Без S3_ENDPOINT_URL поднимает локальный moto server (pip install "moto[server]");
+для MinIO задайте S3_ENDPOINT_URL, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY.
+Пиковая память — tracemalloc только на время вызовов handler, то есть то,
+что держит сама функция.
+'''
+import argparse
+import base64
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+from _common import load_function, report, start_local_s3
+
+MB = 1024 * 1024
+
+
+class Meter:
+    '''Суммарное время и пиковая память вызовов handler'''
+
+    def __init__(self, trace: bool):
+        self.trace = trace
+        self.seconds = 0.0
+        self.peak = 0
+
+    def call(self, handler, event: dict) -> dict:
+        if self.trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            result = handler(event, None)
+        finally:
+            self.seconds += time.perf_counter() - started
+            if self.trace:
+                self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        assert result['statusCode'] == 200, result['body']
+        return json.loads(result['body'])
+
+
+def legacy(handler, path: str, meter: Meter):
+    with open(path, 'rb') as f:
+        # Свежий префикс, чтобы повторный прогон не схлопнулся дедупликацией по sha256
+        data = os.urandom(16) + f.read()[16:]
+        body = json.dumps({'file': base64.b64encode(data).decode(), 'type': 'video', 'user_id': 1})
+    del data
+    meter.call(handler, {'httpMethod': 'POST', 'body': body})
+
+
+def multipart(handler, path: str, meter: Meter, part_size: int):
+    post = lambda body: meter.call(handler, {'httpMethod': 'POST', 'body': json.dumps(body)})
+    upload = post({'action': 'multipart_start', 'type': 'video', 'user_id': 1})
+    parts = []
+    with open(path, 'rb') as f:
+        number = 1
+        while chunk := f.read(part_size):
+            params = {'key': upload['key'], 'upload_id': upload['upload_id'], 'part_number': str(number)}
+            event = {'httpMethod': 'PUT', 'queryStringParameters': params,
+                     'body': base64.b64encode(chunk).decode(), 'isBase64Encoded': True}
+            del chunk
+            parts.append(meter.call(handler, event))
+            number += 1
+    post({'action': 'multipart_complete', 'key': upload['key'], 'upload_id': upload['upload_id'], 'parts': parts})
+
+
+def presigned(handler, path: str, meter: Meter):
+    grant = meter.call(handler, {'httpMethod': 'POST', 'body': json.dumps({'action': 'presign', 'type': 'video', 'user_id': 1})})
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        request = urllib.request.Request(grant['upload_url'], data=f, method='PUT', headers={
+            **grant['headers'], 'Content-Length': str(os.path.getsize(path))
+        })
+        urllib.request.urlopen(request).read()
+    # Передача идёт мимо функции; в пропускную способность её всё равно включаем
+    meter.seconds += time.perf_counter() - started
+
+
+def avatars(upload, count: int) -> None:
+    '''Мелкие файлы: общий на процесс клиент против клиента на каждый вызов (как было раньше)'''
+    for name, reuse in (('fresh client per call', False), ('shared client', True)):
+        samples = []
+        for _ in range(count):
+            if not reuse:
+                upload._s3 = None
+            body = json.dumps({'file': base64.b64encode(os.urandom(20 * 1024)).decode(), 'type': 'avatar', 'user_id': 1})
+            event = {'httpMethod': 'POST', 'body': body}
+            started = time.perf_counter()
+            assert upload.handler(event, None)['statusCode'] == 200
+            samples.append((time.perf_counter() - started) * 1000)
+        report(f'20 KB avatar, {name}', samples)
+
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        assert json.loads(upload.handler(event, None)['body'])['deduplicated']
+        samples.append((time.perf_counter() - started) * 1000)
+    report('20 KB avatar, repeat (dedup hit)', samples)
+    print('metrics:', upload.handler({'httpMethod': 'POST', 'body': json.dumps({'action': 'metrics'})}, None)['body'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100], help='размеры файлов в МБ')
+    parser.add_argument('--part-size', type=int, default=8, help='размер части multipart в МБ')
+    parser.add_argument('--avatars', type=int, default=100, help='сколько мелких загрузок для замера задержки')
+    parser.add_argument('--legacy-max', type=int, default=200, help='base64-путь пропускается для файлов больше, МБ')
+    args = parser.parse_args()
+
+    start_local_s3()
+    upload = load_function('upload')
+    s3 = upload.s3_client()
+    try:
+        s3.create_bucket(Bucket=upload.S3_BUCKET)
+    except s3.exceptions.ClientError:
+        pass
+
+    avatars(upload, args.avatars)
+    for size in args.sizes:
+        with tempfile.NamedTemporaryFile() as f:
+            for _ in range(size):
+                f.write(os.urandom(MB))
+            f.flush()
+            modes = {
+                'base64 json': lambda m: legacy(upload.handler, f.name, m),
+                'multipart proxy': lambda m: multipart(upload.handler, f.name, m, args.part_size * MB),
+                'presigned PUT': lambda m: presigned(upload.handler, f.name, m)
+            }
+            for name, run in modes.items():
+                if name == 'base64 json' and size > args.legacy_max:
+                    print(f'{size:>6} MB  {name:<16} skipped (> --legacy-max)')
+                    continue
+                speed = Meter(trace=False)
+                run(speed)
+                memory = Meter(trace=True)
+                run(memory)
+                print(f'{size:>6} MB  {name:<16} {size / speed.seconds:8.1f} MB/s  '
+                      f'function peak {memory.peak / MB:8.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
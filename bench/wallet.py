@@ -0,0 +1,180 @@
+'''Нагрузочная проверка кошелька: параллельные переводы и подарки без потерянных обновлений.
+
+    DATABASE_URL=postgresql://localhost/speaky DB_POOL_MAX_SIZE=32 python bench/wallet.py --migrate \
+        --users 200 --threads 32 --seconds 20 --hot 0.2
+
+Пополняет --users новых пользователей через topup, затем --threads потоков
+шлют в handler wallet переводы одному и многим получателям (transfer) и
+подарки нескольким получателям (send_gift). Доля --hot запросов списывает с
+одного «горячего» счёта, а доля --retry отправляется дважды одновременно с
+тем же idempotency_key. По успешным ответам скрипт ведёт ожидаемые балансы и
+в конце сверяет их с users.enots, проверяет, что отрицательных балансов нет,
+журнал сходится (wallet_discrepancies) и каждый ключ проведён не больше раза.
+Печатает переводы/сек, отказы по балансу и p50/p99.
+'''
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from _common import apply_migrations, connect, ensure_user, load_modules, report, schema
+
+
+def seed(conn, total: int) -> tuple:
+    prefix = uuid.uuid4().hex[:6]
+    with conn.cursor() as cur:
+        admin_id = ensure_user(cur, '+70000000021', 'bench-wallet')
+        cur.execute(f'UPDATE {schema()}.users SET is_admin = TRUE WHERE id = %s', (admin_id,))
+        cur.execute(f'''
+            INSERT INTO {schema()}.users (phone, nickname, username)
+            SELECT '+7w' || %(prefix)s || i, 'wallet ' || i, '@w' || %(prefix)s || i
+            FROM generate_series(1, %(total)s) i
+            RETURNING id
+        ''', {'prefix': prefix, 'total': total})
+        user_ids = sorted(row[0] for row in cur.fetchall())
+    conn.commit()
+    return admin_id, user_ids
+
+
+def call(handler, body: dict) -> tuple:
+    result = handler({'httpMethod': 'POST', 'body': json.dumps(body)}, None)
+    return result['statusCode'], json.loads(result['body'])
+
+
+class Stress:
+    '''Потоки со случайными переводами; ожидаемые балансы считаются по успешным ответам'''
+
+    def __init__(self, handler, user_ids: list, gifts: dict, args):
+        self.handler = handler
+        self.user_ids = user_ids
+        self.gifts = gifts
+        self.args = args
+        self.lock = threading.Lock()
+        self.deltas = Counter()
+        self.samples = []
+        self.statuses = Counter()
+        self.applied = Counter()
+        self.duplicates = 0
+
+    def request(self) -> tuple:
+        '''Тело запроса и изменения балансов, если он пройдёт'''
+        args = self.args
+        sender = self.user_ids[0] if random.random() < args.hot else random.choice(self.user_ids)
+        others = [user_id for user_id in random.sample(self.user_ids, args.max_recipients + 1) if user_id != sender]
+        recipients = others[:random.randint(1, args.max_recipients)]
+        body = {'user_id': sender, 'recipient_ids': recipients, 'idempotency_key': uuid.uuid4().hex}
+        if random.random() < args.gifts:
+            gift_id = random.choice(list(self.gifts))
+            price = self.gifts[gift_id][2]
+            return {**body, 'action': 'send_gift', 'gift_id': gift_id}, {sender: -price * len(recipients)}
+        amount = random.randint(1, args.max_amount)
+        deltas = {sender: -amount * len(recipients), **dict.fromkeys(recipients, amount)}
+        return {**body, 'action': 'transfer', 'amount': amount}, deltas
+
+    def send(self, body: dict, deltas: dict):
+        started = time.perf_counter()
+        status, result = call(self.handler, body)
+        ms = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.samples.append(ms)
+            self.statuses[status] += 1
+            if status != 200:
+                return
+            if result.get('duplicate'):
+                self.duplicates += 1
+                return
+            self.applied[body['idempotency_key']] += 1
+            self.deltas.update(deltas)
+
+    def worker(self, deadline: float):
+        while time.monotonic() < deadline:
+            body, deltas = self.request()
+            if random.random() < self.args.retry:
+                # Повтор клиента, пока первый запрос ещё в полёте
+                twin = threading.Thread(target=self.send, args=(body, deltas))
+                twin.start()
+                self.send(body, deltas)
+                twin.join()
+            else:
+                self.send(body, deltas)
+
+    def run(self) -> float:
+        deadline = time.monotonic() + self.args.seconds
+        threads = [threading.Thread(target=self.worker, args=(deadline,)) for _ in range(self.args.threads)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+
+def balances(conn, user_ids: list) -> dict:
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT id, enots FROM {schema()}.users WHERE id = ANY(%s)', (user_ids,))
+        rows = dict(cur.fetchall())
+    conn.rollback()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--balance', type=int, default=5000, help='начальный баланс каждого пользователя')
+    parser.add_argument('--hot', type=float, default=0.2, help='доля списаний с одного счёта')
+    parser.add_argument('--retry', type=float, default=0.05, help='доля запросов, отправленных дважды')
+    parser.add_argument('--gifts', type=float, default=0.3, help='доля send_gift среди запросов')
+    parser.add_argument('--max-recipients', type=int, default=20)
+    parser.add_argument('--max-amount', type=int, default=50)
+    parser.add_argument('--migrate', action='store_true', help='накатить db_migrations перед прогоном')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.threads * 2))
+    conn = connect()
+    if args.migrate:
+        apply_migrations(conn)
+    admin_id, user_ids = seed(conn, args.users)
+    modules = load_modules('wallet')
+    handler = modules['index'].handler
+
+    for user_id in user_ids:
+        status, result = call(handler, {'action': 'topup', 'admin_id': admin_id, 'user_id': user_id,
+                                        'amount': args.balance, 'idempotency_key': f'bench-topup-{user_id}'})
+        assert status == 200, result
+    before = balances(conn, user_ids)
+
+    stress = Stress(handler, user_ids, modules['ledger'].GIFTS, args)
+    elapsed = stress.run()
+    applied = sum(stress.applied.values())
+    print(f'{args.threads} threads, {elapsed:.1f}s: {applied} transfers ({applied / elapsed:.0f}/s), '
+          f'{stress.statuses[402]} insufficient funds, {stress.duplicates} duplicates answered, '
+          f'statuses {dict(stress.statuses)}')
+    report('wallet request', stress.samples)
+
+    assert not stress.statuses.keys() - {200, 402}, dict(stress.statuses)
+    assert max(stress.applied.values(), default=0) <= 1, 'idempotency key applied twice'
+    after = balances(conn, user_ids)
+    lost = {user_id: (after[user_id], before[user_id] + stress.deltas[user_id])
+            for user_id in user_ids if after[user_id] != before[user_id] + stress.deltas[user_id]}
+    assert not lost, f'balances differ from applied transfers (actual, expected): {lost}'
+    assert min(after.values()) >= 0, 'negative balance'
+
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT user_id FROM {schema()}.wallet_discrepancies() WHERE user_id = ANY(%s)', (user_ids,))
+        drifted = [user_id for user_id, in cur.fetchall()]
+        cur.execute(f'SELECT COALESCE(SUM(amount), 0) FROM {schema()}.wallet_ledger')
+        total = cur.fetchone()[0]
+    conn.rollback()
+    assert not drifted, f'ledger differs from balances for {drifted}'
+    assert total == 0, f'ledger does not balance: {total}'
+    print(f'ok: {len(user_ids)} balances match applied transfers and the ledger, hot account {after[user_ids[0]]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+-- Keyset-пагинация истории сообщений: WHERE chat_id = ? AND (created_at, id) < (?, ?)
+CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages(chat_id, created_at, id);
+
+-- Префикс нового индекса покрывает поиск по chat_id, старый индекс только замедляет запись
+DROP INDEX IF EXISTS idx_messages_chat_id;
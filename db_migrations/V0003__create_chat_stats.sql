@@ -0,0 +1,88 @@
+-- Денормализованная статистика чата: список чатов больше не считает сообщения
+
+CREATE TABLE IF NOT EXISTS chat_stats (
+    chat_id INTEGER PRIMARY KEY REFERENCES chats(id),
+    message_count INTEGER NOT NULL DEFAULT 0,
+    last_message_id INTEGER,
+    last_message_at TIMESTAMP,
+    last_message_preview VARCHAR(100)
+);
+
+-- Триггеры уровня оператора: многострочная вставка обновляет каждую строку статистики один раз.
+-- SET search_path FROM CURRENT фиксирует схему миграции, т.к. handlers пишут в {schema}.messages
+-- без search_path.
+CREATE OR REPLACE FUNCTION chat_stats_after_insert() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO chat_stats AS s (chat_id, message_count, last_message_id, last_message_at, last_message_preview)
+    SELECT DISTINCT ON (n.chat_id)
+           n.chat_id, n.cnt, n.id, n.created_at,
+           LEFT(COALESCE(NULLIF(n.message_text, ''), n.media_type), 100)
+    FROM (SELECT m.*, COUNT(*) OVER (PARTITION BY m.chat_id) AS cnt FROM new_messages m) n
+    WHERE n.chat_id IS NOT NULL
+    ORDER BY n.chat_id, n.created_at DESC, n.id DESC
+    ON CONFLICT (chat_id) DO UPDATE SET
+        message_count = s.message_count + EXCLUDED.message_count,
+        last_message_id = CASE WHEN s.last_message_at IS NULL
+                                 OR (EXCLUDED.last_message_at, EXCLUDED.last_message_id) > (s.last_message_at, s.last_message_id)
+                               THEN EXCLUDED.last_message_id ELSE s.last_message_id END,
+        last_message_preview = CASE WHEN s.last_message_at IS NULL
+                                 OR (EXCLUDED.last_message_at, EXCLUDED.last_message_id) > (s.last_message_at, s.last_message_id)
+                               THEN EXCLUDED.last_message_preview ELSE s.last_message_preview END,
+        last_message_at = GREATEST(s.last_message_at, EXCLUDED.last_message_at);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION chat_stats_after_delete() RETURNS trigger AS $$
+BEGIN
+    UPDATE chat_stats s
+    SET message_count = GREATEST(s.message_count - d.cnt, 0)
+    FROM (SELECT chat_id, COUNT(*) AS cnt FROM old_messages GROUP BY chat_id) d
+    WHERE s.chat_id = d.chat_id;
+
+    -- Если удалили последнее сообщение, берём предыдущее по индексу (chat_id, created_at, id)
+    UPDATE chat_stats s
+    SET last_message_id = l.id,
+        last_message_at = l.created_at,
+        last_message_preview = LEFT(COALESCE(NULLIF(l.message_text, ''), l.media_type), 100)
+    FROM (SELECT DISTINCT chat_id FROM old_messages) d
+    LEFT JOIN LATERAL (
+        SELECT m.id, m.created_at, m.message_text, m.media_type
+        FROM messages m
+        WHERE m.chat_id = d.chat_id
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT 1
+    ) l ON TRUE
+    WHERE s.chat_id = d.chat_id
+      AND s.last_message_id IN (SELECT id FROM old_messages);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+DROP TRIGGER IF EXISTS trg_chat_stats_insert ON messages;
+CREATE TRIGGER trg_chat_stats_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION chat_stats_after_insert();
+
+DROP TRIGGER IF EXISTS trg_chat_stats_delete ON messages;
+CREATE TRIGGER trg_chat_stats_delete
+    AFTER DELETE ON messages
+    REFERENCING OLD TABLE AS old_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION chat_stats_after_delete();
+
+-- Backfill из существующих сообщений
+INSERT INTO chat_stats (chat_id, message_count, last_message_id, last_message_at, last_message_preview)
+SELECT DISTINCT ON (m.chat_id)
+       m.chat_id,
+       COUNT(*) OVER (PARTITION BY m.chat_id),
+       m.id, m.created_at,
+       LEFT(COALESCE(NULLIF(m.message_text, ''), m.media_type), 100)
+FROM messages m
+WHERE m.chat_id IS NOT NULL
+ORDER BY m.chat_id, m.created_at DESC, m.id DESC
+ON CONFLICT (chat_id) DO UPDATE SET
+    message_count = EXCLUDED.message_count,
+    last_message_id = EXCLUDED.last_message_id,
+    last_message_at = EXCLUDED.last_message_at,
+    last_message_preview = EXCLUDED.last_message_preview;
@@ -0,0 +1,6 @@
+-- Ключ идемпотентности от клиента: повторная отправка того же сообщения не создаёт дубль
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_sender_idempotency_key
+    ON messages(sender_id, idempotency_key)
+    WHERE idempotency_key IS NOT NULL;
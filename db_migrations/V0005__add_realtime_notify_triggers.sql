@@ -0,0 +1,52 @@
+-- NOTIFY speaky_events при новых сообщениях и изменении состава чатов.
+-- Одно уведомление на чат за оператор: пачка из send_batch будит клиентов один раз.
+
+CREATE OR REPLACE FUNCTION notify_messages_inserted() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('speaky_events', json_build_object(
+        'type', 'message',
+        'chat_id', chat_id,
+        'last_message_id', MAX(id),
+        'count', COUNT(*)
+    )::text)
+    FROM new_messages
+    WHERE chat_id IS NOT NULL
+    GROUP BY chat_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_chat_members_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('speaky_events', json_build_object(
+            'type', 'membership', 'action', 'added', 'chat_id', chat_id, 'user_id', user_id
+        )::text)
+        FROM new_members;
+    ELSE
+        PERFORM pg_notify('speaky_events', json_build_object(
+            'type', 'membership', 'action', 'removed', 'chat_id', chat_id, 'user_id', user_id
+        )::text)
+        FROM old_members;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_notify_messages_insert ON messages;
+CREATE TRIGGER trg_notify_messages_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_messages_inserted();
+
+DROP TRIGGER IF EXISTS trg_notify_chat_members_insert ON chat_members;
+CREATE TRIGGER trg_notify_chat_members_insert
+    AFTER INSERT ON chat_members
+    REFERENCING NEW TABLE AS new_members
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_chat_members_changed();
+
+DROP TRIGGER IF EXISTS trg_notify_chat_members_delete ON chat_members;
+CREATE TRIGGER trg_notify_chat_members_delete
+    AFTER DELETE ON chat_members
+    REFERENCING OLD TABLE AS old_members
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_chat_members_changed();
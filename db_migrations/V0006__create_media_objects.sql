@@ -0,0 +1,11 @@
+-- Контентно-адресуемое хранилище медиа: один объект в S3 на sha256, сколько бы раз его ни пересылали
+CREATE TABLE IF NOT EXISTS media_objects (
+    sha256 CHAR(64) PRIMARY KEY,
+    object_key TEXT NOT NULL,
+    content_type VARCHAR(100),
+    size_bytes BIGINT,
+    ref_count INTEGER NOT NULL DEFAULT 1,
+    created_by INTEGER REFERENCES users(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_referenced_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,2 @@
+-- Готовые ступени изображения (64/256/1024 WebP): {"64": "<key>", ...}, NULL пока не отрендерены
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS variants JSONB;
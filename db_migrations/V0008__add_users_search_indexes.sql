@@ -0,0 +1,8 @@
+-- Поиск пользователей: префикс по btree, нечёткое совпадение по триграммам
+CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+
+CREATE INDEX IF NOT EXISTS idx_users_username_prefix ON users (lower(username) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS idx_users_nickname_prefix ON users (lower(nickname) text_pattern_ops);
+
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_nickname_trgm ON users USING gin (lower(nickname) gin_trgm_ops);
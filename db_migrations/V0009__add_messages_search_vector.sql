@@ -0,0 +1,8 @@
+-- Полнотекстовый поиск по сообщениям: русская и английская морфология в одном векторе
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('russian'::regconfig, COALESCE(message_text, '')) ||
+        to_tsvector('english'::regconfig, COALESCE(message_text, ''))
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search_vector ON messages USING gin (search_vector);
@@ -0,0 +1,5 @@
+-- Обратное направление дружбы: друзья пользователя = UNION выборок по user_id и по friend_id
+CREATE INDEX IF NOT EXISTS idx_friendships_friend_id ON friendships(friend_id, user_id) INCLUDE (status);
+
+-- Прямое направление уже покрывает UNIQUE(user_id, friend_id)
+DROP INDEX IF EXISTS idx_friendships_user_id;
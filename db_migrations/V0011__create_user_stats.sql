@@ -0,0 +1,218 @@
+-- Материализованная статистика профиля: users?action=stats читает одну строку по первичному ключу
+
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    friends_count INTEGER NOT NULL DEFAULT 0,
+    groups_count INTEGER NOT NULL DEFAULT 0,
+    channels_count INTEGER NOT NULL DEFAULT 0,
+    gifts_received_count INTEGER NOT NULL DEFAULT 0,
+    gifts_sent_count INTEGER NOT NULL DEFAULT 0,
+    transactions_count INTEGER NOT NULL DEFAULT 0,
+    topup_total BIGINT NOT NULL DEFAULT 0,
+    spent_total BIGINT NOT NULL DEFAULT 0
+);
+
+-- Триггеры уровня оператора с таблицами переходов: дельты по пользователю складываются
+-- одним upsert на оператор. Транзитные таблицы допускают только одно событие на триггер,
+-- поэтому одна функция висит на нескольких триггерах и ветвится по TG_OP.
+
+CREATE OR REPLACE FUNCTION user_stats_friendships() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO user_stats AS s (user_id, friends_count)
+        SELECT uid, COUNT(*) FROM (
+            SELECT user_id AS uid FROM new_rows WHERE status = 'accepted'
+            UNION ALL
+            SELECT friend_id FROM new_rows WHERE status = 'accepted'
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ON CONFLICT (user_id) DO UPDATE SET friends_count = s.friends_count + EXCLUDED.friends_count;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO user_stats AS s (user_id, friends_count)
+        SELECT uid, -COUNT(*) FROM (
+            SELECT user_id AS uid FROM old_rows WHERE status = 'accepted'
+            UNION ALL
+            SELECT friend_id FROM old_rows WHERE status = 'accepted'
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ON CONFLICT (user_id) DO UPDATE SET friends_count = s.friends_count + EXCLUDED.friends_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION user_stats_chat_members() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats AS s (user_id, groups_count, channels_count)
+        SELECT m.user_id,
+               COUNT(*) FILTER (WHERE c.type = 'group'),
+               COUNT(*) FILTER (WHERE c.type = 'channel')
+        FROM new_rows m JOIN chats c ON c.id = m.chat_id
+        WHERE m.user_id IS NOT NULL
+        GROUP BY m.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            groups_count = s.groups_count + EXCLUDED.groups_count,
+            channels_count = s.channels_count + EXCLUDED.channels_count;
+    ELSE
+        INSERT INTO user_stats AS s (user_id, groups_count, channels_count)
+        SELECT m.user_id,
+               -COUNT(*) FILTER (WHERE c.type = 'group'),
+               -COUNT(*) FILTER (WHERE c.type = 'channel')
+        FROM old_rows m JOIN chats c ON c.id = m.chat_id
+        WHERE m.user_id IS NOT NULL
+        GROUP BY m.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            groups_count = s.groups_count + EXCLUDED.groups_count,
+            channels_count = s.channels_count + EXCLUDED.channels_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION user_stats_user_gifts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats AS s (user_id, gifts_received_count, gifts_sent_count)
+        SELECT uid, SUM(received), SUM(sent) FROM (
+            SELECT user_id AS uid, 1 AS received, 0 AS sent FROM new_rows
+            UNION ALL
+            SELECT from_user_id, 0, 1 FROM new_rows
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ON CONFLICT (user_id) DO UPDATE SET
+            gifts_received_count = s.gifts_received_count + EXCLUDED.gifts_received_count,
+            gifts_sent_count = s.gifts_sent_count + EXCLUDED.gifts_sent_count;
+    ELSE
+        INSERT INTO user_stats AS s (user_id, gifts_received_count, gifts_sent_count)
+        SELECT uid, -SUM(received), -SUM(sent) FROM (
+            SELECT user_id AS uid, 1 AS received, 0 AS sent FROM old_rows
+            UNION ALL
+            SELECT from_user_id, 0, 1 FROM old_rows
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ON CONFLICT (user_id) DO UPDATE SET
+            gifts_received_count = s.gifts_received_count + EXCLUDED.gifts_received_count,
+            gifts_sent_count = s.gifts_sent_count + EXCLUDED.gifts_sent_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION user_stats_transactions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats AS s (user_id, transactions_count, topup_total, spent_total)
+        SELECT user_id,
+               COUNT(*),
+               COALESCE(SUM(amount) FILTER (WHERE type = 'topup'), 0),
+               COALESCE(SUM(amount) FILTER (WHERE type IN ('purchase', 'gift_sent')), 0)
+        FROM new_rows
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            transactions_count = s.transactions_count + EXCLUDED.transactions_count,
+            topup_total = s.topup_total + EXCLUDED.topup_total,
+            spent_total = s.spent_total + EXCLUDED.spent_total;
+    ELSE
+        INSERT INTO user_stats AS s (user_id, transactions_count, topup_total, spent_total)
+        SELECT user_id,
+               -COUNT(*),
+               -COALESCE(SUM(amount) FILTER (WHERE type = 'topup'), 0),
+               -COALESCE(SUM(amount) FILTER (WHERE type IN ('purchase', 'gift_sent')), 0)
+        FROM old_rows
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            transactions_count = s.transactions_count + EXCLUDED.transactions_count,
+            topup_total = s.topup_total + EXCLUDED.topup_total,
+            spent_total = s.spent_total + EXCLUDED.spent_total;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+DROP TRIGGER IF EXISTS trg_user_stats_friendships_insert ON friendships;
+CREATE TRIGGER trg_user_stats_friendships_insert AFTER INSERT ON friendships
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_friendships();
+DROP TRIGGER IF EXISTS trg_user_stats_friendships_update ON friendships;
+CREATE TRIGGER trg_user_stats_friendships_update AFTER UPDATE ON friendships
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_friendships();
+DROP TRIGGER IF EXISTS trg_user_stats_friendships_delete ON friendships;
+CREATE TRIGGER trg_user_stats_friendships_delete AFTER DELETE ON friendships
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_friendships();
+
+DROP TRIGGER IF EXISTS trg_user_stats_chat_members_insert ON chat_members;
+CREATE TRIGGER trg_user_stats_chat_members_insert AFTER INSERT ON chat_members
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_chat_members();
+DROP TRIGGER IF EXISTS trg_user_stats_chat_members_delete ON chat_members;
+CREATE TRIGGER trg_user_stats_chat_members_delete AFTER DELETE ON chat_members
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_chat_members();
+
+DROP TRIGGER IF EXISTS trg_user_stats_user_gifts_insert ON user_gifts;
+CREATE TRIGGER trg_user_stats_user_gifts_insert AFTER INSERT ON user_gifts
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_user_gifts();
+DROP TRIGGER IF EXISTS trg_user_stats_user_gifts_delete ON user_gifts;
+CREATE TRIGGER trg_user_stats_user_gifts_delete AFTER DELETE ON user_gifts
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_user_gifts();
+
+DROP TRIGGER IF EXISTS trg_user_stats_transactions_insert ON transactions;
+CREATE TRIGGER trg_user_stats_transactions_insert AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_transactions();
+DROP TRIGGER IF EXISTS trg_user_stats_transactions_delete ON transactions;
+CREATE TRIGGER trg_user_stats_transactions_delete AFTER DELETE ON transactions
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION user_stats_transactions();
+
+-- Пересчёт с нуля: исправляет дрейф (ручные правки, отключённые триггеры) и служит backfill.
+-- Возвращает число исправленных строк.
+CREATE OR REPLACE FUNCTION user_stats_repair() RETURNS INTEGER AS $$
+DECLARE
+    fixed INTEGER;
+BEGIN
+    WITH actual AS (
+        SELECT u.id AS user_id,
+               (SELECT COUNT(*) FROM friendships f WHERE f.user_id = u.id AND f.status = 'accepted') +
+               (SELECT COUNT(*) FROM friendships f WHERE f.friend_id = u.id AND f.status = 'accepted') AS friends_count,
+               (SELECT COUNT(*) FROM chat_members m JOIN chats c ON c.id = m.chat_id
+                WHERE m.user_id = u.id AND c.type = 'group') AS groups_count,
+               (SELECT COUNT(*) FROM chat_members m JOIN chats c ON c.id = m.chat_id
+                WHERE m.user_id = u.id AND c.type = 'channel') AS channels_count,
+               (SELECT COUNT(*) FROM user_gifts g WHERE g.user_id = u.id) AS gifts_received_count,
+               (SELECT COUNT(*) FROM user_gifts g WHERE g.from_user_id = u.id) AS gifts_sent_count,
+               (SELECT COUNT(*) FROM transactions t WHERE t.user_id = u.id) AS transactions_count,
+               (SELECT COALESCE(SUM(amount), 0) FROM transactions t
+                WHERE t.user_id = u.id AND t.type = 'topup') AS topup_total,
+               (SELECT COALESCE(SUM(amount), 0) FROM transactions t
+                WHERE t.user_id = u.id AND t.type IN ('purchase', 'gift_sent')) AS spent_total
+        FROM users u
+    ),
+    upserted AS (
+        INSERT INTO user_stats AS s
+        SELECT * FROM actual
+        ON CONFLICT (user_id) DO UPDATE SET
+            friends_count = EXCLUDED.friends_count,
+            groups_count = EXCLUDED.groups_count,
+            channels_count = EXCLUDED.channels_count,
+            gifts_received_count = EXCLUDED.gifts_received_count,
+            gifts_sent_count = EXCLUDED.gifts_sent_count,
+            transactions_count = EXCLUDED.transactions_count,
+            topup_total = EXCLUDED.topup_total,
+            spent_total = EXCLUDED.spent_total
+        WHERE (s.friends_count, s.groups_count, s.channels_count, s.gifts_received_count, s.gifts_sent_count,
+               s.transactions_count, s.topup_total, s.spent_total)
+           IS DISTINCT FROM
+              (EXCLUDED.friends_count, EXCLUDED.groups_count, EXCLUDED.channels_count, EXCLUDED.gifts_received_count,
+               EXCLUDED.gifts_sent_count, EXCLUDED.transactions_count, EXCLUDED.topup_total, EXCLUDED.spent_total)
+        RETURNING 1
+    )
+    SELECT COUNT(*) INTO fixed FROM upserted;
+    RETURN fixed;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+SELECT user_stats_repair();
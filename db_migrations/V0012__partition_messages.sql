@@ -0,0 +1,249 @@
+-- Помесячное секционирование messages по created_at.
+--
+-- Миграция не переписывает данные: старая куча переименовывается в messages_legacy и
+-- подключается к новой секционированной messages одной секцией FROM (MINVALUE) TO (<следующий месяц>),
+-- поэтому вся история видна сразу. Дальше:
+--   messages_split_legacy()      переносит самый старый месяц legacy в собственную секцию (одна транзакция
+--                                на месяц, повторять до NULL) — онлайн-backfill без остановки записи;
+--   messages_ensure_partitions() создаёт секции на текущий и следующие месяцы и разбирает messages_default;
+--   messages_default             ловит строки, для месяца которых секции ещё нет.
+-- Холодные месяцы выгружаются в S3 функцией chats (см. partitions.py) и записываются в каталог
+-- message_archives / message_archive_chats.
+
+UPDATE messages SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+
+-- Уникальный индекс секционированной таблицы обязан включать ключ секционирования, поэтому
+-- глобальная уникальность (sender_id, idempotency_key) переезжает в отдельную таблицу
+CREATE TABLE IF NOT EXISTS message_idempotency_keys (
+    sender_id INTEGER NOT NULL,
+    idempotency_key VARCHAR(64) NOT NULL,
+    message_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (sender_id, idempotency_key)
+);
+
+INSERT INTO message_idempotency_keys (sender_id, idempotency_key, message_id, created_at)
+SELECT sender_id, idempotency_key, id, created_at
+FROM messages
+WHERE idempotency_key IS NOT NULL AND sender_id IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+-- Триггеры с таблицами переходов не допускаются на секциях: они переезжают на родителя.
+-- Внешний ключ reply_to -> messages(id) невозможен без уникального индекса по одному id.
+DROP TRIGGER IF EXISTS trg_chat_stats_insert ON messages;
+DROP TRIGGER IF EXISTS trg_chat_stats_delete ON messages;
+DROP TRIGGER IF EXISTS trg_notify_messages_insert ON messages;
+ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_reply_to_fkey;
+DROP INDEX IF EXISTS idx_messages_sender_idempotency_key;
+
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER INDEX messages_pkey RENAME TO messages_legacy_pkey;
+ALTER INDEX idx_messages_chat_created_id RENAME TO idx_messages_legacy_chat_created_id;
+ALTER INDEX idx_messages_search_vector RENAME TO idx_messages_legacy_search_vector;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    chat_id INTEGER REFERENCES chats(id),
+    sender_id INTEGER REFERENCES users(id),
+    message_text TEXT,
+    media_type VARCHAR(20) CHECK (media_type IN ('text', 'photo', 'video', 'voice', 'file')),
+    media_url TEXT,
+    reply_to INTEGER,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    idempotency_key VARCHAR(64),
+    search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('russian'::regconfig, COALESCE(message_text, '')) ||
+        to_tsvector('english'::regconfig, COALESCE(message_text, ''))
+    ) STORED,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Индексы с теми же определениями, что у legacy: при подключении её индексы присоединяются без перестройки
+CREATE INDEX idx_messages_chat_created_id ON messages (chat_id, created_at, id);
+CREATE INDEX idx_messages_search_vector ON messages USING gin (search_vector);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+CREATE TABLE IF NOT EXISTS message_archives (
+    month DATE PRIMARY KEY,
+    message_count BIGINT NOT NULL,
+    chat_count INTEGER NOT NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Один объект на чат за месяц: history дочитывает архив чата, не перебирая весь месяц
+CREATE TABLE IF NOT EXISTS message_archive_chats (
+    chat_id INTEGER NOT NULL,
+    month DATE NOT NULL REFERENCES message_archives(month),
+    object_key TEXT NOT NULL,
+    message_count INTEGER NOT NULL,
+    first_at TIMESTAMP NOT NULL,
+    last_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (chat_id, month)
+);
+
+CREATE OR REPLACE FUNCTION messages_partition_name(month_start TIMESTAMP) RETURNS TEXT AS $$
+    SELECT 'messages_p' || to_char(month_start, 'YYYYMM');
+$$ LANGUAGE sql STABLE;
+
+-- Верхняя граница секции messages_legacy (NULL, если legacy уже разобрана)
+CREATE OR REPLACE FUNCTION messages_legacy_upper() RETURNS TIMESTAMP AS $$
+    SELECT substring(pg_get_expr(c.relpartbound, c.oid) FROM 'TO \(''([^'']+)''\)')::timestamp
+    FROM pg_class c
+    WHERE c.oid = to_regclass('messages_legacy') AND c.relispartition;
+$$ LANGUAGE sql STABLE SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION messages_create_partition(month_start TIMESTAMP) RETURNS BOOLEAN AS $$
+DECLARE
+    partition_name TEXT := messages_partition_name(month_start);
+    month_end TIMESTAMP := month_start + INTERVAL '1 month';
+    columns TEXT := 'id, chat_id, sender_id, message_text, media_type, media_url, reply_to, created_at, idempotency_key';
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    -- Строки месяца, уже попавшие в messages_default, переезжают в новую секцию:
+    -- иначе CREATE ... PARTITION OF откажет из-за нарушения ограничения default.
+    -- Вставка прямо в секцию не запускает триггеры родителя, chat_stats не меняется.
+    EXECUTE format('CREATE TEMP TABLE messages_default_moved ON COMMIT DROP AS SELECT %s FROM messages WITH NO DATA', columns);
+    EXECUTE format('
+        WITH moved AS (
+            DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING %s
+        )
+        INSERT INTO messages_default_moved SELECT * FROM moved', month_start, month_end, columns);
+    EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, month_start, month_end);
+    EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM messages_default_moved', partition_name, columns, columns);
+    DROP TABLE messages_default_moved;
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION messages_ensure_partitions(months_ahead INTEGER DEFAULT 2) RETURNS INTEGER AS $$
+DECLARE
+    month_start TIMESTAMP;
+    created INTEGER := 0;
+BEGIN
+    -- Секции создаются с разных инстансов функции: по одному за раз
+    PERFORM pg_advisory_xact_lock(hashtext('messages_partitions'));
+    FOR month_start IN
+        SELECT generate_series(
+            GREATEST(date_trunc('month', LOCALTIMESTAMP), messages_legacy_upper()),
+            date_trunc('month', LOCALTIMESTAMP) + make_interval(months => months_ahead),
+            INTERVAL '1 month'
+        )
+        UNION
+        SELECT DISTINCT date_trunc('month', created_at) FROM messages_default
+        ORDER BY 1
+    LOOP
+        IF messages_create_partition(month_start) THEN
+            created := created + 1;
+        END IF;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+-- Шаг онлайн-backfill: самый старый месяц legacy становится отдельной секцией.
+-- Копия и её индексы строятся, пока legacy подключена и читается; под блокировкой родителя
+-- остаются удаление перенесённых строк, проверка нового диапазона legacy и подключение.
+-- Текущий месяц не переносится, пока в него пишут. Возвращает имя секции или NULL, если делать нечего.
+CREATE OR REPLACE FUNCTION messages_split_legacy() RETURNS TEXT AS $$
+DECLARE
+    legacy_end TIMESTAMP := messages_legacy_upper();
+    month_start TIMESTAMP;
+    month_end TIMESTAMP;
+    partition_name TEXT;
+    columns TEXT := 'id, chat_id, sender_id, message_text, media_type, media_url, reply_to, created_at, idempotency_key';
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('messages_partitions'));
+    IF legacy_end IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    SELECT date_trunc('month', MIN(created_at)) INTO month_start FROM messages_legacy;
+    IF month_start IS NULL THEN
+        ALTER TABLE messages DETACH PARTITION messages_legacy;
+        DROP TABLE messages_legacy;
+        PERFORM messages_ensure_partitions();
+        RETURN NULL;
+    END IF;
+    IF month_start >= date_trunc('month', LOCALTIMESTAMP) THEN
+        RETURN NULL;
+    END IF;
+
+    month_end := month_start + INTERVAL '1 month';
+    partition_name := messages_partition_name(month_start);
+
+    EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)',
+                   partition_name);
+    EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM messages_legacy WHERE created_at < %L',
+                   partition_name, columns, columns, month_end);
+    -- Проверенное ограничение диапазона избавляет ATTACH от повторного сканирования секции
+    EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I CHECK (created_at >= %L AND created_at < %L)',
+                   partition_name, partition_name || '_range', month_start, month_end);
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, created_at)', partition_name);
+    EXECUTE format('CREATE INDEX ON %I (chat_id, created_at, id)', partition_name);
+    EXECUTE format('CREATE INDEX ON %I USING gin (search_vector)', partition_name);
+    EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (chat_id) REFERENCES chats(id), '
+                   'ADD FOREIGN KEY (sender_id) REFERENCES users(id)', partition_name);
+
+    ALTER TABLE messages DETACH PARTITION messages_legacy;
+    EXECUTE format('DELETE FROM messages_legacy l USING %I m WHERE l.id = m.id AND l.created_at = m.created_at',
+                   partition_name);
+    ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_range;
+    EXECUTE format('ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, month_start, month_end);
+    EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', partition_name, partition_name || '_range');
+
+    IF month_end >= legacy_end THEN
+        IF EXISTS (SELECT 1 FROM messages_legacy) THEN
+            RAISE EXCEPTION 'messages_legacy still has rows after moving its last month %', month_start;
+        END IF;
+        DROP TABLE messages_legacy;
+    ELSE
+        EXECUTE format('ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_range '
+                       'CHECK (created_at >= %L AND created_at < %L)', month_end, legacy_end);
+        EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (%L) TO (%L)',
+                       month_end, legacy_end);
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+-- Пустая база сразу получает помесячные секции; иначе legacy подключается целиком.
+-- SET NOT NULL сканирует legacy (CHECK по диапазону NULL не исключает); вместе с ним
+-- проверенный CHECK доказывает ограничение секции, и ATTACH повторно не сканирует.
+DO $$
+DECLARE
+    cutover TIMESTAMP := date_trunc('month', LOCALTIMESTAMP) + INTERVAL '1 month';
+BEGIN
+    IF EXISTS (SELECT 1 FROM messages_legacy) THEN
+        EXECUTE format('ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_range CHECK (created_at < %L)', cutover);
+        ALTER TABLE messages_legacy ALTER COLUMN created_at SET NOT NULL;
+        EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)', cutover);
+    ELSE
+        DROP TABLE messages_legacy;
+    END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+SELECT messages_ensure_partitions();
+
+-- Триггеры уровня оператора на родителе видят строки всех секций через таблицы переходов
+CREATE TRIGGER trg_chat_stats_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION chat_stats_after_insert();
+
+CREATE TRIGGER trg_chat_stats_delete
+    AFTER DELETE ON messages
+    REFERENCING OLD TABLE AS old_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION chat_stats_after_delete();
+
+CREATE TRIGGER trg_notify_messages_insert
+    AFTER INSERT ON messages
+    REFERENCING NEW TABLE AS new_messages
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_messages_inserted();
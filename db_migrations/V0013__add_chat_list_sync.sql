@@ -0,0 +1,61 @@
+-- Дельта-синхронизация списка чатов: какие записи списка изменились после токена клиента.
+--
+-- changed_xid — id транзакции последнего изменения строки (txid_current()). Токен синхронизации —
+-- xmin снимка на момент чтения (txid_snapshot_xmin): все транзакции младше него уже были видны,
+-- поэтому изменения с changed_xid >= токена — ровно то, что клиент мог не увидеть (с запасом,
+-- без пропусков, в отличие от сравнения по времени при параллельных коммитах).
+-- Столбцы добавляются без значения по умолчанию для старых строк (без перезаписи таблиц):
+-- NULL означает «не менялась с момента миграции».
+
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS changed_xid BIGINT;
+ALTER TABLE chats ALTER COLUMN changed_xid SET DEFAULT txid_current();
+
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS changed_xid BIGINT;
+ALTER TABLE chat_members ALTER COLUMN changed_xid SET DEFAULT txid_current();
+
+ALTER TABLE chat_stats ADD COLUMN IF NOT EXISTS changed_xid BIGINT;
+ALTER TABLE chat_stats ALTER COLUMN changed_xid SET DEFAULT txid_current();
+
+CREATE OR REPLACE FUNCTION touch_changed_xid() RETURNS trigger AS $$
+BEGIN
+    NEW.changed_xid := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_chats_changed_xid ON chats;
+CREATE TRIGGER trg_chats_changed_xid BEFORE UPDATE ON chats
+    FOR EACH ROW EXECUTE FUNCTION touch_changed_xid();
+
+DROP TRIGGER IF EXISTS trg_chat_members_changed_xid ON chat_members;
+CREATE TRIGGER trg_chat_members_changed_xid BEFORE UPDATE ON chat_members
+    FOR EACH ROW EXECUTE FUNCTION touch_changed_xid();
+
+DROP TRIGGER IF EXISTS trg_chat_stats_changed_xid ON chat_stats;
+CREATE TRIGGER trg_chat_stats_changed_xid BEFORE UPDATE ON chat_stats
+    FOR EACH ROW EXECUTE FUNCTION touch_changed_xid();
+
+-- Выход из чата удаляет строку участника, поэтому для дельты остаётся отметка: одна на пару (user, chat)
+CREATE TABLE IF NOT EXISTS chat_member_removals (
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    removed_xid BIGINT NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+
+CREATE OR REPLACE FUNCTION chat_member_removals_record() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO chat_member_removals AS r (user_id, chat_id, removed_xid)
+    SELECT DISTINCT user_id, chat_id, txid_current()
+    FROM old_members
+    WHERE user_id IS NOT NULL AND chat_id IS NOT NULL
+    ON CONFLICT (user_id, chat_id) DO UPDATE SET removed_xid = EXCLUDED.removed_xid;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+DROP TRIGGER IF EXISTS trg_chat_member_removals ON chat_members;
+CREATE TRIGGER trg_chat_member_removals
+    AFTER DELETE ON chat_members
+    REFERENCING OLD TABLE AS old_members
+    FOR EACH STATEMENT EXECUTE FUNCTION chat_member_removals_record();
@@ -0,0 +1,119 @@
+-- Кошелёк: двойная запись движений енотиков рядом с балансом users.enots.
+--
+-- Каждое движение — строка wallet_transfers и проводки wallet_ledger по счетам: счёт
+-- пользователя (account = 'user', user_id) или системные счета 'issuance' (пополнения
+-- извне) и 'shop' (оплата подарков). Сумма проводок перевода всегда ноль, поэтому
+-- users.enots совпадает с суммой проводок по счёту пользователя (wallet_discrepancies()).
+-- Ключ идемпотентности уникален для инициатора: повтор запроса не списывает второй раз.
+-- Отрицательные балансы раньше ничто не запрещало: до ограничения enots >= 0 они
+-- обнуляются переводом 'correction' со счёта issuance, так что журнал помнит, сколько списано в долг.
+
+UPDATE users SET enots = 0 WHERE enots IS NULL;
+ALTER TABLE users ALTER COLUMN enots SET NOT NULL;
+
+CREATE TABLE IF NOT EXISTS wallet_transfers (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL CHECK (kind IN ('opening', 'correction', 'topup', 'purchase', 'gift', 'transfer')),
+    initiator_id INTEGER REFERENCES users(id),
+    idempotency_key VARCHAR(64),
+    amount BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_wallet_transfers_idempotency_key
+    ON wallet_transfers(initiator_id, idempotency_key)
+    WHERE idempotency_key IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS wallet_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    transfer_id BIGINT NOT NULL REFERENCES wallet_transfers(id),
+    account VARCHAR(20) NOT NULL CHECK (account IN ('user', 'issuance', 'shop')),
+    user_id INTEGER REFERENCES users(id),
+    amount BIGINT NOT NULL,
+    CHECK ((account = 'user') = (user_id IS NOT NULL))
+);
+
+CREATE INDEX IF NOT EXISTS idx_wallet_ledger_transfer_id ON wallet_ledger(transfer_id);
+CREATE INDEX IF NOT EXISTS idx_wallet_ledger_user_id ON wallet_ledger(user_id) WHERE user_id IS NOT NULL;
+
+-- История кошелька ссылается на перевод, который её породил
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS transfer_id BIGINT REFERENCES wallet_transfers(id);
+CREATE INDEX IF NOT EXISTS idx_transactions_user_id_id ON transactions(user_id, id DESC);
+
+-- Проводки перевода пишутся одним оператором, поэтому баланс проверяется на уровне оператора
+CREATE OR REPLACE FUNCTION wallet_ledger_balanced() RETURNS trigger AS $$
+DECLARE
+    unbalanced BIGINT;
+BEGIN
+    SELECT transfer_id INTO unbalanced
+    FROM new_entries
+    GROUP BY transfer_id
+    HAVING SUM(amount) <> 0
+    LIMIT 1;
+    IF FOUND THEN
+        RAISE EXCEPTION 'wallet transfer % is unbalanced', unbalanced;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_wallet_ledger_balanced ON wallet_ledger;
+CREATE TRIGGER trg_wallet_ledger_balanced
+    AFTER INSERT ON wallet_ledger
+    REFERENCING NEW TABLE AS new_entries
+    FOR EACH STATEMENT EXECUTE FUNCTION wallet_ledger_balanced();
+
+-- Входящие остатки: текущие балансы переносятся в журнал одним переводом со счёта issuance
+DO $$
+DECLARE
+    opening BIGINT;
+BEGIN
+    IF EXISTS (SELECT 1 FROM wallet_transfers WHERE kind = 'opening') THEN
+        RETURN;
+    END IF;
+    INSERT INTO wallet_transfers (kind, amount)
+    SELECT 'opening', COALESCE(SUM(enots), 0) FROM users
+    RETURNING id INTO opening;
+
+    INSERT INTO wallet_ledger (transfer_id, account, user_id, amount)
+    SELECT opening, 'user', id, enots FROM users WHERE enots <> 0
+    UNION ALL
+    SELECT opening, 'issuance', NULL, -COALESCE(SUM(enots), 0) FROM users;
+END;
+$$;
+
+-- Отрицательные остатки доводятся до нуля проводкой, а не молча
+DO $$
+DECLARE
+    correction BIGINT;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM users WHERE enots < 0) THEN
+        RETURN;
+    END IF;
+    INSERT INTO wallet_transfers (kind, amount)
+    SELECT 'correction', -SUM(enots) FROM users WHERE enots < 0
+    RETURNING id INTO correction;
+
+    INSERT INTO wallet_ledger (transfer_id, account, user_id, amount)
+    SELECT correction, 'user', id, -enots FROM users WHERE enots < 0
+    UNION ALL
+    SELECT correction, 'issuance', NULL, SUM(enots) FROM users WHERE enots < 0;
+
+    UPDATE users SET enots = 0 WHERE enots < 0;
+END;
+$$;
+
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_enots_nonnegative;
+ALTER TABLE users ADD CONSTRAINT users_enots_nonnegative CHECK (enots >= 0);
+
+-- Сверка: пользователи, у которых баланс разошёлся с журналом (пусто — всё сходится)
+CREATE OR REPLACE FUNCTION wallet_discrepancies()
+RETURNS TABLE (user_id INTEGER, enots INTEGER, ledger BIGINT) AS $$
+    SELECT u.id, u.enots, COALESCE(l.total, 0)
+    FROM users u
+    LEFT JOIN (
+        SELECT user_id, SUM(amount) AS total FROM wallet_ledger WHERE account = 'user' GROUP BY user_id
+    ) l ON l.user_id = u.id
+    WHERE u.enots <> COALESCE(l.total, 0)
+    ORDER BY u.id;
+$$ LANGUAGE sql STABLE SET search_path FROM CURRENT;
@@ -0,0 +1,7 @@
+-- Время последней активности для присутствия. Пишется пачками из памяти функций (presence.py),
+-- а не на каждый пульс; timestamptz — сравнивается со временем процесса в UTC.
+-- Индекса нет намеренно: обновления last_seen остаются HOT и не трогают индексы users,
+-- а свободное место на страницах (fillfactor) оставляет новым версиям строк место рядом.
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMPTZ;
+ALTER TABLE users SET (fillfactor = 90);
@@ -0,0 +1,36 @@
+-- Прочитанное — водяной знак участника, а не строка на каждое прочитанное сообщение.
+--
+-- last_read_message_id — последнее прочитанное сообщение, read_count — chat_stats.message_count
+-- на момент этой отметки. Непрочитанные = message_count - read_count: список чатов берёт их
+-- из уже прочитанных строк chat_members и chat_stats, ничего не считая по messages.
+
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id BIGINT;
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS read_count INTEGER;
+
+-- Текущие участники начинают с прочитанным чатом, а не с бейджем на всю историю
+UPDATE chat_members cm
+SET last_read_message_id = s.last_message_id,
+    read_count = s.message_count
+FROM chat_stats s
+WHERE s.chat_id = cm.chat_id AND cm.read_count IS NULL;
+
+UPDATE chat_members SET read_count = 0 WHERE read_count IS NULL;
+
+-- Новый участник не видит непрочитанной всю историю до вступления
+CREATE OR REPLACE FUNCTION chat_members_read_start() RETURNS trigger AS $$
+BEGIN
+    IF NEW.read_count IS NULL THEN
+        SELECT s.message_count, s.last_message_id INTO NEW.read_count, NEW.last_read_message_id
+        FROM chat_stats s
+        WHERE s.chat_id = NEW.chat_id;
+        NEW.read_count := COALESCE(NEW.read_count, 0);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+DROP TRIGGER IF EXISTS trg_chat_members_read_start ON chat_members;
+CREATE TRIGGER trg_chat_members_read_start BEFORE INSERT ON chat_members
+    FOR EACH ROW EXECUTE FUNCTION chat_members_read_start();
+
+ALTER TABLE chat_members ALTER COLUMN read_count SET NOT NULL;
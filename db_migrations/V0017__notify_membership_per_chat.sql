@@ -0,0 +1,30 @@
+-- Изменение состава чата — одно уведомление на чат за оператор, а не на каждую строку chat_members.
+-- Массовое добавление из add_members раньше давало по pg_notify на участника. Теперь user_ids
+-- собираются в массив; пачками по 500, чтобы payload оставался меньше лимита NOTIFY в 8000 байт.
+
+CREATE OR REPLACE FUNCTION notify_chat_members_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM pg_notify('speaky_events', json_build_object(
+            'type', 'membership', 'action', 'added', 'chat_id', chat_id, 'user_ids', json_agg(user_id)
+        )::text)
+        FROM (
+            SELECT chat_id, user_id, (row_number() OVER (PARTITION BY chat_id ORDER BY user_id) - 1) / 500 AS chunk
+            FROM new_members
+            WHERE chat_id IS NOT NULL
+        ) m
+        GROUP BY chat_id, chunk;
+    ELSE
+        PERFORM pg_notify('speaky_events', json_build_object(
+            'type', 'membership', 'action', 'removed', 'chat_id', chat_id, 'user_ids', json_agg(user_id)
+        )::text)
+        FROM (
+            SELECT chat_id, user_id, (row_number() OVER (PARTITION BY chat_id ORDER BY user_id) - 1) / 500 AS chunk
+            FROM old_members
+            WHERE chat_id IS NOT NULL
+        ) m
+        GROUP BY chat_id, chunk;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
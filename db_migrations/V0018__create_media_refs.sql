@@ -0,0 +1,15 @@
+-- Чьи ссылки на объект media_objects: release снимает только ссылку того пользователя, который её взял.
+-- media_objects.ref_count по-прежнему общий счётчик; media_refs раскладывает его по пользователям.
+CREATE TABLE IF NOT EXISTS media_refs (
+    sha256 CHAR(64) NOT NULL REFERENCES media_objects(sha256) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    refs INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (sha256, user_id)
+);
+
+-- Ссылки, взятые до миграции, считаются ссылками автора объекта
+INSERT INTO media_refs (sha256, user_id, refs)
+SELECT sha256, created_by, ref_count
+FROM media_objects
+WHERE created_by IS NOT NULL AND ref_count > 0
+ON CONFLICT (sha256, user_id) DO NOTHING;
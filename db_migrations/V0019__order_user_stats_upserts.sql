@@ -0,0 +1,149 @@
+-- Upsert-ы user_stats из триггеров V0011 берут блокировки строк в порядке user_id.
+-- Без ORDER BY два массовых оператора с пересекающимися пользователями (add_members,
+-- пачка дружб) могли заблокировать строки в разном порядке и уйти в deadlock.
+-- UPDATE дружб теперь сводит старые и новые строки в одну дельту на пользователя:
+-- два отдельных upsert-а снова брали бы блокировки в два прохода.
+
+CREATE OR REPLACE FUNCTION user_stats_friendships() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats AS s (user_id, friends_count)
+        SELECT uid, COUNT(*) FROM (
+            SELECT user_id AS uid FROM new_rows WHERE status = 'accepted'
+            UNION ALL
+            SELECT friend_id FROM new_rows WHERE status = 'accepted'
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ORDER BY uid
+        ON CONFLICT (user_id) DO UPDATE SET friends_count = s.friends_count + EXCLUDED.friends_count;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO user_stats AS s (user_id, friends_count)
+        SELECT uid, SUM(delta) FROM (
+            SELECT user_id AS uid, 1 AS delta FROM new_rows WHERE status = 'accepted'
+            UNION ALL
+            SELECT friend_id, 1 FROM new_rows WHERE status = 'accepted'
+            UNION ALL
+            SELECT user_id, -1 FROM old_rows WHERE status = 'accepted'
+            UNION ALL
+            SELECT friend_id, -1 FROM old_rows WHERE status = 'accepted'
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        HAVING SUM(delta) <> 0
+        ORDER BY uid
+        ON CONFLICT (user_id) DO UPDATE SET friends_count = s.friends_count + EXCLUDED.friends_count;
+    ELSE
+        INSERT INTO user_stats AS s (user_id, friends_count)
+        SELECT uid, -COUNT(*) FROM (
+            SELECT user_id AS uid FROM old_rows WHERE status = 'accepted'
+            UNION ALL
+            SELECT friend_id FROM old_rows WHERE status = 'accepted'
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ORDER BY uid
+        ON CONFLICT (user_id) DO UPDATE SET friends_count = s.friends_count + EXCLUDED.friends_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION user_stats_chat_members() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats AS s (user_id, groups_count, channels_count)
+        SELECT m.user_id,
+               COUNT(*) FILTER (WHERE c.type = 'group'),
+               COUNT(*) FILTER (WHERE c.type = 'channel')
+        FROM new_rows m JOIN chats c ON c.id = m.chat_id
+        WHERE m.user_id IS NOT NULL
+        GROUP BY m.user_id
+        ORDER BY m.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            groups_count = s.groups_count + EXCLUDED.groups_count,
+            channels_count = s.channels_count + EXCLUDED.channels_count;
+    ELSE
+        INSERT INTO user_stats AS s (user_id, groups_count, channels_count)
+        SELECT m.user_id,
+               -COUNT(*) FILTER (WHERE c.type = 'group'),
+               -COUNT(*) FILTER (WHERE c.type = 'channel')
+        FROM old_rows m JOIN chats c ON c.id = m.chat_id
+        WHERE m.user_id IS NOT NULL
+        GROUP BY m.user_id
+        ORDER BY m.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            groups_count = s.groups_count + EXCLUDED.groups_count,
+            channels_count = s.channels_count + EXCLUDED.channels_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION user_stats_user_gifts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats AS s (user_id, gifts_received_count, gifts_sent_count)
+        SELECT uid, SUM(received), SUM(sent) FROM (
+            SELECT user_id AS uid, 1 AS received, 0 AS sent FROM new_rows
+            UNION ALL
+            SELECT from_user_id, 0, 1 FROM new_rows
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ORDER BY uid
+        ON CONFLICT (user_id) DO UPDATE SET
+            gifts_received_count = s.gifts_received_count + EXCLUDED.gifts_received_count,
+            gifts_sent_count = s.gifts_sent_count + EXCLUDED.gifts_sent_count;
+    ELSE
+        INSERT INTO user_stats AS s (user_id, gifts_received_count, gifts_sent_count)
+        SELECT uid, -SUM(received), -SUM(sent) FROM (
+            SELECT user_id AS uid, 1 AS received, 0 AS sent FROM old_rows
+            UNION ALL
+            SELECT from_user_id, 0, 1 FROM old_rows
+        ) d
+        WHERE uid IS NOT NULL
+        GROUP BY uid
+        ORDER BY uid
+        ON CONFLICT (user_id) DO UPDATE SET
+            gifts_received_count = s.gifts_received_count + EXCLUDED.gifts_received_count,
+            gifts_sent_count = s.gifts_sent_count + EXCLUDED.gifts_sent_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION user_stats_transactions() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO user_stats AS s (user_id, transactions_count, topup_total, spent_total)
+        SELECT user_id,
+               COUNT(*),
+               COALESCE(SUM(amount) FILTER (WHERE type = 'topup'), 0),
+               COALESCE(SUM(amount) FILTER (WHERE type IN ('purchase', 'gift_sent')), 0)
+        FROM new_rows
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+        ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            transactions_count = s.transactions_count + EXCLUDED.transactions_count,
+            topup_total = s.topup_total + EXCLUDED.topup_total,
+            spent_total = s.spent_total + EXCLUDED.spent_total;
+    ELSE
+        INSERT INTO user_stats AS s (user_id, transactions_count, topup_total, spent_total)
+        SELECT user_id,
+               -COUNT(*),
+               -COALESCE(SUM(amount) FILTER (WHERE type = 'topup'), 0),
+               -COALESCE(SUM(amount) FILTER (WHERE type IN ('purchase', 'gift_sent')), 0)
+        FROM old_rows
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+        ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            transactions_count = s.transactions_count + EXCLUDED.transactions_count,
+            topup_total = s.topup_total + EXCLUDED.topup_total,
+            spent_total = s.spent_total + EXCLUDED.spent_total;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
@@ -0,0 +1,118 @@
+-- Порядковый номер сообщения в чате: read_count отметки (V0016) считается из счётчиков, а не по messages.
+--
+-- chat_stats.message_seq — сколько сообщений чата выдано номеров (удаление его не уменьшает),
+-- messages.chat_seq — номер сообщения. Сообщений после отмеченного ровно message_seq - chat_seq,
+-- пока после него ничего не удаляли, так что read_count = message_count - (message_seq - chat_seq).
+-- Номера выдаёт insert_messages (chats/index.py) одним upsert-ом chat_stats на чат пачки, в порядке
+-- chat_id, как и триггер V0003. У старых сообщений и вставленных мимо него chat_seq пуст: для отметки
+-- на таком сообщении read_count по-прежнему считается по индексу (chat_id, created_at, id).
+
+-- Без DEFAULT: добавление столбца на секционированную messages не переписывает секции
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS chat_seq INTEGER;
+
+ALTER TABLE chat_stats ADD COLUMN IF NOT EXISTS message_seq INTEGER NOT NULL DEFAULT 0;
+
+-- Новые номера идут после уже существующих сообщений. changed_xid (V0013) не трогаем:
+-- иначе каждый long-poll клиент получил бы событие по каждому своему чату
+ALTER TABLE chat_stats DISABLE TRIGGER trg_chat_stats_changed_xid;
+UPDATE chat_stats SET message_seq = message_count WHERE message_seq < message_count;
+ALTER TABLE chat_stats ENABLE TRIGGER trg_chat_stats_changed_xid;
+
+-- Перенос строк между секциями (V0012) копирует все хранимые столбцы messages, а не список,
+-- записанный в миграции: с фиксированным списком chat_seq терялся бы у строк, переехавших
+-- из messages_default в новую секцию месяца. Генерируемые столбцы секция вычисляет сама.
+CREATE OR REPLACE FUNCTION messages_columns() RETURNS TEXT AS $$
+    SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum)
+    FROM pg_attribute a
+    WHERE a.attrelid = 'messages'::regclass AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = '';
+$$ LANGUAGE sql STABLE SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION messages_create_partition(month_start TIMESTAMP) RETURNS BOOLEAN AS $$
+DECLARE
+    partition_name TEXT := messages_partition_name(month_start);
+    month_end TIMESTAMP := month_start + INTERVAL '1 month';
+    columns TEXT := messages_columns();
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    -- Строки месяца, уже попавшие в messages_default, переезжают в новую секцию:
+    -- иначе CREATE ... PARTITION OF откажет из-за нарушения ограничения default.
+    -- Вставка прямо в секцию не запускает триггеры родителя, chat_stats не меняется.
+    EXECUTE format('CREATE TEMP TABLE messages_default_moved ON COMMIT DROP AS SELECT %s FROM messages WITH NO DATA', columns);
+    EXECUTE format('
+        WITH moved AS (
+            DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING %s
+        )
+        INSERT INTO messages_default_moved SELECT * FROM moved', month_start, month_end, columns);
+    EXECUTE format('CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, month_start, month_end);
+    EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM messages_default_moved', partition_name, columns, columns);
+    DROP TABLE messages_default_moved;
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+CREATE OR REPLACE FUNCTION messages_split_legacy() RETURNS TEXT AS $$
+DECLARE
+    legacy_end TIMESTAMP := messages_legacy_upper();
+    month_start TIMESTAMP;
+    month_end TIMESTAMP;
+    partition_name TEXT;
+    columns TEXT := messages_columns();
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('messages_partitions'));
+    IF legacy_end IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    SELECT date_trunc('month', MIN(created_at)) INTO month_start FROM messages_legacy;
+    IF month_start IS NULL THEN
+        ALTER TABLE messages DETACH PARTITION messages_legacy;
+        DROP TABLE messages_legacy;
+        PERFORM messages_ensure_partitions();
+        RETURN NULL;
+    END IF;
+    IF month_start >= date_trunc('month', LOCALTIMESTAMP) THEN
+        RETURN NULL;
+    END IF;
+
+    month_end := month_start + INTERVAL '1 month';
+    partition_name := messages_partition_name(month_start);
+
+    EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)',
+                   partition_name);
+    EXECUTE format('INSERT INTO %I (%s) SELECT %s FROM messages_legacy WHERE created_at < %L',
+                   partition_name, columns, columns, month_end);
+    -- Проверенное ограничение диапазона избавляет ATTACH от повторного сканирования секции
+    EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I CHECK (created_at >= %L AND created_at < %L)',
+                   partition_name, partition_name || '_range', month_start, month_end);
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id, created_at)', partition_name);
+    EXECUTE format('CREATE INDEX ON %I (chat_id, created_at, id)', partition_name);
+    EXECUTE format('CREATE INDEX ON %I USING gin (search_vector)', partition_name);
+    EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (chat_id) REFERENCES chats(id), '
+                   'ADD FOREIGN KEY (sender_id) REFERENCES users(id)', partition_name);
+
+    ALTER TABLE messages DETACH PARTITION messages_legacy;
+    EXECUTE format('DELETE FROM messages_legacy l USING %I m WHERE l.id = m.id AND l.created_at = m.created_at',
+                   partition_name);
+    ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_range;
+    EXECUTE format('ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, month_start, month_end);
+    EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', partition_name, partition_name || '_range');
+
+    IF month_end >= legacy_end THEN
+        IF EXISTS (SELECT 1 FROM messages_legacy) THEN
+            RAISE EXCEPTION 'messages_legacy still has rows after moving its last month %', month_start;
+        END IF;
+        DROP TABLE messages_legacy;
+    ELSE
+        EXECUTE format('ALTER TABLE messages_legacy ADD CONSTRAINT messages_legacy_range '
+                       'CHECK (created_at >= %L AND created_at < %L)', month_end, legacy_end);
+        EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (%L) TO (%L)',
+                       month_end, legacy_end);
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
@@ -26,6 +26,12 @@ export const api = {
   },
   
   users: {
+    bootstrap: async (userId: number, fields?: Array<'user' | 'stats' | 'friends' | 'blocked' | 'chats'>) => {
+      const query = fields?.length ? `&fields=${fields.join(',')}` : '';
+      const response = await fetch(`${API_URLS.users}?user_id=${userId}&action=bootstrap${query}`);
+      return response.json();
+    },
+    
     getStats: async (userId: number) => {
       const response = await fetch(`${API_URLS.users}?user_id=${userId}&action=stats`);
       return response.json();